@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Running baselines and ΔF/F that can be updated as more samples arrive,
+e.g. while a video is being measured.
+
+All the classes here take the samples of several signals (one value
+per signal and sample) and use a trailing window: the baseline at a
+given sample is calculated from that sample and the `window - 1`
+samples before it. Until the window is full, the samples available are
+used. NaN values are ignored.
+'''
+
+from bisect import bisect_left, insort
+
+import numpy as np
+import pandas as pd
+
+
+class RollingPercentile:
+    '''
+    Running percentile of `n` signals over a window of `window`
+    samples. Percentiles are interpolated between samples as with
+    `np.percentile`.
+
+    Samples can be added one or a block at a time. A block at least as
+    long as the samples still in the window is calculated, together
+    with those samples, with pandas' rolling quantiles, which keep the
+    window of each signal in a skiplist: O(log window) per sample, in
+    compiled code, for all the signals at once. Shorter blocks, e.g.
+    the few frames measured at a time while a video is being recorded,
+    would then be mostly calculated again; instead, their samples are
+    added to a sorted list per signal: a binary search plus the
+    insertion and removal of one item, which moves O(window) items but
+    as a single memory move, so it is fast for windows of a few
+    thousand samples.
+    '''
+    def __init__(self, n, window, percentile):
+        if window < 1:
+            raise ValueError("window must be at least 1 sample")
+        if not 0 <= percentile <= 100:
+            raise ValueError("percentile must be between 0 and 100")
+        self.window = window
+        self.percentile = percentile
+        # The window itself, as a ring buffer, to know which value
+        # drops out of it at each update.
+        self._ring = np.full((window, n), np.nan)
+        self._index = 0
+        self._count = 0
+        # The values in the window of each signal, sorted; made from the
+        # ring buffer when first needed.
+        self._sorted = None
+
+    def update(self, values):
+        '''
+        Adds samples to the window and returns the percentile of each
+        signal at each of them. `values` is a sample (one value per
+        signal) or an array with one row per sample; the result has
+        the same shape.
+        '''
+        values = np.asarray(values, dtype=float)
+        samples = values.reshape(-1, self._ring.shape[1])
+        history = min(self._count, self.window - 1)
+        if len(samples) >= history:
+            baseline = self._update_block(samples, history)
+        else:
+            baseline = np.array([self._update_sample(sample)
+                                 for sample in samples])
+        return baseline.reshape(values.shape)
+
+    def _update_block(self, samples, history):
+        # The samples still in the window, oldest first, and then the
+        # new ones.
+        indices = (self._index - history + np.arange(history)) % self.window
+        data = np.concatenate([self._ring[indices], samples])
+        rolling = pd.DataFrame(data).rolling(self.window, min_periods=1)
+        if self.percentile == 0:
+            baseline = rolling.min()
+        else:
+            baseline = rolling.quantile(self.percentile / 100,
+                                        interpolation='linear')
+        last = data[-self.window:]
+        self._ring[:] = np.nan
+        self._ring[:len(last)] = last
+        self._index = len(last) % self.window
+        self._count += len(samples)
+        self._sorted = None
+        return baseline.to_numpy()[history:]
+
+    def _update_sample(self, values):
+        if self._sorted is None:
+            self._sorted = [np.sort(column[~np.isnan(column)]).tolist()
+                            for column in self._ring.T]
+        old_values = self._ring[self._index].tolist()
+        self._ring[self._index] = values
+        self._index = (self._index + 1) % self.window
+        self._count += 1
+
+        baseline = np.full(len(self._sorted), np.nan)
+        fraction = self.percentile / 100
+        for (n, (window, old, new)) in enumerate(
+                zip(self._sorted, old_values, values.tolist())):
+            if old == old:  # i.e. not NaN
+                del window[bisect_left(window, old)]
+            if new == new:
+                insort(window, new)
+            if window:
+                position = fraction * (len(window) - 1)
+                lower = int(position)
+                weight = position - lower
+                baseline[n] = window[lower]
+                if weight > 0:
+                    baseline[n] += weight * (window[lower + 1] -
+                                             window[lower])
+        return baseline
+
+
+class DeltaF:
+    '''
+    ΔF/F of `n` signals, where F is a running baseline: the
+    `percentile` of each signal over a window of `window` samples.
+    '''
+    def __init__(self, n, window, percentile=8):
+        self.baseline = RollingPercentile(n, window, percentile)
+
+    def update(self, values):
+        '''
+        Adds samples, one or a block of them as in
+        RollingPercentile.update, and returns their ΔF/F.
+        '''
+        values = np.asarray(values, dtype=float)
+        baseline = self.baseline.update(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (values - baseline) / baseline
+
+
+def delta_f(values, window, percentile=8):
+    '''
+    Returns the ΔF/F of `values`, an array with one row per sample and
+    one column per signal. See DeltaF.
+    '''
+    values = np.asarray(values, dtype=float)
+    return DeltaF(values.shape[1], window, percentile).update(values)
@@ -0,0 +1,142 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Time how long VideoTiff takes to read a compressed TIFF with different
+numbers of threads, to choose the number used by default.
+
+A video of 16-bit noise over a smooth image (which compresses, but not
+to nothing) is saved with each compression, and read with each number
+of threads from 1 to the number of CPUs and with the default (half the
+number of CPUs, that of tifffile): loaded whole, and read a few pages
+at a time (paged) as measuring does. Each time is the shortest of
+`--repeat` runs, as a multiple of that with 1 thread:
+
+    python3 benchmark_tiff.py
+    python3 benchmark_tiff.py --frames 2000 --size 512 --repeat 5
+
+A TIFF file can be given instead, to time that one.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from memory import budget
+from video import VideoTiff
+
+COMPRESSIONS = ('zlib', 'lzw')
+
+
+def make_frames(count, size):
+    rng = np.random.RandomState(0)
+    (y, x) = np.mgrid[:size, :size] / size
+    image = 20000 + 10000 * np.sin(6 * x) * np.cos(4 * y)
+    frames = image + rng.normal(0, 500, (count, size, size))
+    return frames.clip(0, 2**16 - 1).astype(np.uint16)
+
+
+def read_time(filename, threads, paged, repeat):
+    '''
+    Returns the shortest time, of `repeat` runs, to open `filename`
+    and read all its frames.
+    '''
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        video = VideoTiff(filename, fps=1, threads=threads,
+                          memory=0 if paged else None)
+        if paged:
+            for (frame_number, frame) in video.iter_frames():
+                pass
+        times.append(time.perf_counter() - start)
+        video.close()
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description=('Time reading a compressed TIFF with different '
+                         'numbers of threads'))
+    parser.add_argument(
+            'filename', nargs='?', type=str, default=None,
+            help='TIFF file (default: synthetic videos)')
+    parser.add_argument(
+            '--frames', type=int, default=500,
+            help='Number of frames of each video (default: 500)')
+    parser.add_argument(
+            '--size', type=int, default=256,
+            help='Width and height of the frames (default: 256)')
+    parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='Runs of each case (default: 3)')
+    args = parser.parse_args()
+
+    import tifffile
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(
+            os, 'sched_getaffinity') else os.cpu_count() or 1
+    thread_counts = sorted({1, 2, cpus // 2 or 1, cpus} |
+                           {2**n for n in range(cpus.bit_length())})
+    thread_counts = [threads for threads in thread_counts
+                     if threads <= cpus] + [None]
+    print('{} CPUs; default: {} threads'.format(cpus,
+                                                tifffile.TIFF.MAXWORKERS))
+    # Enough for the videos to be loaded whole.
+    budget.limit = max(budget.limit, 2**33)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        if args.filename is None:
+            frames = make_frames(args.frames, args.size)
+            filenames = []
+            for compression in COMPRESSIONS:
+                filename = os.path.join(dirname, compression + '.tif')
+                try:
+                    tifffile.imwrite(filename, frames,
+                                     compression=compression)
+                except KeyError as error:
+                    # LZW requires the imagecodecs module.
+                    print('Skipping {}: {}'.format(compression, error))
+                    continue
+                filenames.append(filename)
+        else:
+            filenames = [args.filename]
+        print('{:<12}{:<8}{:>8}{:>10}{:>10}'.format(
+                'file', 'read', 'threads', 'time (s)', 'speed-up'))
+        for filename in filenames:
+            for paged in (False, True):
+                single = None
+                for threads in thread_counts:
+                    seconds = read_time(filename, threads, paged,
+                                        args.repeat)
+                    single = single or seconds
+                    print('{:<12}{:<8}{:>8}{:>10.3f}{:>10.2f}'.format(
+                            os.path.basename(filename)[:11],
+                            'paged' if paged else 'whole',
+                            'default' if threads is None else threads,
+                            seconds, single / seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
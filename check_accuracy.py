@@ -0,0 +1,580 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Check that every way of measuring ROIs gives the right intensities.
+
+Synthetic videos of noise, with some saturated pixels, are measured,
+so that any pixel taken by mistake, or missed, changes the result.
+What each way of measuring should give is calculated here from the
+frames, independently of measure.py, with the rule that measuring
+follows: a pixel belongs to a ROI if its centre is inside the ellipse
+(see `ellipse_mask`). The ROIs are rotated ellipses of different
+shapes, and some of them are partly outside the frame.
+
+The videos are made in every format (8 and 16-bit, gray and RGB) and
+read with every video class: VideoCv (an AVI file with a lossless
+codec, 8-bit only), VideoTiff, VideoStore and VideoSequence. Each of
+them is measured with each engine:
+
+    mask        measure.measure with a RoiSet
+    labels      measure.measure with a LabelImage
+    parallel    measure.measure with worker processes
+    binned      measure.measure with frames binned 2 x 2
+    channels    measure.measure of each colour channel (RGB only)
+    statistics  every statistic in measure.STATISTICS
+    neuropil    the neuropil and the intensity corrected for it
+    motion      ROIs moved by a random shift in each frame, some of
+                them partly out of the frame
+    dff         ΔF/F over a window of DFF_WINDOW frames
+
+The largest difference from what the rule gives must be within the
+tolerance of each engine (see `tolerance`): floating point error,
+except where the values of the pixels measured are rounded to the
+integer type of the video.
+
+The first five engines are also compared with the original measuring
+of videoroi, the reference, with pyqtgraph's
+EllipseROI.getArrayRegion and data[mask].mean() for each ROI and frame
+(skipped if pyqtgraph is not available). It interpolates frames, so it
+takes pixels near the edge of each ROI in part, or not at all; only
+the weights of pixels within a pixel of the edge (within the binning,
+for binned frames) differ from the rule, each by at most 1/A in a ROI
+of A pixels. If there are B such pixels, the standard deviation of the
+difference is at most sqrt(B) / A times that of the noise; the root
+mean square over the frames of the difference of each ROI must be
+within that bound (see `reference_bounds`). The largest ratio to the
+bound is shown. This only bounds how far videoroi has moved from the
+reference; pixels taken by mistake are found by the comparison with
+the rule.
+
+The time taken by each engine, including reading the video (and, for
+the parallel engine, starting its processes), is shown with the
+result:
+
+    python3 check_accuracy.py
+    python3 check_accuracy.py --frames 200 --output accuracy.tsv
+
+Exits with status 1 if any check fails.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from measure import (CHANNELS, NEUROPIL_RADII, STATISTICS, EllipseRoi,
+                     LabelImage, gray, measure, select_measure)
+from video import Video, transcode
+
+ENGINES = ('mask', 'labels', 'parallel', 'binned', 'channels',
+           'statistics', 'neuropil', 'motion', 'dff')
+# Engines that measure the intensity only, which are compared with the
+# reference too.
+INTENSITY_ENGINES = ('mask', 'labels', 'parallel', 'binned', 'channels')
+# Difference allowed for floating point error, relative to the largest
+# value of a pixel (ROIs moved partly out of the frame are measured in
+# single precision).
+FLOAT_ERROR = 1e-6
+# Size of the synthetic videos, and fraction of their pixels that are
+# saturated.
+WIDTH = 160
+HEIGHT = 120
+SATURATED = 0.02
+BINNING = 2
+NEUROPIL_FACTOR = 0.7
+DFF_WINDOW = 5
+DFF_PERCENTILE = 8
+# Largest shift of the ROIs by the motion engine (pixels).
+MAX_SHIFT = 6
+# ROIs: rotated ellipses of different shapes, and some partly outside
+# the frame (left edge, bottom right corner and top edge).
+ROIS = [EllipseRoi('round', (10, 12), (20, 20)),
+        EllipseRoi('flat', (50, 10), (36, 10), 20),
+        EllipseRoi('tall', (110, 8), (12, 30), 45),
+        EllipseRoi('tilted', (40, 50), (30, 14), 120),
+        EllipseRoi('thin', (95, 55), (40, 5), -30),
+        EllipseRoi('small', (130, 55), (5, 5), 10),
+        EllipseRoi('left', (-8, 70), (20, 24)),
+        EllipseRoi('corner', (148, 108), (24, 20), 15),
+        EllipseRoi('top', (135, -6), (18, 14), 60)]
+FORMATS = ('uint8', 'uint16', 'uint8 rgb', 'uint16 rgb')
+BACKENDS = ('cv', 'tiff', 'store', 'sequence')
+
+
+def make_frames(frame_count, dtype, rgb, seed=0):
+    '''
+    Returns synthetic frames (RGB if `rgb`): noise over the whole range
+    of `dtype`, with a fraction SATURATED of the pixels at its maximum.
+    '''
+    random = np.random.RandomState(seed)
+    top = np.iinfo(dtype).max
+    shape = (frame_count, HEIGHT, WIDTH, 3 if rgb else 1)
+    frames = random.randint(0, top + 1, shape).astype(dtype)
+    frames[random.random_sample(shape[:3]) < SATURATED] = top
+    return frames if rgb else frames[..., 0]
+
+
+def make_shifts(frame_count, seed=0):
+    '''
+    Returns a random shift (x, y) for each frame, of up to MAX_SHIFT
+    pixels.
+    '''
+    random = np.random.RandomState(seed)
+    return random.uniform(-MAX_SHIFT, MAX_SHIFT, (frame_count, 2))
+
+
+def write_video(frames, backend, dirname, name):
+    '''
+    Saves `frames` (RGB if they have 4 dimensions) in the format read by
+    `backend` and returns the name of the video.
+    '''
+    import tifffile
+
+    rgb = frames.ndim == 4
+    tiff = os.path.join(dirname, name + '.tif')
+    if not os.path.exists(tiff):
+        tifffile.imwrite(tiff, frames,
+                         photometric='rgb' if rgb else 'minisblack')
+    if backend == 'tiff':
+        return tiff
+    if backend == 'store':
+        filename = os.path.join(dirname, name + '_frames')
+        transcode(Video(tiff), filename).close()
+        return filename
+
+    # OpenCV writes and reads colour frames as BGR.
+    bgr = frames[..., ::-1] if rgb else frames
+    if backend == 'sequence':
+        filename = os.path.join(dirname, name + '_images')
+        os.makedirs(filename, exist_ok=True)
+        for (frame_number, frame) in enumerate(bgr):
+            cv2.imwrite(os.path.join(
+                filename, 'frame_{:06d}.png'.format(frame_number)), frame)
+        return filename
+    filename = os.path.join(dirname, name + '.avi')
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'FFV1'),
+                             10, (WIDTH, HEIGHT), rgb)
+    for frame in bgr:
+        writer.write(frame)
+    writer.release()
+    return filename
+
+
+def ellipse_mask(roi, width, height, scale=1):
+    '''
+    Returns the pixels of a frame of `width` x `height` that belong to
+    `roi`, with its position and size multiplied by `scale`: those
+    whose centre is inside the ellipse. It is calculated from the
+    centre and the axes of the ellipse, not as measure.EllipseRoi
+    does, so that this checks it.
+    '''
+    theta = np.deg2rad(roi.angle)
+    (cos, sin) = (np.cos(theta), np.sin(theta))
+    (a, b) = (roi.x_size * scale / 2, roi.y_size * scale / 2)
+    # The ellipse is rotated about its origin, the top left corner of
+    # its bounding box.
+    x_centre = roi.x_pos * scale + a * cos - b * sin
+    y_centre = roi.y_pos * scale + a * sin + b * cos
+    (y, x) = np.mgrid[:height, :width] + 0.5
+    (dx, dy) = (x - x_centre, y - y_centre)
+    return ((dx * cos + dy * sin) / a)**2 + \
+        ((dy * cos - dx * sin) / b)**2 <= 1
+
+
+def gray_frames(frames, video):
+    '''
+    Returns `frames`, made by make_frames, converted to gray as `video`
+    reads them and measuring converts them: as if they were BGR,
+    whatever the order of their channels.
+    '''
+    if frames.ndim == 3:
+        return frames.astype(float)
+    if video.channel_order == 'bgr':
+        frames = frames[..., ::-1]
+    return np.array([gray(np.ascontiguousarray(frame))
+                     for frame in frames], dtype=float)
+
+
+def combine_channels(intensity, video):
+    '''
+    Returns the gray intensity of each ROI in each frame (frame, ROI)
+    from that of its channels (frame, ROI, channel, in the order of
+    CHANNELS), weighted as frames of `video` are converted to gray.
+    '''
+    # As in `gray_frames`, frames are converted as if they were BGR.
+    weights = dict(zip(video.channel_order, (0.114, 0.587, 0.299)))
+    return sum(intensity[..., index] * weights[initial]
+               for (index, initial) in enumerate(CHANNELS))
+
+
+def means(pixels, masks):
+    '''
+    Returns the mean of `pixels` (frame, y, x) in each of `masks`, as
+    an array (frame, mask).
+    '''
+    return np.column_stack([pixels[:, mask].mean(axis=1)
+                            for mask in masks])
+
+
+def expected(engine, frames, video, shifts):
+    '''
+    Returns what `engine` should measure in `video`, made from
+    `frames`, according to the rule: a dictionary with an array
+    (frame, ROI) for each measure, by the name given to select_measure.
+    '''
+    masks = [ellipse_mask(roi, WIDTH, HEIGHT) for roi in ROIS]
+    if engine == 'binned':
+        # Averages of blocks of pixels, converted to gray as OpenCV
+        # does but without rounding.
+        blocks = frames.reshape((len(frames), HEIGHT // BINNING, BINNING,
+                                 WIDTH // BINNING, BINNING) +
+                                frames.shape[3:]).mean(axis=(2, 4))
+        if blocks.ndim == 4:
+            blocks = combine_channels(blocks, video)
+        binned_masks = [ellipse_mask(roi, WIDTH // BINNING,
+                                     HEIGHT // BINNING, 1 / BINNING)
+                        for roi in ROIS]
+        return {'intensity': means(blocks, binned_masks)}
+    if engine == 'channels':
+        # The channels of the frames made, whatever order the video
+        # reads them in.
+        return {name: means(frames[..., 'rgb'.index(initial)].astype(float),
+                            masks)
+                for (initial, name) in CHANNELS.items()}
+
+    pixels = gray_frames(frames, video)
+    intensity = means(pixels, masks)
+    if engine == 'statistics':
+        top = np.iinfo(frames.dtype).max
+        functions = dict(mean=np.mean, std=np.std, median=np.median,
+                         min=np.min, max=np.max,
+                         saturated=lambda values: np.sum(values >= top),
+                         area=np.size)
+        result = {name: np.column_stack([
+                          [functions[name](frame[mask]) for frame in pixels]
+                          for mask in masks])
+                  for name in STATISTICS}
+        result['intensity'] = result.pop('mean')
+        return result
+    if engine == 'neuropil':
+        # The pixels within `outer` pixels of each ROI but not within
+        # `inner` pixels of any, as grown with OpenCV's elliptical
+        # structuring element.
+        (inner, outer) = NEUROPIL_RADII
+
+        def grow(mask, pixels):
+            kernel = cv2.getStructuringElement(
+                    cv2.MORPH_ELLIPSE, (2 * pixels + 1, 2 * pixels + 1))
+            return cv2.dilate(mask.astype(np.uint8), kernel).astype(bool)
+
+        excluded = grow(np.any(masks, axis=0), inner)
+        annuli = [grow(mask, outer) & ~excluded for mask in masks]
+        neuropil = means(pixels, annuli)
+        return {'intensity': intensity, 'neuropil': neuropil,
+                'corrected': intensity - NEUROPIL_FACTOR * neuropil}
+    if engine == 'motion':
+        # The pixels of each ROI in the frame, moved by the shift of
+        # each frame rounded to whole pixels; those moved out of the
+        # frame are not measured.
+        intensity = np.empty((len(frames), len(ROIS)))
+        for (frame_number, (dx, dy)) in enumerate(
+                np.rint(shifts).astype(int)):
+            for (roi_number, mask) in enumerate(masks):
+                (y, x) = np.nonzero(mask)
+                (y, x) = (y + dy, x + dx)
+                inside = (x >= 0) & (x < WIDTH) & (y >= 0) & (y < HEIGHT)
+                intensity[frame_number, roi_number] = \
+                    pixels[frame_number, y[inside], x[inside]].mean()
+        return {'intensity': intensity}
+    if engine == 'dff':
+        # The baseline of each frame is the percentile of the window of
+        # frames that ends with it.
+        baseline = np.array([
+                np.percentile(intensity[max(0, end - DFF_WINDOW):end],
+                              DFF_PERCENTILE, axis=0)
+                for end in range(1, len(intensity) + 1)])
+        return {'intensity': intensity,
+                'dff': (intensity - baseline) / baseline}
+    return {'intensity': intensity}
+
+
+def tolerance(engine, dtype, rgb):
+    '''
+    Returns the largest difference allowed between what `engine`
+    measures in a video of `dtype` and what the rule gives, in gray
+    levels (pixels, for the statistics that count them): floating point
+    error, plus half a level for each time that the values of the
+    pixels measured are rounded to the integer type of the video and
+    the rule does not round them. For 'dff', whose ΔF/F is measured in
+    double precision, it is the floating point error of that.
+    '''
+    if engine == 'dff':
+        return FLOAT_ERROR
+    roundings = 0
+    if engine == 'binned':
+        # By cv2.resize and, for colour frames, by the conversion to
+        # gray of the binned frames.
+        roundings = 2 if rgb else 1
+    elif engine == 'motion' and rgb:
+        # ROIs moved partly out of the frame are measured from a
+        # floating point crop, which is converted to gray without
+        # rounding; the rule rounds all.
+        roundings = 1
+    return FLOAT_ERROR * np.iinfo(dtype).max + roundings / 2
+
+
+def reference_bounds(engine, dtype, rgb, frame_count, sigma):
+    '''
+    Returns, for each ROI, the largest root mean square over
+    `frame_count` frames of the difference between what `engine` and
+    the reference measure, as a fraction of the standard deviation of
+    the noise, `sigma`. See the module's docstring.
+    '''
+    reach = BINNING if engine == 'binned' else 1
+    kernel = np.ones((2 * reach + 1, 2 * reach + 1), dtype=np.uint8)
+    bounds = []
+    for roi in ROIS:
+        mask = ellipse_mask(roi, WIDTH, HEIGHT).astype(np.uint8)
+        # Pixels within `reach` pixels of the edge, inside or outside
+        # the ROI. The edges of the frame are not edges of the ROI.
+        edge = (cv2.dilate(mask, kernel) -
+                cv2.erode(mask, kernel, borderValue=1))
+        bounds.append(np.sqrt(edge.sum()) / mask.sum())
+    # The root mean square of n frames estimates the standard deviation
+    # with an error of about 1 / sqrt(2 n) of it; allow three times
+    # that. Rounding (see `tolerance`) adds up to a level, and the
+    # reference rounds the gray of colour frames, which the channels
+    # engine does not.
+    rounding = (tolerance(engine, dtype, rgb) +
+                0.5 * (engine == 'channels'))
+    return (np.array(bounds) * (1 + 3 / np.sqrt(2 * frame_count)) +
+            rounding / sigma)
+
+
+def measure_reference(video, rois):
+    '''
+    Measures `rois` in `video` as videoroi originally did, with
+    pyqtgraph, one ROI at a time. Returns a DataFrame as `measure`
+    does, without the time.
+    '''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import pyqtgraph as pg
+
+    pg.mkQApp()
+    img_item = pg.ImageItem(axisOrder='row-major')
+    view_box = pg.ViewBox()
+    view_box.addItem(img_item)
+    items = []
+    for roi in rois:
+        item = pg.EllipseROI((roi.x_pos, roi.y_pos),
+                             (roi.x_size, roi.y_size), angle=roi.angle)
+        view_box.addItem(item)
+        items.append(item)
+
+    intensity = pd.DataFrame(index=np.arange(video.frame_count),
+                             columns=[roi.name for roi in rois],
+                             dtype=float)
+    masks = None
+    for (frame_number, frame) in video.iter_frames():
+        frame = gray(frame)
+        img_item.setImage(frame)
+        if masks is None:
+            ones = np.ones_like(frame)
+            masks = [item.getArrayRegion(ones, img_item).astype('bool')
+                     for item in items]
+        for (roi, item, mask) in zip(rois, items, masks):
+            data = item.getArrayRegion(frame, img_item)
+            intensity.loc[frame_number, roi.name] = data[mask].mean()
+    return intensity
+
+
+def run_engine(engine, video, rois, workers, shifts):
+    '''
+    Measures `rois` in `video` with `engine`. Returns the DataFrame
+    returned by `measure` and the time taken in seconds.
+    '''
+    started = time.perf_counter()
+    if engine == 'reference':
+        intensity = measure_reference(video, rois)
+    elif engine == 'labels':
+        labels = LabelImage.from_rois(rois, video.width, video.height)
+        intensity = measure(video, labels)
+    elif engine == 'parallel':
+        intensity = measure(video, rois, workers=workers)
+    elif engine == 'binned':
+        intensity = measure(video, rois, binning=BINNING)
+    elif engine == 'channels':
+        intensity = measure(video, rois,
+                            channels=tuple(CHANNELS.values()))
+    elif engine == 'statistics':
+        intensity = measure(video, rois, statistics=STATISTICS)
+    elif engine == 'neuropil':
+        intensity = measure(video, rois, neuropil_factor=NEUROPIL_FACTOR)
+    elif engine == 'motion':
+        intensity = measure(video, rois, shifts=shifts)
+    elif engine == 'dff':
+        # A window of DFF_WINDOW frames, whatever the frame rate.
+        intensity = measure(video, rois, dff_window=DFF_WINDOW / video.fps,
+                            dff_percentile=DFF_PERCENTILE)
+    else:
+        intensity = measure(video, rois)
+    return (intensity, time.perf_counter() - started)
+
+
+def largest_difference(measured, truth):
+    '''
+    Returns the largest absolute difference between two arrays, taking
+    NaN (e.g. the statistics of a ROI without pixels) as equal to NaN
+    only.
+    '''
+    if measured.shape != truth.shape:
+        return np.inf
+    difference = np.abs(measured - truth)
+    difference[np.isnan(measured) & np.isnan(truth)] = 0
+    return np.nan_to_num(difference, nan=np.inf).max()
+
+
+def check(engine, video, frames, shifts, workers, reference=None):
+    '''
+    Measures `video`, made from `frames`, with `engine`. Returns the
+    largest difference from what the rule gives, the time taken and,
+    if the intensities measured by the reference (a DataFrame) are
+    given, the largest ratio of the difference from them to its bound.
+    '''
+    (intensity, seconds) = run_engine(engine, video, ROIS, workers,
+                                      shifts)
+    truth = expected(engine, frames, video, shifts)
+    measured = {name: select_measure(intensity, name).drop(
+                        columns='time').to_numpy(dtype=float)
+                for name in truth}
+    error = max(largest_difference(measured[name], truth[name])
+                for name in truth)
+    if reference is None:
+        return (error, seconds, None)
+
+    if engine == 'channels':
+        values = np.stack([measured[name] for name in CHANNELS.values()],
+                          axis=2)
+        values = combine_channels(values, video)
+    else:
+        values = measured['intensity']
+    pixels = gray_frames(frames, video)
+    sigma = pixels.std()
+    rms = np.sqrt(np.mean((values - reference) ** 2, axis=0)) / sigma
+    bounds = reference_bounds(engine, frames.dtype, frames.ndim == 4,
+                              len(frames), sigma)
+    return (error, seconds, (rms / bounds).max())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description=('Check that every engine and video class '
+                         'measures synthetic videos correctly'))
+    parser.add_argument(
+            '--frames', type=int, default=20,
+            help='Number of frames of each video (default: 20)')
+    parser.add_argument(
+            '--workers', type=int, default=2,
+            help='Processes for the parallel engine (default: 2)')
+    parser.add_argument(
+            '--engines', nargs='+', default=list(ENGINES),
+            choices=ENGINES, help='Engines to check')
+    parser.add_argument(
+            '--backends', nargs='+', default=list(BACKENDS),
+            choices=BACKENDS, help='Video classes to check')
+    parser.add_argument(
+            '--output', type=str, default=None,
+            help='Save the results in this file (tab separated)')
+    args = parser.parse_args()
+
+    compare = True
+    try:
+        import pyqtgraph  # noqa: F401
+    except ImportError:
+        print('pyqtgraph not available: skipping the comparison with '
+              'the reference')
+        compare = False
+
+    results = []
+
+    def add_result(video_format, backend, engine, compared, error,
+                   allowed, seconds):
+        passed = error <= allowed
+        results.append(dict(
+                format=video_format, backend=backend, engine=engine,
+                compared=compared, error=error, tolerance=allowed,
+                passed=passed, seconds=seconds,
+                fps=args.frames / seconds))
+        print('{:<11} {:<9} {:<10} {:<9} error {:.2e} (tolerance '
+              '{:.1e}) {:>8.1f} fps  {}'.format(
+                  video_format, backend, engine, compared, error, allowed,
+                  args.frames / seconds, 'ok' if passed else 'FAILED'))
+
+    shifts = make_shifts(args.frames)
+    with tempfile.TemporaryDirectory() as dirname:
+        for video_format in FORMATS:
+            dtype = np.dtype(video_format.split()[0])
+            rgb = video_format.endswith('rgb')
+            frames = make_frames(args.frames, dtype, rgb)
+            name = video_format.replace(' ', '_')
+            for backend in args.backends:
+                if backend == 'cv' and dtype != np.uint8:
+                    # OpenCV only writes 8-bit videos.
+                    continue
+                video = Video(write_video(frames, backend, dirname, name))
+                reference = None
+                if compare:
+                    # The reference is what the others are compared
+                    # with, not checked itself.
+                    (reference, _) = run_engine('reference', video, ROIS,
+                                                args.workers, shifts)
+                    reference = reference[[roi.name for roi in ROIS]] \
+                        .to_numpy(dtype=float)
+                for engine in args.engines:
+                    if engine == 'channels' and not rgb:
+                        continue
+                    (error, seconds, ratio) = check(
+                            engine, video, frames, shifts, args.workers,
+                            reference if engine in INTENSITY_ENGINES
+                            else None)
+                    add_result(video_format, backend, engine, 'rule',
+                               error, tolerance(engine, dtype, rgb),
+                               seconds)
+                    if ratio is not None:
+                        add_result(video_format, backend, engine,
+                                   'reference', ratio, 1.0, seconds)
+                video.close()
+
+    results = pd.DataFrame(results)
+    if args.output is not None:
+        results.to_csv(args.output, sep='\t', index=False)
+    failed = (~results.passed).sum()
+    print('{} of {} checks passed'.format(len(results) - failed,
+                                          len(results)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
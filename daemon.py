@@ -0,0 +1,627 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A local service that measures videos on request.
+
+Every run of a script pays for starting Python, importing modules,
+opening the video and, for some formats, loading or indexing it. The
+daemon pays for that once: it keeps videos open between jobs (see
+VideoPool) and the results of recent jobs, and runs jobs on a pool of
+threads. Start it with
+
+    python3 daemon.py
+
+and submit jobs from scripts, the command line (`measure.py --daemon`)
+or the graphical interface (MEASURE_DAEMON in videoroi.py):
+
+    from daemon import submit
+
+    intensity = submit('cells.avi', 'cells_ROIs.tsv', dff_window=30)
+
+It listens on a Unix socket that only its user can use (or on a port
+of localhost where there are no Unix sockets). There is no other
+authentication, and jobs read and write files as the user of the
+daemon, so it does not listen on ports of other interfaces than the
+loopback one, where other machines could connect. Requests and
+responses are JSON objects, one per line. A request is e.g.
+
+    {"command": "measure", "video": "cells.avi",
+     "rois": "cells_ROIs.tsv", "options": {"step": 2}}
+
+to which the daemon responds with a "queued" event, "progress" events
+and finally a "done" event with the data (or the name of the file where
+they were saved) or an "error" event. See `submit` for all the fields.
+Closing the connection cancels the job. {"command": "status"} returns
+the videos open, the jobs running and the memory used.
+'''
+
+import asyncio
+import collections
+import contextlib
+import functools
+import getpass
+import ipaddress
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Port used where there are no Unix sockets.
+DEFAULT_PORT = 47390
+
+# Longest request accepted, in bytes. ROIs sent in the request take
+# about 80 bytes each.
+REQUEST_LIMIT = 2**26
+
+
+def default_address():
+    '''
+    Returns the address of the daemon: a Unix socket in the temporary
+    directory, named after the user, or 'localhost:port'.
+    '''
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(tempfile.gettempdir(),
+                            'videoroi-{}.sock'.format(getpass.getuser()))
+    return 'localhost:{}'.format(DEFAULT_PORT)
+
+
+def _tcp_address(address):
+    '''
+    Returns (host, port) if `address` is 'host:port', or None if it is
+    the name of a Unix socket.
+    '''
+    match = re.match(r'^([\w.-]+):(\d+)$', address)
+    if match is None:
+        return None
+    return (match.group(1), int(match.group(2)))
+
+
+def _is_loopback(host):
+    '''
+    Returns True if all the addresses of `host` are loopback ones, so
+    that only this machine can connect to them.
+    '''
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    # IPv6 addresses may have a zone, e.g. 'fe80::1%eth0'.
+    return all(ipaddress.ip_address(sockaddr[0].split('%')[0]).is_loopback
+               for (family, type, proto, name, sockaddr) in addresses)
+
+
+def _to_json(value):
+    # numpy numbers and arrays, e.g. in the attrs of the data.
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError("Cannot convert {!r} to JSON".format(value))
+
+
+def _encode(message):
+    return (json.dumps(message, default=_to_json) + '\n').encode()
+
+
+async def _read_request(reader):
+    '''
+    Returns the first line read from `reader`, or None if it is longer
+    than the limit of the stream. Then the rest of the line is read
+    and dropped, so that the client, still sending it, gets the error
+    instead of a connection reset.
+    '''
+    try:
+        return await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as error:
+        return error.partial
+    except asyncio.LimitOverrunError as error:
+        consumed = error.consumed
+    while True:
+        try:
+            await reader.readexactly(consumed)
+            await reader.readuntil(b'\n')
+            return None
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError as error:
+            consumed = error.consumed
+
+
+class VideoPool:
+    '''
+    Videos kept open to be reused by later jobs.
+
+    `open` lends a video that nobody else is using, opening it only if
+    needed; it is kept when returned, unless the file has changed since
+    it was opened. At most `size` videos are kept; the ones used least
+    recently are closed first.
+    '''
+    def __init__(self, size=8):
+        self.size = size
+        # Idle videos by (filename, binning), with the modification
+        # time of the file when they were opened, most recently used
+        # last.
+        self._idle = collections.OrderedDict()
+        self._busy = collections.Counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def open(self, filename, binning=1):
+        from video import Video
+        key = (os.path.abspath(filename), binning)
+        mtime = os.path.getmtime(filename)
+        video = None
+        with self._lock:
+            videos = self._idle.get(key, [])
+            while videos and video is None:
+                (video, opened) = videos.pop()
+                if opened != mtime:
+                    video.close()
+                    video = None
+            if not videos:
+                self._idle.pop(key, None)
+            self._busy[key] += 1
+        try:
+            if video is None:
+                video = Video(filename, binning=binning)
+            yield video
+        finally:
+            with self._lock:
+                self._busy[key] -= 1
+                if video is not None:
+                    self._idle.setdefault(key, []).append((video, mtime))
+                    self._idle.move_to_end(key)
+                    self._trim()
+
+    def _trim(self):
+        while sum(len(videos) for videos in self._idle.values()) > \
+                self.size:
+            (key, videos) = next(iter(self._idle.items()))
+            (video, opened) = videos.pop(0)
+            video.close()
+            if not videos:
+                del self._idle[key]
+
+    def status(self):
+        '''
+        Returns the names of the videos open and how many are in use.
+        '''
+        with self._lock:
+            return dict(
+                idle=['{} (binning {})'.format(*key) for (key, videos)
+                      in self._idle.items() for video in videos],
+                busy=sum(self._busy.values()))
+
+
+class Daemon:
+    '''
+    The measurement service. Jobs run on `workers` threads (by default,
+    as many as ThreadPoolExecutor uses); decoding and most of the
+    measuring is done by OpenCV and NumPy, which let other threads run
+    meanwhile. The data of the last `cache_size` jobs are kept and
+    returned again without measuring, as long as the video and ROIs
+    have not changed. Their memory is taken from the memory budget
+    (see memory.py), and they are dropped when it is needed elsewhere.
+    '''
+    def __init__(self, workers=None, cache_size=32):
+        self.executor = ThreadPoolExecutor(workers)
+        self.videos = VideoPool()
+        self.cache_size = cache_size
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.jobs_running = 0
+        self.jobs_done = 0
+
+    async def serve(self, address=None):
+        '''
+        Accepts connections at `address` (see `default_address`) until
+        cancelled.
+        '''
+        if address is None:
+            address = default_address()
+        tcp = _tcp_address(address)
+        if tcp is not None:
+            if not _is_loopback(tcp[0]):
+                raise RuntimeError(
+                        "Refusing to listen at {}: only loopback "
+                        "addresses (e.g. localhost) are allowed, as there "
+                        "is no authentication".format(address))
+            server = await asyncio.start_server(self.handle, *tcp,
+                                                limit=REQUEST_LIMIT)
+        else:
+            if os.path.exists(address):
+                # Left by a daemon that did not stop cleanly, unless
+                # one is still listening.
+                with contextlib.suppress(OSError), \
+                        socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(address)
+                    raise RuntimeError(
+                            "A daemon is already running at " + address)
+                os.remove(address)
+            # Only the user can connect: jobs read and write files.
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(
+                        self.handle, address, limit=REQUEST_LIMIT)
+            finally:
+                os.umask(umask)
+        print('Listening at', address, flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if tcp is None and os.path.exists(address):
+                os.remove(address)
+            self.executor.shutdown(wait=False)
+
+    async def handle(self, reader, writer):
+        '''
+        Handles a connection: reads one request and responds to it.
+        '''
+        try:
+            line = await _read_request(reader)
+            if line is None:
+                writer.write(_encode(dict(
+                    event='error',
+                    message='Request longer than {} bytes'.format(
+                        REQUEST_LIMIT))))
+                await writer.drain()
+                return
+            try:
+                request = json.loads(line)
+                command = request.get('command', 'measure')
+            except ValueError:
+                writer.write(_encode(dict(event='error',
+                                          message='Invalid request')))
+                return
+            if command == 'status':
+                writer.write(_encode(dict(event='status',
+                                          **self.status())))
+            elif command == 'measure':
+                await self.run_job(request, reader, writer)
+            else:
+                writer.write(_encode(dict(
+                    event='error', message='Unknown command: ' + command)))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run_job(self, request, reader, writer):
+        '''
+        Runs a measure request on the thread pool, sending progress
+        events until it is done. The job is cancelled if the client
+        closes the connection.
+        '''
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        cancelled = threading.Event()
+        last = [None]
+
+        def progress(frames_done, frame_count):
+            # Only send an event when the percentage changes, not for
+            # every frame.
+            percent = 100 * frames_done // max(frame_count, 1)
+            if percent != last[0]:
+                last[0] = percent
+                loop.call_soon_threadsafe(messages.put_nowait, dict(
+                    event='progress', done=frames_done,
+                    total=frame_count))
+            return cancelled.is_set()
+
+        writer.write(_encode(dict(event='queued')))
+        await writer.drain()
+        job = loop.run_in_executor(self.executor, self.measure, request,
+                                   progress)
+        # Anything read from the client, or the end of the connection,
+        # cancels the job.
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                message = asyncio.ensure_future(messages.get())
+                (done, pending) = await asyncio.wait(
+                        {job, message, closed},
+                        return_when=asyncio.FIRST_COMPLETED)
+                if message in done:
+                    writer.write(_encode(message.result()))
+                    await writer.drain()
+                else:
+                    message.cancel()
+                if closed in done:
+                    cancelled.set()
+                    await asyncio.wait({job})
+                    return
+                if job in done:
+                    break
+            try:
+                writer.write(_encode(job.result()))
+            except Exception as error:
+                writer.write(_encode(dict(
+                    event='error',
+                    message='{}: {}'.format(type(error).__name__, error))))
+        finally:
+            closed.cancel()
+
+    def measure(self, request, progress=None):
+        '''
+        Runs a measure request (on a thread of the pool). Returns the
+        "done" event.
+        '''
+        from measure import (LabelImage, load_labels, load_rois, measure,
+                             save_intensity, EllipseRoi)
+        from video import companion_name
+
+        with self._lock:
+            self.jobs_running += 1
+        try:
+            filename = request['video']
+            key = self._cache_key(request)
+            with self._lock:
+                intensity = self._results.get(key, (None, None))[0]
+                if intensity is not None:
+                    self._results.move_to_end(key)
+            if intensity is None:
+                with self.videos.open(
+                        filename, request.get('video_binning', 1)) as video:
+                    rois = request.get('rois')
+                    if request.get('labels') is not None:
+                        rois = load_labels(request['labels'])
+                    elif rois is None:
+                        rois = load_rois(companion_name(filename) +
+                                         '_ROIs.tsv')
+                    elif isinstance(rois, str):
+                        rois = load_rois(rois)
+                    else:
+                        rois = [EllipseRoi(name, (x_pos, y_pos),
+                                           (x_size, y_size), angle)
+                                for (name, x_pos, y_pos, x_size, y_size,
+                                     angle) in rois]
+                    if request.get('method', 'mask') == 'labels':
+                        rois = LabelImage.from_rois(rois, video.width,
+                                                    video.height)
+                    shifts = None
+                    if request.get('motion'):
+                        from motion import get_shifts
+                        shifts = get_shifts(
+                                video, request.get('motion_binning', 1))
+                    options = dict(request.get('options', {}))
+                    for name in ('start', 'stop'):
+                        seconds = request.get(name + '_time')
+                        if seconds is not None:
+                            options[name] = round(seconds * video.fps)
+                    intensity = measure(video, rois, shifts=shifts,
+                                        progress=progress, **options)
+                if intensity is None:
+                    return dict(event='cancelled')
+                self._cache(key, intensity, filename)
+
+            output = request.get('output')
+            if output is not None:
+                save_intensity(output, intensity,
+                               request.get('format', 'long'))
+                return dict(event='done', output=output)
+            data = intensity.to_dict(orient='split')
+            return dict(event='done', data=data, attrs=intensity.attrs)
+        finally:
+            with self._lock:
+                self.jobs_running -= 1
+                self.jobs_done += 1
+
+    def _cache(self, key, intensity, filename):
+        '''
+        Keeps the data of a job, if the memory budget has room for
+        them.
+        '''
+        from memory import budget
+
+        allocation = budget.allocate(
+                'Data of ' + os.path.basename(filename),
+                int(intensity.memory_usage(deep=True).sum()),
+                release=functools.partial(self._drop_result, key))
+        if allocation is None:
+            return
+        dropped = []
+        with self._lock:
+            if key in self._results:
+                dropped.append(self._results.pop(key))
+            self._results[key] = (intensity, allocation)
+            while len(self._results) > self.cache_size:
+                dropped.append(self._results.popitem(last=False)[1])
+        # N.B. not with the lock held: the budget calls _drop_result
+        # with its own lock held.
+        for (intensity, allocation) in dropped:
+            allocation.free()
+
+    def _drop_result(self, key):
+        # Called by the memory budget when it needs the memory.
+        with self._lock:
+            self._results.pop(key, None)
+
+    @staticmethod
+    def _cache_key(request):
+        '''
+        Returns a key that identifies the data a request asks for,
+        including the time the files it reads were modified.
+        '''
+        from video import companion_name
+
+        fields = {name: value for (name, value) in request.items()
+                  if name not in ('output', 'format', 'command')}
+        filenames = [request['video']]
+        for name in ('rois', 'labels'):
+            if isinstance(request.get(name), str):
+                filenames.append(request[name])
+        if request.get('rois') is None and request.get('labels') is None:
+            filenames.append(companion_name(request['video']) +
+                             '_ROIs.tsv')
+        fields['modified'] = [os.path.getmtime(name) if
+                              os.path.exists(name) else None
+                              for name in filenames]
+        fields['video'] = os.path.abspath(request['video'])
+        return json.dumps(fields, sort_keys=True, default=_to_json)
+
+    def status(self):
+        from memory import budget
+        # Not with the lock held; see `_cache`.
+        memory = budget.report()
+        with self._lock:
+            return dict(videos=self.videos.status(),
+                        jobs_running=self.jobs_running,
+                        jobs_done=self.jobs_done,
+                        cached_results=len(self._results),
+                        memory=memory)
+
+
+def _connect(address):
+    if address is None:
+        address = default_address()
+    tcp = _tcp_address(address)
+    if tcp is not None:
+        return socket.create_connection(tcp)
+    connection = socket.socket(socket.AF_UNIX)
+    connection.connect(address)
+    return connection
+
+
+def _request(message, address=None):
+    '''
+    Sends a request and iterates over the events of the response.
+    '''
+    with _connect(address) as connection:
+        connection.sendall(_encode(message))
+        with connection.makefile('rb') as stream:
+            for line in stream:
+                yield json.loads(line)
+
+
+def submit(video, rois=None, labels=None, method='mask', motion=False,
+           motion_binning=1, video_binning=1, start_time=None,
+           stop_time=None, output=None, table_fmt='long', progress=None,
+           address=None, **options):
+    '''
+    Measures a video in the daemon at `address` (by default, that of
+    `default_address`).
+
+    `video` is the name of the video file, which the daemon opens with
+    binning `video_binning` (see video.Video). The ROIs are read from
+    the `rois` file, or from the video's `_ROIs.tsv` file by default;
+    `rois` can also be a sequence of EllipseRoi. Alternatively
+    `labels` is the name of a label image. `method`, `motion` and
+    `motion_binning` are as in the command line of measure.py, and any
+    other `options` are passed on to `measure.measure`. The frames
+    measured can be given in seconds, as `start_time` and `stop_time`,
+    instead of the frame numbers `start` and `stop`.
+
+    File names are relative to the directory where the daemon runs, so
+    absolute names are safer.
+
+    If `output` is given, the daemon saves the data in that file (see
+    `measure.save_intensity`) and its name is returned. Otherwise the
+    data are returned as by `measure.measure`.
+
+    `progress` is as in `measure.measure`; if it returns True the job
+    is cancelled and None is returned. Raises RuntimeError if the job
+    fails.
+    '''
+    absolute = (lambda name: name if name is None else
+                os.path.abspath(name))
+    if rois is not None and not isinstance(rois, str):
+        rois = [(roi.name, roi.x_pos, roi.y_pos, roi.x_size, roi.y_size,
+                 roi.angle) for roi in rois]
+    elif rois is not None:
+        rois = absolute(rois)
+    message = dict(command='measure', video=absolute(video),
+                   video_binning=video_binning, rois=rois,
+                   labels=absolute(labels), method=method,
+                   motion=motion, motion_binning=motion_binning,
+                   start_time=start_time, stop_time=stop_time,
+                   output=absolute(output), format=table_fmt,
+                   options=options)
+    events = _request(message, address)
+    with contextlib.closing(events):
+        return _result(events, progress)
+
+
+def _result(events, progress):
+    '''
+    Returns the result of a measure request from its events; see
+    `submit`.
+    '''
+    for event in events:
+        if event['event'] == 'progress':
+            if progress is not None and progress(event['done'],
+                                                 event['total']):
+                # Closing the connection cancels the job.
+                return None
+        elif event['event'] == 'error':
+            raise RuntimeError(event['message'])
+        elif event['event'] == 'cancelled':
+            return None
+        elif event['event'] == 'done':
+            if 'output' in event:
+                return event['output']
+            import pandas as pd
+            data = event['data']
+            intensity = pd.DataFrame(data['data'], index=data['index'],
+                                     columns=data['columns'])
+            intensity.index.name = 'frame'
+            intensity.attrs.update(event['attrs'])
+            return intensity
+    raise RuntimeError("The daemon closed the connection")
+
+
+def status(address=None):
+    '''
+    Returns the status of the daemon: videos open, jobs and memory.
+    '''
+    for event in _request(dict(command='status'), address):
+        return event
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+            description='Measure videos on request from other programs')
+    parser.add_argument(
+            '--address', type=str, default=None,
+            help=('Unix socket, or HOST:PORT with a loopback HOST ' +
+                  '(e.g. localhost), to listen at (default: ' +
+                  default_address() + ')'))
+    parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Number of jobs run at the same time')
+    parser.add_argument(
+            '--status', action='store_true',
+            help='Show the status of the running daemon and exit')
+    args = parser.parse_args()
+
+    if args.status:
+        print(json.dumps(status(args.address), indent=2))
+    else:
+        try:
+            asyncio.run(Daemon(args.workers).serve(args.address))
+        except KeyboardInterrupt:
+            pass
+        except RuntimeError as error:
+            sys.exit(str(error))
@@ -0,0 +1,149 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Stand-in for a camera, to try measuring videos while they are recorded
+(see `measure.follow` and the Follow button of videoroi).
+
+Copies the frames of an existing video into a new file at a given
+frame rate, one frame at a time, as an acquisition program would:
+
+    python3 fake_acquisition.py cells.avi live.tif --fps 20
+
+while, e.g. in another terminal,
+
+    python3 measure.py live.tif cells_ROIs.tsv --follow 5
+
+The output can be a multi-frame TIFF (requires tifffile), a directory
+where frames are saved as one image each, or any video format that
+OpenCV can write (but see `video.VideoCv.refresh`).
+'''
+
+import argparse
+import os
+import time
+
+import cv2
+
+from video import Video
+
+
+class TiffWriter:
+    '''
+    Writes frames as the pages of a TIFF file, flushing each one to
+    disk so that it can be read straight away.
+    '''
+    def __init__(self, filename):
+        import tifffile
+        self._tif = tifffile.TiffWriter(filename)
+
+    def write(self, frame):
+        # Without metadata, readers take all pages as one series.
+        self._tif.write(frame, contiguous=False, metadata=None)
+        self._tif.filehandle.flush()
+
+    def close(self):
+        self._tif.close()
+
+
+class SequenceWriter:
+    '''
+    Writes frames as numbered images in a directory.
+    '''
+    def __init__(self, dirname, extension='.tif'):
+        os.makedirs(dirname, exist_ok=True)
+        self.dirname = dirname
+        self.extension = extension
+        self._frame_number = 0
+
+    def write(self, frame):
+        filename = os.path.join(self.dirname, 'frame_{:06d}{}'.format(
+            self._frame_number, self.extension))
+        cv2.imwrite(filename, frame)
+        self._frame_number += 1
+
+    def close(self):
+        pass
+
+
+class CvWriter:
+    '''
+    Writes frames with cv2.VideoWriter.
+    '''
+    def __init__(self, filename, fps, width, height, is_color,
+                 fourcc='FFV1'):
+        self._writer = cv2.VideoWriter(
+                filename, cv2.VideoWriter_fourcc(*fourcc), fps,
+                (width, height), is_color)
+
+    def write(self, frame):
+        self._writer.write(frame)
+
+    def close(self):
+        self._writer.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description=('Copy a video into a new file one frame at a ' +
+                         'time, as a camera would record it'))
+    parser.add_argument(
+            'source', type=str, help='Video to copy')
+    parser.add_argument(
+            'output', type=str,
+            help=('Output file (.tif or any video format) or, without ' +
+                  'extension, directory to save frames as images'))
+    parser.add_argument(
+            '--fps', type=float, default=None,
+            help='Frame rate (default: that of the source)')
+    parser.add_argument(
+            '--frames', type=int, default=None,
+            help='Number of frames to write (default: all)')
+    parser.add_argument(
+            '--fourcc', type=str, default='FFV1',
+            help='Codec for video formats')
+    args = parser.parse_args()
+
+    source = Video(args.source)
+    fps = args.fps if args.fps is not None else source.fps
+    extension = os.path.splitext(args.output)[-1].lower()
+    if extension in ('.tif', '.tiff'):
+        writer = TiffWriter(args.output)
+    elif extension == '':
+        writer = SequenceWriter(args.output)
+    else:
+        frame = source.read(0)
+        writer = CvWriter(args.output, fps, source.width, source.height,
+                          frame.ndim == 3, args.fourcc)
+
+    start = time.monotonic()
+    try:
+        for (frame_number, frame) in source.iter_frames(0, args.frames):
+            # Keep to the frame rate, whatever the time taken to read
+            # and write frames.
+            delay = start + frame_number / fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            writer.write(frame)
+            print('\rFrame {}'.format(frame_number), end='', flush=True)
+    except KeyboardInterrupt:
+        pass
+    print()
+    writer.close()
+    source.close()
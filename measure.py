@@ -0,0 +1,1338 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Measure the mean intensity of one or more ROIs in a video.
+
+This module does not depend on Qt or pyqtgraph, so it can be used from
+scripts and notebooks as well as from the graphical interface:
+
+    from video import Video
+    from measure import load_rois, measure
+
+    video = Video('cells.avi')
+    rois = load_rois('cells_ROIs.tsv')
+    intensity = measure(video, rois)
+'''
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import cv2
+
+from video import VideoBinned
+from baseline import DeltaF
+
+ROI_COLUMNS = ("name", "x_pos", "y_pos", "x_size", "y_size", "angle")
+# Distances (in pixels of the video file) from the edge of a ROI to the
+# inner and outer edges of its neuropil annulus; see Neuropil.
+NEUROPIL_RADII = (2, 15)
+# Names of the channels of colour frames, which can be measured
+# separately instead of converting frames to gray, by their initial
+# as in the `channel_order` of the video classes.
+CHANNELS = {'r': 'red', 'g': 'green', 'b': 'blue'}
+# Statistics of the pixels of each ROI that can be measured. The mean
+# is the intensity; 'saturated' is the number of pixels at the maximum
+# value of the video's bit depth and 'area' the number of pixels
+# measured (which is less than that of the ROI if part of it is outside
+# the frame).
+STATISTICS = ('mean', 'std', 'median', 'min', 'max', 'saturated', 'area')
+
+
+class EllipseRoi:
+    '''
+    An elliptical region of interest.
+
+    The geometry is that of pyqtgraph's EllipseROI, which is also the
+    one saved in the `_ROIs.tsv` files: `pos` is the origin of the ROI
+    (the top left corner of the ellipse's bounding box before it is
+    rotated), `size` is the width and height of the ellipse, and
+    `angle` is a rotation in degrees about `pos`.
+    '''
+    def __init__(self, name, pos, size, angle=0.0):
+        self.name = name
+        self.x_pos, self.y_pos = (float(value) for value in pos)
+        self.x_size, self.y_size = (float(value) for value in size)
+        self.angle = float(angle)
+
+    def __repr__(self):
+        fmt = '{}({!r}, pos=({:g}, {:g}), size=({:g}, {:g}), angle={:g})'
+        return fmt.format(self.__class__.__name__, self.name,
+                          self.x_pos, self.y_pos, self.x_size,
+                          self.y_size, self.angle)
+
+    def scaled(self, factor):
+        '''
+        Returns a copy of the ROI with position and size multiplied by
+        `factor`, e.g. 1/2 to use it on a video binned 2 x 2.
+        '''
+        return EllipseRoi(self.name,
+                          (self.x_pos * factor, self.y_pos * factor),
+                          (self.x_size * factor, self.y_size * factor),
+                          self.angle)
+
+    def contains(self, x, y):
+        '''
+        Returns a boolean array that is True where the points (x, y),
+        in image coordinates, fall inside the ellipse.
+        '''
+        theta = np.deg2rad(self.angle)
+        cos, sin = np.cos(theta), np.sin(theta)
+        dx = np.asarray(x) - self.x_pos
+        dy = np.asarray(y) - self.y_pos
+        # Rotate the points back into the ROI's own coordinate system,
+        # in which the ellipse is inscribed in (0, 0, x_size, y_size).
+        u = dx * cos + dy * sin
+        v = -dx * sin + dy * cos
+        a = self.x_size / 2
+        b = self.y_size / 2
+        if a == 0 or b == 0:
+            return np.zeros(np.broadcast(u, v).shape, dtype=bool)
+        return ((u - a) / a)**2 + ((v - b) / b)**2 <= 1
+
+    def bounding_box(self):
+        '''
+        Returns the bounding box of the (rotated) ellipse as a tuple
+        (x_min, y_min, x_max, y_max) in image coordinates.
+        '''
+        theta = np.deg2rad(self.angle)
+        cos, sin = np.cos(theta), np.sin(theta)
+        a = self.x_size / 2
+        b = self.y_size / 2
+        x_centre = self.x_pos + a * cos - b * sin
+        y_centre = self.y_pos + a * sin + b * cos
+        half_width = np.hypot(a * cos, b * sin)
+        half_height = np.hypot(a * sin, b * cos)
+        return (x_centre - half_width, y_centre - half_height,
+                x_centre + half_width, y_centre + half_height)
+
+    def mask(self, width, height):
+        '''
+        Returns a boolean array of shape (height, width) that is True
+        for the pixels of an image of that size that belong to the
+        ROI. A pixel belongs to the ROI if its centre is inside the
+        ellipse; pixels outside the image are ignored.
+        '''
+        mask = np.zeros((height, width), dtype=bool)
+        x_min, y_min, x_max, y_max = self.bounding_box()
+        x0 = int(np.clip(np.floor(x_min), 0, width))
+        y0 = int(np.clip(np.floor(y_min), 0, height))
+        x1 = int(np.clip(np.ceil(x_max), 0, width))
+        y1 = int(np.clip(np.ceil(y_max), 0, height))
+        x = np.arange(x0, x1) + 0.5
+        y = np.arange(y0, y1)[:, np.newaxis] + 0.5
+        mask[y0:y1, x0:x1] = self.contains(x, y)
+        return mask
+
+
+def _crop(frame, box, offset=(0, 0)):
+    '''
+    Returns the region `box` (x0, y0, x1, y1) of `frame`, moved by
+    `offset` (dx, dy) pixels. Parts of the region that fall outside the
+    frame are NaN.
+    '''
+    (x0, y0, x1, y1) = box
+    (dx, dy) = offset
+    (x0, y0, x1, y1) = (x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+    (height, width) = frame.shape[:2]
+    if x0 >= 0 and y0 >= 0 and x1 <= width and y1 <= height:
+        return frame[y0:y1, x0:x1]
+
+    # float32 rather than float64 because it can hold any 8 or 16-bit
+    # value and it can be converted to gray by OpenCV.
+    crop = np.full((y1 - y0, x1 - x0) + frame.shape[2:], np.nan,
+                   dtype=np.float32)
+    (fx0, fy0) = (max(x0, 0), max(y0, 0))
+    (fx1, fy1) = (min(x1, width), min(y1, height))
+    if fx0 < fx1 and fy0 < fy1:
+        crop[fy0 - y0:fy1 - y0, fx0 - x0:fx1 - x0] = frame[fy0:fy1,
+                                                          fx0:fx1]
+    return crop
+
+
+class MaskSet:
+    '''
+    A set of ROIs of any shape, each given by its bounding box (x0, y0,
+    x1, y1) in a frame of size `width` x `height` and by a boolean
+    mask of its pixels within that box. ROIs may overlap.
+
+    The union of all the bounding boxes is the region of the frame that
+    is needed to measure the ROIs, so each frame is cropped once to
+    that region and each ROI is then measured on a small sub-array of
+    it. Thus the cost of measuring a frame depends on the area covered
+    by the ROIs and not on the size of the frame.
+    '''
+    def __init__(self, names, boxes, masks, width, height):
+        self.names = list(names)
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("ROI names must be unique")
+        self.width = width
+        self.height = height
+        self.boxes = np.asarray(boxes, dtype=int).reshape(-1, 4)
+
+        # The crop is the union of all the bounding boxes.
+        if len(self.names) > 0:
+            self.crop = (self.boxes[:, 0].min(), self.boxes[:, 1].min(),
+                         self.boxes[:, 2].max(), self.boxes[:, 3].max())
+        else:
+            self.crop = (0, 0, 0, 0)
+
+        # For each ROI, the slices of its bounding box within the crop.
+        (crop_x0, crop_y0) = self.crop[:2]
+        self._slices = [(slice(y0 - crop_y0, y1 - crop_y0),
+                         slice(x0 - crop_x0, x1 - crop_x0))
+                        for (x0, y0, x1, y1) in self.boxes]
+        self._masks = list(masks)
+        self.area = np.array([mask.sum() for mask in self._masks])
+
+    def __len__(self):
+        return len(self.names)
+
+    def roi_masks(self):
+        '''
+        Iterates over the ROIs, yielding tuples (box, mask).
+        '''
+        return zip(self.boxes, self._masks)
+
+    def subset(self, indices):
+        '''
+        Returns a MaskSet with the ROIs at `indices` only.
+        '''
+        return MaskSet([self.names[index] for index in indices],
+                       self.boxes[indices],
+                       [self._masks[index] for index in indices],
+                       self.width, self.height)
+
+    def crop_frame(self, frame, offset=(0, 0)):
+        '''
+        Returns the region of `frame` that contains all the ROIs, with
+        the ROIs moved by `offset` (dx, dy) pixels.
+        '''
+        return _crop(frame, self.crop, offset)
+
+    def reduce(self, crop):
+        '''
+        Returns the mean intensity of each ROI in `crop`, a frame
+        already cropped with `crop_frame`. ROIs without any pixels
+        inside the frame are NaN.
+
+        If `crop` has several channels (3 dimensions) all of them are
+        measured at once and the result has one row per ROI and one
+        column per channel.
+        '''
+        values = np.full((len(self),) + crop.shape[2:], np.nan)
+        # Float crops may have pixels outside the frame (NaN).
+        has_nan = crop.dtype.kind == 'f'
+        for (roi_number, (slices, mask)) in enumerate(
+                zip(self._slices, self._masks)):
+            # One row per pixel (and one column per channel).
+            data = crop[slices][mask]
+            if has_nan:
+                missing = np.isnan(data)
+                if missing.ndim > 1:
+                    missing = missing.any(axis=1)
+                data = data[~missing]
+            if len(data) > 0:
+                values[roi_number] = data.mean(axis=0)
+        return values
+
+    def reduce_stats(self, crop, statistics, saturation=None):
+        '''
+        Returns a dictionary with the `statistics` (names from
+        STATISTICS) of each ROI in `crop`, as in `reduce`. `saturation`
+        is the value of saturated pixels.
+        '''
+        results = {name: np.full(len(self), np.nan) for name in statistics}
+        has_nan = crop.dtype.kind == 'f'
+        functions = dict(mean=np.mean, std=np.std, median=np.median,
+                         min=np.min, max=np.max)
+        for (roi_number, (slices, mask)) in enumerate(
+                zip(self._slices, self._masks)):
+            data = crop[slices][mask]
+            if has_nan:
+                data = data[~np.isnan(data)]
+            for name in statistics:
+                if name == 'area':
+                    value = data.size
+                elif name == 'saturated':
+                    value = np.count_nonzero(data >= saturation)
+                elif data.size > 0:
+                    value = functions[name](data)
+                else:
+                    continue
+                results[name][roi_number] = value
+        return results
+
+
+class RoiSet(MaskSet):
+    '''
+    A set of elliptical ROIs prepared for measuring frames of a given
+    size.
+
+    The geometry of all the ROIs is held in arrays (one element per
+    ROI) together with the bounding box of each ROI in pixels, clipped
+    to the frame, and the mask of the pixels whose centre is inside the
+    ellipse. See MaskSet.
+    '''
+    def __init__(self, rois, width, height):
+        self.x_pos = np.array([roi.x_pos for roi in rois], dtype=float)
+        self.y_pos = np.array([roi.y_pos for roi in rois], dtype=float)
+        self.x_size = np.array([roi.x_size for roi in rois], dtype=float)
+        self.y_size = np.array([roi.y_size for roi in rois], dtype=float)
+        self.angle = np.array([roi.angle for roi in rois], dtype=float)
+
+        # Bounding boxes, one row per ROI: (x0, y0, x1, y1) such that
+        # frame[y0:y1, x0:x1] holds all the ROI's pixels.
+        boxes = np.array([roi.bounding_box() for roi in rois],
+                         dtype=float).reshape(-1, 4)
+        boxes[:, :2] = np.floor(boxes[:, :2])
+        boxes[:, 2:] = np.ceil(boxes[:, 2:])
+        boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, width)
+        boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, height)
+        boxes = boxes.astype(int)
+
+        # The mask of each ROI's pixels within its bounding box.
+        masks = []
+        for (roi, (x0, y0, x1, y1)) in zip(rois, boxes):
+            x = np.arange(x0, x1) + 0.5
+            y = np.arange(y0, y1)[:, np.newaxis] + 0.5
+            masks.append(roi.contains(x, y))
+        super().__init__([roi.name for roi in rois], boxes, masks,
+                         width, height)
+
+    @property
+    def rois(self):
+        '''
+        The ROIs as a list of EllipseRoi.
+        '''
+        return [EllipseRoi(*args) for args in zip(
+            self.names, zip(self.x_pos, self.y_pos),
+            zip(self.x_size, self.y_size), self.angle)]
+
+    def binned(self, binning):
+        '''
+        Returns the RoiSet for frames binned `binning` x `binning`.
+        '''
+        return RoiSet([roi.scaled(1 / binning) for roi in self.rois],
+                      self.width // binning, self.height // binning)
+
+
+class LabelImage:
+    '''
+    A set of ROIs defined by an integer label image.
+
+    `labels` is an array the size of a frame in which pixels that
+    belong to no ROI are 0 and pixels that belong to ROI n are n, as
+    produced by most cell segmentation tools. The mean of every ROI in
+    a frame is then obtained in a single pass over the labelled
+    region with `np.bincount`, so the cost depends on the number of
+    pixels and not on the number of ROIs. This makes it suitable for
+    thousands of ROIs. Unlike a RoiSet, ROIs cannot overlap.
+
+    `names` are the names of the ROIs, in order of increasing label;
+    by default they are 'roi' followed by the label. `values` are the
+    labels of the ROIs, by default those in `labels`; a ROI whose label
+    is not in the image (e.g. a ROI outside the frame) has no pixels,
+    and is measured as NaN.
+    '''
+    def __init__(self, labels, names=None, values=None):
+        labels = np.asarray(labels)
+        if labels.ndim != 2 or labels.dtype.kind not in 'iu':
+            raise ValueError("labels must be a 2D array of integers")
+        self.height, self.width = labels.shape
+        self.label_image = labels
+
+        # Labels do not need to be consecutive; internally they are
+        # replaced by their rank so that bincount's output is compact.
+        present = np.unique(labels)
+        present = present[present != 0]
+        if values is None:
+            values = present
+        else:
+            values = np.unique(values)
+            if not np.isin(present, values).all():
+                raise ValueError("The label image has labels of no ROI")
+        if names is None:
+            names = ['roi{}'.format(value) for value in values]
+        if len(names) != len(values):
+            raise ValueError("There must be one name per label")
+        self.names = list(names)
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("ROI names must be unique")
+        self.labels = values
+
+        # Crop to the bounding box of all the labelled pixels.
+        (rows, cols) = np.nonzero(labels)
+        if len(rows) > 0:
+            self.crop = (cols.min(), rows.min(),
+                         cols.max() + 1, rows.max() + 1)
+        else:
+            self.crop = (0, 0, 0, 0)
+        (x0, y0, x1, y1) = self.crop
+        cropped = labels[y0:y1, x0:x1]
+        ranks = np.searchsorted(values, cropped)
+        ranks[cropped == 0] = -1
+        self._bins = (ranks + 1).ravel()
+        self.area = np.bincount(self._bins, minlength=len(self) + 1)[1:]
+
+    @classmethod
+    def from_rois(cls, rois, width, height):
+        '''
+        Creates a label image by rasterising a sequence of EllipseRoi
+        into an image of the given size. Where ROIs overlap, pixels
+        belong to the last of them; ROIs left without pixels (covered
+        by others, or outside the image) are kept, and measured as NaN.
+        '''
+        labels = np.zeros((height, width), dtype=np.int32)
+        for (roi_number, roi) in enumerate(rois):
+            labels[roi.mask(width, height)] = roi_number + 1
+        return cls(labels, names=[roi.name for roi in rois],
+                   values=np.arange(1, len(rois) + 1))
+
+    def binned(self, binning):
+        '''
+        Returns the LabelImage for frames binned `binning` x `binning`.
+        Each binned pixel takes the label of the pixel at the centre of
+        its block. ROIs too small to keep any pixel are kept, and
+        measured as NaN.
+        '''
+        offset = binning // 2
+        labels = self.label_image[offset::binning, offset::binning]
+        labels = labels[:self.height // binning, :self.width // binning]
+        return LabelImage(labels, self.names, self.labels)
+
+    def __len__(self):
+        return len(self.names)
+
+    def subset(self, indices):
+        '''
+        Returns a LabelImage with the ROIs at `indices` only. ROIs keep
+        their order, that of their labels, whatever that of `indices`.
+        '''
+        indices = np.sort(indices)
+        label_image = np.where(
+                np.isin(self.label_image, self.labels[indices]),
+                self.label_image, 0)
+        return LabelImage(label_image,
+                          [self.names[index] for index in indices],
+                          self.labels[indices])
+
+    def roi_masks(self):
+        '''
+        Iterates over the ROIs, yielding tuples (box, mask) as
+        MaskSet.roi_masks. ROIs without pixels have an empty box and
+        mask.
+        '''
+        (crop_x0, crop_y0) = self.crop[:2]
+        ranks = self._bins - 1
+        (rows, cols) = np.divmod(np.nonzero(ranks >= 0)[0],
+                                 self.crop[2] - crop_x0)
+        # Pixels grouped by ROI.
+        order = np.argsort(ranks[ranks >= 0], kind='stable')
+        ends = np.cumsum(self.area)
+        for (start, end) in zip(ends - self.area, ends):
+            if start == end:
+                yield ((0, 0, 0, 0), np.zeros((0, 0), dtype=bool))
+                continue
+            (roi_rows, roi_cols) = (rows[order[start:end]],
+                                    cols[order[start:end]])
+            (x0, y0) = (roi_cols.min(), roi_rows.min())
+            (x1, y1) = (roi_cols.max() + 1, roi_rows.max() + 1)
+            mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+            mask[roi_rows - y0, roi_cols - x0] = True
+            yield ((x0 + crop_x0, y0 + crop_y0, x1 + crop_x0,
+                    y1 + crop_y0), mask)
+
+    def crop_frame(self, frame, offset=(0, 0)):
+        '''
+        Returns the region of `frame` that contains all the ROIs, with
+        the ROIs moved by `offset` (dx, dy) pixels.
+        '''
+        return _crop(frame, self.crop, offset)
+
+    def reduce(self, crop):
+        '''
+        Returns the mean intensity of each ROI in `crop`, a frame
+        already cropped with `crop_frame`. ROIs without any pixels
+        are NaN.
+
+        If `crop` has several channels (3 dimensions) the result has
+        one row per ROI and one column per channel.
+        '''
+        # One row per pixel and one column per channel.
+        channel_count = crop.shape[2] if crop.ndim == 3 else 1
+        data = crop.reshape(len(self._bins), channel_count)
+        bins = self._bins
+        area = self.area
+        if crop.dtype.kind == 'f':
+            # Float crops may have pixels outside the frame (NaN).
+            valid = ~np.isnan(data).any(axis=1)
+            if not valid.all():
+                data = data[valid]
+                bins = bins[valid]
+                area = np.bincount(bins, minlength=len(self) + 1)[1:]
+        sums = np.column_stack([
+            np.bincount(bins, weights=channel,
+                        minlength=len(self) + 1)[1:]
+            for channel in data.T])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = sums / area[:, np.newaxis]
+        if crop.ndim == 2:
+            return values[:, 0]
+        return values
+
+    def reduce_stats(self, crop, statistics, saturation=None):
+        '''
+        Returns a dictionary with the `statistics` (names from
+        STATISTICS) of each ROI in `crop`, as in `reduce`. `saturation`
+        is the value of saturated pixels.
+
+        As for the mean, every statistic is computed for all the ROIs
+        at once: sums with `np.bincount`, and the median, minimum and
+        maximum from the pixels sorted by ROI and by value.
+        '''
+        data = crop.ravel()
+        bins = self._bins
+        if crop.dtype.kind == 'f':
+            valid = ~np.isnan(data)
+            if not valid.all():
+                data = data[valid]
+                bins = bins[valid]
+        length = len(self) + 1
+        counts = np.bincount(bins, minlength=length)
+        area = counts[1:]
+        empty = area == 0
+        results = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if 'mean' in statistics or 'std' in statistics:
+                mean = np.bincount(bins, weights=data,
+                                   minlength=length)[1:] / area
+                results['mean'] = mean
+            if 'std' in statistics:
+                squares = np.bincount(
+                        bins, weights=np.square(data, dtype=float),
+                        minlength=length)[1:] / area
+                results['std'] = np.sqrt(np.maximum(squares - mean**2, 0))
+        if 'saturated' in statistics:
+            results['saturated'] = np.bincount(
+                    bins, weights=data >= saturation,
+                    minlength=length)[1:]
+        if 'area' in statistics:
+            results['area'] = area.astype(float)
+
+        if {'median', 'min', 'max'} & set(statistics):
+            # With the pixels sorted by ROI and by value, each ROI is a
+            # run of pixels that starts with its minimum and ends with
+            # its maximum.
+            ordered = data[np.lexsort((data, bins))].astype(float)
+            first = (np.cumsum(counts) - counts)[1:]
+            last = np.maximum(first + area - 1, 0)
+            first = np.minimum(first, len(ordered) - 1)
+            if len(ordered) == 0:
+                ordered = np.full(1, np.nan)
+                first[:] = last[:] = 0
+            values = dict(min=ordered[first], max=ordered[last],
+                          median=(ordered[first + (area - 1) // 2] +
+                                  ordered[first + area // 2]) / 2)
+            for name in ('median', 'min', 'max'):
+                if name in statistics:
+                    results[name] = np.where(empty, np.nan, values[name])
+        return {name: results[name] for name in statistics}
+
+
+def _grow(mask, pixels):
+    '''
+    Returns `mask` (uint8) grown by `pixels` pixels in all directions.
+    '''
+    if pixels < 1:
+        return mask
+    kernel = cv2.getStructuringElement(
+            cv2.MORPH_ELLIPSE, (2 * pixels + 1, 2 * pixels + 1))
+    return cv2.dilate(mask, kernel)
+
+
+class Neuropil(MaskSet):
+    '''
+    Annuli around a set of ROIs, to measure the neuropil: the
+    fluorescence of the tissue around each cell, which contaminates
+    that of the cell.
+
+    `rois` is a RoiSet or a LabelImage. The annulus of each ROI covers
+    the pixels between `inner` and `outer` pixels away from the ROI,
+    except those of any ROI or less than `inner` pixels away from one.
+    Annuli are named after their ROIs and are measured as a MaskSet.
+    '''
+    def __init__(self, rois, inner=2, outer=15):
+        (width, height) = (rois.width, rois.height)
+        roi_masks = list(rois.roi_masks())
+        excluded = np.zeros((height, width), dtype=np.uint8)
+        for ((x0, y0, x1, y1), mask) in roi_masks:
+            excluded[y0:y1, x0:x1] |= mask
+        excluded = _grow(excluded, inner).astype(bool)
+
+        boxes = []
+        masks = []
+        for ((x0, y0, x1, y1), mask) in roi_masks:
+            (bx0, by0) = (max(x0 - outer, 0), max(y0 - outer, 0))
+            (bx1, by1) = (min(x1 + outer, width), min(y1 + outer, height))
+            grown = np.zeros((by1 - by0, bx1 - bx0), dtype=np.uint8)
+            grown[y0 - by0:y1 - by0, x0 - bx0:x1 - bx0] = mask
+            annulus = (_grow(grown, outer).astype(bool) &
+                       ~excluded[by0:by1, bx0:bx1])
+            boxes.append((bx0, by0, bx1, by1))
+            masks.append(annulus)
+        super().__init__(rois.names, boxes, masks, width, height)
+
+
+def load_rois(filename):
+    '''
+    Loads ROIs from a tab separated file. This file should consist of
+    a header, one line per ROI, and 6 columns:
+        roi_name, x_pos, y_pos, x_size, y_size, angle
+
+    Returns a list of EllipseRoi.
+    '''
+    table = pd.read_csv(filename, sep='\t')
+    return [EllipseRoi(roi['name'], (roi.x_pos, roi.y_pos),
+                       (roi.x_size, roi.y_size), roi.angle)
+            for (index, roi) in table.iterrows()]
+
+
+def save_rois(filename, rois):
+    '''
+    Saves ROIs as a tsv list. This is a file with a header, one line
+    per ROI and 6 columns:
+        roi_name, x_pos, y_pos, x_size, y_size, angle
+
+    This file can be loaded later with `load_rois`.
+    '''
+    headerfmt = '{}\t{}\t{}\t{}\t{}\t{}\n'
+    datafmt = '{}\t{:.6f}\t{:.6f}\t{:.6f}\t{:.6f}\t{:.6f}\n'
+
+    with open(filename, 'w') as f:
+        f.write(headerfmt.format(*ROI_COLUMNS))
+        for roi in rois:
+            f.write(datafmt.format(roi.name, roi.x_pos, roi.y_pos,
+                                   roi.x_size, roi.y_size, roi.angle))
+
+
+def load_labels(filename, names=None):
+    '''
+    Loads a label image (e.g. a 16-bit png or tiff file) as a
+    LabelImage. See LabelImage for the meaning of `names`.
+    '''
+    labels = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    if labels is None:
+        raise FileNotFoundError("Unable to read labels from " + filename)
+    if labels.ndim == 3:
+        raise ValueError("A label image must have a single channel")
+    return LabelImage(labels, names)
+
+
+def gray(frame):
+    '''
+    Returns a single channel version of `frame`. Frames with 3
+    dimensions are assumed to be BGR, as returned by OpenCV.
+    '''
+    if frame.ndim == 3 and frame.size > 0:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame
+
+
+class FrameReducer:
+    '''
+    Reduces frames to the measures of a set of ROIs.
+
+    `rois` is a RoiSet, a LabelImage or any MaskSet. The mean intensity
+    of each ROI is measured together with its `statistics` (names from
+    STATISTICS other than the mean; `saturation` is the value of
+    saturated pixels) and, if `neuropil` (a Neuropil for the same ROIs)
+    is given, the mean of its annulus. Colour frames are converted to
+    gray, unless `channel_indices` are given: then the channels at
+    those positions of the last axis are measured separately.
+
+    A reducer does not depend on the video, so it can be sent to
+    another process (see the parallel module).
+    '''
+    def __init__(self, rois, statistics=(), saturation=None,
+                 neuropil=None, channel_indices=None):
+        self.rois = rois
+        self.statistics = list(statistics)
+        self.saturation = saturation
+        self.neuropil = neuropil
+        self.channel_indices = channel_indices
+
+    def __len__(self):
+        return len(self.rois)
+
+    def subset(self, indices):
+        '''
+        Returns a FrameReducer for the ROIs at `indices` only, which
+        must be in increasing order.
+        '''
+        neuropil = None
+        if self.neuropil is not None:
+            neuropil = self.neuropil.subset(indices)
+        return FrameReducer(self.rois.subset(indices), self.statistics,
+                            self.saturation, neuropil,
+                            self.channel_indices)
+
+    def reduce(self, frame, offset=(0, 0)):
+        '''
+        Returns a dictionary with the measures of each ROI in `frame`,
+        with the ROIs moved by `offset` (dx, dy) pixels: 'intensity',
+        any statistics and, if measured, 'neuropil'.
+        '''
+        # Only the region that contains the ROIs is converted to gray
+        # and measured.
+        crop = self._prepare(self.rois.crop_frame(frame, offset))
+        if self.statistics:
+            results = self._reduce_stats(crop,
+                                         ['mean'] + self.statistics)
+            results['intensity'] = results.pop('mean')
+        else:
+            results = {'intensity': self.rois.reduce(crop)}
+        if self.neuropil is not None:
+            results['neuropil'] = self.neuropil.reduce(self._prepare(
+                    self.neuropil.crop_frame(frame, offset)))
+        return results
+
+    def _prepare(self, crop):
+        '''
+        Returns `crop` converted to gray, or with the channels measured
+        only.
+        '''
+        if self.channel_indices is None:
+            return gray(crop)
+        if crop.ndim != 3:
+            raise ValueError("Channels can only be measured in colour "
+                             "videos")
+        return crop[..., self.channel_indices]
+
+    def _reduce_stats(self, crop, statistics):
+        if crop.ndim == 2:
+            return self.rois.reduce_stats(crop, statistics,
+                                          self.saturation)
+        # One channel at a time.
+        results = [self.rois.reduce_stats(crop[..., channel], statistics,
+                                          self.saturation)
+                   for channel in range(crop.shape[2])]
+        return {name: np.column_stack([result[name] for result in results])
+                for name in statistics}
+
+
+def measure(video, rois, start=0, stop=None, step=1, bin_size=1,
+            binning=1, dff_window=None, dff_percentile=8, shifts=None,
+            statistics=(), neuropil_factor=None, channels=None,
+            workers=1, progress=None):
+    '''
+    Calculates the mean intensity of each ROI in the frames of
+    `video`.
+
+    `video` is any of the classes in the `video` module and `rois`
+    either a sequence of EllipseRoi, a RoiSet or a LabelImage. Each
+    frame is read once and all the ROIs are measured on it.
+
+    Frames `start` to `stop` (excluded; by default the end of the
+    video) are measured, taking one every `step` frames. If `bin_size`
+    is greater than 1, consecutive measurements are averaged in bins
+    of that size; each bin is labelled with its first frame and with
+    the mean time of its frames.
+
+    If `binning` is greater than 1 the frames are binned `binning` x
+    `binning` pixels before they are measured (see video.VideoBinned),
+    and the ROIs, given for the full size video, are scaled to match.
+    This is much faster but less precise; the binning used is stored
+    in the `binning` entry of the DataFrame's `attrs`.
+
+    If `dff_window` (in seconds) is given, ΔF/F is calculated as well,
+    as the frames are measured, using as baseline the `dff_percentile`
+    of the intensity over a trailing window of that length (see
+    baseline.DeltaF).
+
+    `shifts`, if given, is an array with the displacement (x, y) in
+    pixels of the video file of each frame, as returned by
+    `motion.get_shifts`. The ROIs are moved by the displacement of
+    each frame, rounded to whole pixels, before they are measured.
+
+    `statistics` are the names of other statistics of the pixels of
+    each ROI to measure besides the mean (see STATISTICS), e.g.
+    ('std', 'max', 'saturated'). They are calculated from the same
+    crop of each frame as the mean.
+
+    If `neuropil_factor` is given, the mean intensity of an annulus
+    around each ROI (see Neuropil and NEUROPIL_RADII) is measured too,
+    from the same frames, and the intensity corrected for it as
+    `intensity - neuropil_factor * neuropil` (0.7 is a common value).
+    ΔF/F is calculated from the intensity without correction.
+
+    Colour frames are converted to gray unless `channels` are given,
+    e.g. ('red', 'green') (see CHANNELS). Then each of those channels
+    is measured separately, from the same frames, and every measure is
+    split by channel: the intensity is in columns named after the ROI
+    and the channel (e.g. 'roi0_red') and any other measure in columns
+    named after the ROI, the measure and the channel (e.g.
+    'roi0_dff_red').
+
+    If `workers` is greater than 1, or None for one per core, frames
+    are still read here but measured in that many processes, each of
+    them measuring part of the ROIs (see parallel.ParallelMeasurement).
+    This is faster when measuring takes longer than reading frames,
+    e.g. with many ROIs.
+
+    `progress`, if given, is a function that is called after each
+    frame as `progress(frames_done, frame_count)`. If it returns True
+    the measurement is cancelled and None is returned.
+
+    Returns a pandas DataFrame with one row per frame (the index) and
+    one column per ROI, plus a 'time' column with the time of each
+    frame in seconds. Measures other than the mean intensity, such as
+    ΔF/F, are added as further columns named after the ROI and the
+    measure (e.g. 'roi0_dff'); use `select_measure` to get them with
+    the same layout as the intensity.
+    '''
+    options = dict(start=start, step=step, binning=binning,
+                   dff_window=dff_window, dff_percentile=dff_percentile,
+                   shifts=shifts, statistics=statistics,
+                   neuropil_factor=neuropil_factor, channels=channels)
+    if workers == 1:
+        measurement = Measurement(video, rois, **options)
+    else:
+        from parallel import ParallelMeasurement
+        measurement = ParallelMeasurement(video, rois, workers=workers,
+                                          **options)
+    if measurement.update(stop, progress) is None:
+        return None
+    return measurement.result(bin_size)
+
+
+class Measurement:
+    '''
+    Measurement of ROIs in the frames of a video that can be continued
+    as more frames become available, e.g. while the video is being
+    recorded (see the `refresh` method of the video classes).
+
+    Arguments are as in `measure`. `update` measures the frames
+    available and `result` returns the data measured so far.
+    '''
+    def __init__(self, video, rois, start=0, step=1, binning=1,
+                 dff_window=None, dff_percentile=8, shifts=None,
+                 statistics=(), neuropil_factor=None, channels=None):
+        if not isinstance(rois, (RoiSet, LabelImage)):
+            rois = RoiSet(rois, video.width, video.height)
+        if binning > 1:
+            video = VideoBinned(video, binning)
+            rois = rois.binned(binning)
+        self.video = video
+        self.rois = rois
+        self.step = step
+        self.shifts = shifts
+        # The next frame to measure.
+        self.next_frame = start
+
+        self.measures = ['intensity']
+        # The mean is the intensity.
+        self.statistics = [name for name in statistics if name != 'mean']
+        for name in self.statistics:
+            if name not in STATISTICS:
+                raise ValueError("Unknown statistic: " + name)
+            self.measures.append(name)
+
+        # Channels measured, if not gray, and their position in the
+        # frames.
+        self.channels = None
+        channel_indices = None
+        if channels is not None:
+            self.channels = list(channels)
+            order = [CHANNELS[initial] for initial in video.channel_order]
+            for channel in self.channels:
+                if channel not in order:
+                    raise ValueError("Unknown channel: " + channel)
+            channel_indices = [order.index(channel)
+                               for channel in self.channels]
+        channel_count = 1 if channels is None else len(self.channels)
+        # The annuli are made once, for the frames as measured (i.e.
+        # binned if that is the case).
+        neuropil = None
+        self.neuropil_factor = neuropil_factor
+        if neuropil_factor is not None:
+            (inner, outer) = NEUROPIL_RADII
+            neuropil = Neuropil(rois, max(1, round(inner / video.binning)),
+                                max(1, round(outer / video.binning)))
+            self.measures += ['neuropil', 'corrected']
+        self.reducer = FrameReducer(
+                rois, self.statistics, 2**video.bits_per_sample - 1,
+                neuropil, channel_indices)
+        self.delta_f = None
+        if dff_window is not None:
+            window = max(1, round(dff_window * video.fps / step))
+            self.delta_f = DeltaF(len(rois) * channel_count, window,
+                                  dff_percentile)
+            self.measures.append('dff')
+
+        if shifts is not None:
+            self.offsets = np.rint(np.asarray(shifts) /
+                                   video.binning).astype(int)
+
+        # The data are kept as they are returned by `result`, one row
+        # per frame with the time and then each measure, channel and
+        # ROI in turn, so that each update only adds rows. Rows are
+        # allocated in blocks, doubling in size.
+        self._channel_count = channel_count
+        self._columns = {}
+        self._column_names = ['time']
+        self._measure_names = []
+        for name in self.measures:
+            start = len(self._column_names)
+            self._columns[name] = slice(
+                    start, start + len(rois) * channel_count)
+            for channel in (self.channels or [None]):
+                measure = name
+                if channel is not None:
+                    # Each channel is a measure of its own.
+                    measure = channel if name == 'intensity' else \
+                        '{}_{}'.format(name, channel)
+                self._measure_names.append(measure)
+                for roi_name in rois.names:
+                    if measure != 'intensity':
+                        roi_name = '{}_{}'.format(roi_name, measure)
+                    self._column_names.append(roi_name)
+        self._table = np.empty((0, len(self._column_names)))
+        self._frames = np.empty(0, dtype=int)
+        self._rows = 0
+        # Rows whose ΔF/F has been calculated.
+        self._dff_rows = 0
+        # Complete time bins calculated so far, by bin size, as the
+        # number of rows binned and their means.
+        self._bins = {}
+
+    def update(self, stop=None, progress=None):
+        '''
+        Measures frames from where the last update stopped up to
+        `stop` (excluded; by default the end of the video).
+
+        `progress` is as in `measure`. Returns the number of frames
+        measured, or None if cancelled.
+        '''
+        if stop is None or stop > self.video.frame_count:
+            stop = self.video.frame_count
+        frame_count = len(range(self.next_frame, stop, self.step))
+
+        frames_done = 0
+        reduced = self.reduce_frames(self.next_frame, stop)
+        try:
+            for (frame_number, results) in reduced:
+                self._add(frame_number, results)
+                frames_done += 1
+                if progress is not None:
+                    if progress(frames_done, frame_count):
+                        return None
+        finally:
+            reduced.close()
+            if self.delta_f is not None:
+                self._update_delta_f()
+        # Frames that could not be read are left for the next update.
+        return frames_done
+
+    def offset(self, frame_number):
+        '''
+        Returns the displacement (dx, dy) of the ROIs in a frame.
+        '''
+        if self.shifts is None:
+            return (0, 0)
+        return tuple(int(value) for value in self.offsets[frame_number])
+
+    def reduce_frames(self, start, stop):
+        '''
+        Reads frames `start` to `stop` (excluded), one every `step`,
+        and reduces them. Yields tuples (frame_number, results) in
+        order of frame, with `results` as returned by
+        FrameReducer.reduce.
+        '''
+        for (frame_number, frame) in self.video.iter_frames(
+                start, stop, self.step):
+            yield (frame_number,
+                   self.reducer.reduce(frame, self.offset(frame_number)))
+
+    @property
+    def frames(self):
+        '''
+        The numbers of the frames measured so far.
+        '''
+        return self._frames[:self._rows]
+
+    def _add(self, frame_number, results):
+        '''
+        Adds the results of a frame to the data.
+        '''
+        row = self._rows
+        if row == len(self._table):
+            capacity = max(1024, 2 * len(self._table))
+            table = np.empty((capacity, self._table.shape[1]))
+            table[:row] = self._table[:row]
+            frames = np.empty(capacity, dtype=int)
+            frames[:row] = self._frames[:row]
+            (self._table, self._frames) = (table, frames)
+        self._frames[row] = frame_number
+        self._table[row, 0] = frame_number / self.video.fps
+        for (name, values) in results.items():
+            self._set(row, name, values)
+        if self.neuropil_factor is not None:
+            self._set(row, 'corrected', results['intensity'] -
+                      self.neuropil_factor * results['neuropil'])
+        self._rows += 1
+        self.next_frame = frame_number + self.step
+
+    def _set(self, rows, name, values):
+        '''
+        Stores the `values` of a measure, one per ROI and channel, in
+        `rows` of the data.
+        '''
+        values = np.reshape(values, (-1, len(self.rois),
+                                     self._channel_count))
+        self._table[rows, self._columns[name]] = \
+            values.transpose(0, 2, 1).reshape(len(values), -1)
+
+    def _update_delta_f(self):
+        '''
+        Calculates the ΔF/F of the frames added since the last update,
+        all at once, which is much faster than one frame at a time (see
+        baseline.RollingPercentile).
+        '''
+        rows = slice(self._dff_rows, self._rows)
+        values = self._table[rows, self._columns['intensity']]
+        if len(values) == 0:
+            return
+        self._table[rows, self._columns['dff']] = \
+            self.delta_f.update(values)
+        self._dff_rows = self._rows
+
+    def _binned(self, bin_size):
+        '''
+        Returns the rows of the data averaged in bins of `bin_size`.
+        Complete bins are kept, so that only the rows added since the
+        last call are averaged.
+        '''
+        (done, binned) = self._bins.get(
+                bin_size, (0, self._table[:0].copy()))
+        bins = np.arange(done, self._rows, bin_size)
+        counts = np.diff(np.append(bins, self._rows))
+        means = (np.add.reduceat(self._table[done:self._rows],
+                                 bins - done) / counts[:, np.newaxis])
+        complete = np.count_nonzero(counts == bin_size)
+        binned = np.concatenate([binned, means[:complete]])
+        self._bins[bin_size] = (done + complete * bin_size, binned)
+        return np.concatenate([binned, means[complete:]])
+
+    def result(self, bin_size=1):
+        '''
+        Returns the data measured so far as a DataFrame, as described
+        in `measure`.
+        '''
+        table = self._table[:self._rows]
+        frames = self.frames
+        if bin_size > 1 and self._rows > 0:
+            table = self._binned(bin_size)
+            frames = frames[::bin_size]
+        intensity = pd.DataFrame(table, index=frames,
+                                 columns=self._column_names, copy=True)
+        intensity.index.name = 'frame'
+        intensity.attrs['binning'] = self.video.binning
+        intensity.attrs['rois'] = list(self.rois.names)
+        intensity.attrs['measures'] = list(self._measure_names)
+        intensity.attrs['motion_corrected'] = self.shifts is not None
+        intensity.attrs['channels'] = self.channels
+        return intensity
+
+
+def follow(video, rois, interval=0.2, timeout=10, bin_size=1,
+           **options):
+    '''
+    Measures `video` while it is being recorded.
+
+    Every `interval` seconds the video is checked for new frames (see
+    the `refresh` method of the video classes), and if there are any
+    they are measured and the data measured so far, as returned by
+    `measure`, is yielded. Stops when no frames have been added, nor
+    has the file grown (frames may take a while to be complete), for
+    `timeout` seconds.
+
+    Other arguments are as in `measure`, except for `stop` and
+    `shifts`: the motion of frames not yet recorded is not known.
+    '''
+    measurement = Measurement(video, rois, **options)
+    last_update = time.monotonic()
+    size = _file_size(video.filename)
+    while True:
+        measurement.video.refresh()
+        last_size = size
+        size = _file_size(video.filename)
+        if measurement.update():
+            last_update = time.monotonic()
+            yield measurement.result(bin_size)
+        elif size != last_size:
+            last_update = time.monotonic()
+            time.sleep(interval)
+        elif time.monotonic() - last_update > timeout:
+            return
+        else:
+            time.sleep(interval)
+
+
+def _file_size(filename):
+    # Size of a video file; None for directories (image sequences and
+    # frame stores), where each frame is a new file.
+    return os.path.getsize(filename) if os.path.isfile(filename) else None
+
+
+def select_measure(intensity, measure='intensity'):
+    '''
+    Returns one of the measures in a DataFrame returned by `measure`
+    (e.g. 'intensity' or 'dff') as a DataFrame with a 'time' column
+    and one column per ROI.
+    '''
+    rois = intensity.attrs.get('rois', list(intensity.columns[1:]))
+    if measure == 'intensity':
+        columns = rois
+    else:
+        columns = ['{}_{}'.format(roi, measure) for roi in rois]
+    selection = intensity[['time'] + columns]
+    selection.columns = ['time'] + rois
+    return selection
+
+
+def save_intensity(filename, intensity, table_fmt='long'):
+    '''
+    Saves intensity data, as returned by `measure`, in a tab-separated
+    file. In 'wide' format there is one row per frame and one column
+    per ROI and measure; in 'long' format there is one row per frame
+    and ROI, and one column per measure.
+    '''
+    if table_fmt == 'long':
+        # Convert table from wide to long format, one measure at a
+        # time. All of them have the same frames and ROIs in the same
+        # order.
+        measures = intensity.attrs.get('measures', ['intensity'])
+        table = None
+        for measure in measures:
+            values = select_measure(intensity, measure).reset_index()
+            values = values.melt(
+                    id_vars = ['frame', 'time'],
+                    var_name = 'roi',
+                    value_name = measure)
+            if table is None:
+                table = values
+            else:
+                table[measure] = values[measure].values
+        table.to_csv(filename, sep='\t', index = False)
+
+    elif table_fmt == 'wide':
+        intensity.to_csv(filename, sep='\t', index = True)
+
+    else:
+        raise ValueError("table_fmt must be 'wide' or 'long'")
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from video import Video, companion_name
+
+    parser = argparse.ArgumentParser(
+            description='Obtain intensity of ROIs in a video')
+    parser.add_argument(
+            'filename', type=str, help='Video file')
+    parser.add_argument(
+            'rois', nargs='?', type=str, default=None,
+            help='ROIs file (default: [filename]_ROIs.tsv)')
+    parser.add_argument(
+            '--labels', type=str, default=None,
+            help='Measure the ROIs in a label image instead')
+    parser.add_argument(
+            '--method', choices=('mask', 'labels'), default='mask',
+            help=('Measure each ROI with its own mask or rasterise ' +
+                  'the ROIs into a label image (faster for many ROIs)'))
+    parser.add_argument(
+            '--start', type=float, default=0,
+            help='Start measuring at this time (s)')
+    parser.add_argument(
+            '--stop', type=float, default=None,
+            help='Stop measuring at this time (s)')
+    parser.add_argument(
+            '--step', type=int, default=1,
+            help='Measure one every STEP frames')
+    parser.add_argument(
+            '--bin', type=int, default=1,
+            help='Average measurements in bins of BIN frames')
+    parser.add_argument(
+            '--binning', type=int, default=1,
+            help=('Bin frames BINNING x BINNING pixels before ' +
+                  'measuring them (faster but less precise)'))
+    parser.add_argument(
+            '--dff', type=float, default=None, metavar='WINDOW',
+            help=('Calculate also ΔF/F with a baseline over a ' +
+                  'window of WINDOW seconds'))
+    parser.add_argument(
+            '--dff-percentile', type=float, default=8,
+            help='Percentile of the intensity used as baseline')
+    parser.add_argument(
+            '--statistics', nargs='+', choices=STATISTICS[1:],
+            default=(), metavar='STATISTIC',
+            help=('Measure also these statistics of the pixels of ' +
+                  'each ROI: ' + ', '.join(STATISTICS[1:])))
+    parser.add_argument(
+            '--neuropil', type=float, nargs='?', const=0.7,
+            default=None, metavar='FACTOR',
+            help=('Measure also the neuropil around each ROI and ' +
+                  'subtract FACTOR (default 0.7) times it from the ' +
+                  'intensity'))
+    parser.add_argument(
+            '--channels', nargs='+', choices=tuple(CHANNELS.values()),
+            default=None, metavar='CHANNEL',
+            help=('Measure these channels of colour videos ' +
+                  'separately instead of converting frames to gray'))
+    parser.add_argument(
+            '--workers', type=int, default=1,
+            help=('Measure frames in WORKERS processes (0: one per ' +
+                  'core), which is faster for many ROIs'))
+    parser.add_argument(
+            '--motion', action='store_true',
+            help=('Correct for motion (shifts are saved in ' +
+                  '[filename]_shifts.tsv and reused)'))
+    parser.add_argument(
+            '--motion-binning', type=int, default=1,
+            help=('Bin frames to estimate motion (faster but less ' +
+                  'precise)'))
+    parser.add_argument(
+            '--follow', type=float, default=None, metavar='TIMEOUT',
+            help=('Keep measuring frames as they are added to the ' +
+                  'video (e.g. while it is recorded) until none are ' +
+                  'added, nor does the file grow, for TIMEOUT ' +
+                  'seconds'))
+    parser.add_argument(
+            '--daemon', type=str, nargs='?', const='', default=None,
+            metavar='ADDRESS',
+            help=('Measure in a running daemon (see daemon.py), at ' +
+                  'ADDRESS if given, instead of in this process'))
+    parser.add_argument(
+            '--memory', type=float, default=None, metavar='MB',
+            help=('Memory budget for frames held in memory, e.g. ' +
+                  'TIFF videos (default: 2048 or $VIDEOROI_MEMORY)'))
+    parser.add_argument(
+            '--format', choices=('long', 'wide'), default='long',
+            help='Output table format')
+    args = parser.parse_args()
+    if args.follow is not None and args.motion:
+        # The motion of frames not yet recorded is not known.
+        parser.error("--motion cannot be used with --follow")
+    if args.follow is not None and args.workers != 1:
+        # Only a few frames are measured at a time.
+        parser.error("--workers cannot be used with --follow")
+    if args.follow is not None and args.daemon is not None:
+        parser.error("--daemon cannot be used with --follow")
+
+    if args.memory is not None:
+        import memory
+        memory.budget.limit = int(args.memory * 2**20)
+
+    basename = companion_name(args.filename)
+    if args.daemon is not None:
+        # The daemon opens the video and saves the data.
+        from daemon import submit
+        if args.binning > 1:
+            basename += '_bin{}'.format(args.binning)
+
+        def print_progress(frames_done, frame_count):
+            print('\rFrame {}/{}'.format(frames_done, frame_count),
+                  end='', flush=True)
+
+        try:
+            output = submit(
+                    args.filename, rois=args.rois, labels=args.labels,
+                    method=args.method, motion=args.motion,
+                    motion_binning=args.motion_binning,
+                    start_time=args.start, stop_time=args.stop,
+                    output=basename + '.tsv', table_fmt=args.format,
+                    progress=print_progress, address=args.daemon or None,
+                    step=args.step, bin_size=args.bin,
+                    binning=args.binning, dff_window=args.dff,
+                    dff_percentile=args.dff_percentile,
+                    statistics=args.statistics,
+                    neuropil_factor=args.neuropil,
+                    channels=args.channels, workers=args.workers or None)
+        except (OSError, RuntimeError) as error:
+            sys.exit("Measuring in the daemon failed: {}".format(error))
+        print()
+        if output is None:
+            sys.exit("No frames were measured")
+        sys.exit()
+
+    video = Video(args.filename)
+    if args.labels is not None:
+        rois = load_labels(args.labels)
+    else:
+        if args.rois is None:
+            args.rois = basename + '_ROIs.tsv'
+        rois = load_rois(args.rois)
+        if args.method == 'labels':
+            rois = LabelImage.from_rois(rois, video.width, video.height)
+
+    if args.motion:
+        from motion import get_shifts
+        shifts = get_shifts(video, binning=args.motion_binning)
+    else:
+        shifts = None
+
+    start = round(args.start * video.fps)
+    stop = None if args.stop is None else round(args.stop * video.fps)
+    if args.follow is None:
+        intensity = measure(video, rois, start=start, stop=stop,
+                            step=args.step, bin_size=args.bin,
+                            binning=args.binning, dff_window=args.dff,
+                            dff_percentile=args.dff_percentile,
+                            shifts=shifts, statistics=args.statistics,
+                            neuropil_factor=args.neuropil,
+                            channels=args.channels,
+                            workers=args.workers or None)
+    else:
+        # Stopped with Ctrl-C or after the timeout; either way, the
+        # data measured are saved.
+        intensity = None
+        try:
+            for intensity in follow(
+                    video, rois, timeout=args.follow, start=start,
+                    step=args.step, bin_size=args.bin,
+                    binning=args.binning, dff_window=args.dff,
+                    dff_percentile=args.dff_percentile,
+                    statistics=args.statistics,
+                    neuropil_factor=args.neuropil,
+                    channels=args.channels):
+                print('\rFrame {}'.format(intensity.index[-1]),
+                      end='', flush=True)
+        except KeyboardInterrupt:
+            pass
+        print()
+    if intensity is None:
+        sys.exit("No frames were measured")
+    if args.binning > 1:
+        basename += '_bin{}'.format(args.binning)
+    save_intensity(basename + '.tsv', intensity, args.format)
@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A single limit for the memory taken by frames held in memory.
+
+Videos loaded in memory, frames read ahead, projections and other
+buffers can each take a lot of memory with large videos. Rather than
+each having a limit of its own, they all take the memory they need
+from one MemoryBudget, `budget`, so that the total stays within its
+`limit`. That is what needs to be set to run on a machine shared with
+others, either before opening any video:
+
+    import memory
+    memory.budget.limit = 8 * 2**30
+
+or with the VIDEOROI_MEMORY environment variable (in MB). Lowering it
+later releases what can be released to fit in the new limit.
+
+When there is no room for an allocation, allocations that can be given
+back are released to make room, oldest first: e.g. a TIFF video loaded
+in memory is then read from file a few frames at a time instead (see
+`release` in MemoryBudget.allocate). If there is still no room the
+allocation is refused and whoever asked for it has to do without, e.g.
+read fewer frames ahead.
+'''
+
+import inspect
+import os
+import threading
+import weakref
+
+# Default limit (bytes), unless set with VIDEOROI_MEMORY (MB).
+DEFAULT_LIMIT = 2**31
+
+
+def format_size(size):
+    '''
+    Returns a number of bytes as a string, e.g. '1.5 GB'.
+    '''
+    for unit in ('bytes', 'kB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    if unit == 'bytes':
+        return '{} {}'.format(int(size), unit)
+    return '{:.1f} {}'.format(size, unit)
+
+
+class Allocation:
+    '''
+    Memory taken from a MemoryBudget; see MemoryBudget.allocate.
+    '''
+    def __init__(self, budget, name, size, release=None):
+        self.budget = budget
+        self.name = name
+        self.size = size
+        # A method is held by a weak reference, so that the allocation
+        # does not keep its object alive (see `owner` in
+        # MemoryBudget.allocate).
+        if inspect.ismethod(release):
+            self._release = weakref.WeakMethod(release)
+        elif release is not None:
+            self._release = lambda: release
+        else:
+            self._release = None
+
+    @property
+    def releasable(self):
+        return self._release is not None
+
+    def release(self):
+        '''
+        Frees the memory, calling the release function of the
+        allocation first so that whoever holds it stops using it.
+        '''
+        self.free()
+        function = None if self._release is None else self._release()
+        if function is not None:
+            function()
+
+    def resize(self, size):
+        '''
+        Changes the size of the allocation. Returns False, and leaves
+        it as it was, if there is no room for the new size.
+        '''
+        return self.budget._resize(self, size)
+
+    def free(self):
+        '''
+        Gives the memory back to the budget. Freeing an allocation
+        more than once does nothing.
+        '''
+        self.budget._free(self)
+
+
+class MemoryBudget:
+    '''
+    Keeps account of the memory taken by frames held in memory, up to
+    `limit` bytes. See the module's docstring.
+    '''
+    def __init__(self, limit=DEFAULT_LIMIT):
+        self._allocations = []
+        # Allocations may be requested from several threads.
+        self._lock = threading.RLock()
+        # Number of allocations released to make room for others.
+        self.release_count = 0
+        self.limit = limit
+
+    @property
+    def limit(self):
+        '''
+        Most memory that can be allocated (bytes). When it is lowered,
+        allocations are released, oldest first, until the memory used
+        is within it; those that cannot be released are kept, and no
+        more can be allocated until they are freed.
+        '''
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit):
+        with self._lock:
+            self._limit = limit
+            self._make_room(0)
+
+    @property
+    def used(self):
+        '''
+        Memory allocated (bytes).
+        '''
+        with self._lock:
+            return sum(allocation.size for allocation in self._allocations)
+
+    @property
+    def available(self):
+        '''
+        Memory that can be allocated without releasing any (bytes).
+        '''
+        return max(self.limit - self.used, 0)
+
+    def allocate(self, name, size, release=None, owner=None,
+                 minimum=None):
+        '''
+        Takes `size` bytes for `name` (a description shown by
+        `report`). Returns an Allocation, or None if there is no room
+        for it even after releasing others.
+
+        `release`, if given, is a function that stops using the
+        memory. It is called if the memory is needed for another
+        allocation, which makes this one releasable; the allocation is
+        then freed.
+
+        If `owner` is given, the allocation is freed when `owner` is
+        deleted, so it need not be freed explicitly.
+
+        If `minimum` is given, and there is not enough room for `size`
+        bytes, as much as there is is allocated instead, as long as it
+        is at least `minimum` bytes; only then are other allocations
+        released to make room. The size allocated is the `size` of the
+        Allocation.
+        '''
+        with self._lock:
+            if minimum is not None and size > self.available:
+                size = max(self.available, minimum)
+            if not self._make_room(size):
+                return None
+            allocation = Allocation(self, name, size, release)
+            self._allocations.append(allocation)
+        if owner is not None:
+            weakref.finalize(owner, allocation.free)
+        return allocation
+
+    def _make_room(self, size, keep=None):
+        '''
+        Releases allocations, oldest first, until there are `size`
+        bytes available. Returns False if that is not possible.
+        '''
+        if size > self.limit:
+            return False
+        for allocation in list(self._allocations):
+            if self.used + size <= self.limit:
+                break
+            if allocation.releasable and allocation is not keep:
+                allocation.release()
+                self.release_count += 1
+        return self.used + size <= self.limit
+
+    def _resize(self, allocation, size):
+        with self._lock:
+            if allocation not in self._allocations:
+                return False
+            if (size > allocation.size and
+                    not self._make_room(size - allocation.size,
+                                        keep=allocation)):
+                return False
+            allocation.size = size
+            return True
+
+    def _free(self, allocation):
+        with self._lock:
+            if allocation in self._allocations:
+                self._allocations.remove(allocation)
+
+    def report(self):
+        '''
+        Returns a description of the memory used: the total and then
+        one line per allocation.
+        '''
+        with self._lock:
+            lines = ['{} of {} used'.format(format_size(self.used),
+                                            format_size(self.limit))]
+            for allocation in self._allocations:
+                lines.append('{}: {}'.format(allocation.name,
+                                             format_size(allocation.size)))
+            if self.release_count:
+                lines.append('Released to make room: {}'.format(
+                    self.release_count))
+        return '\n'.join(lines)
+
+
+def _default_limit():
+    value = os.environ.get('VIDEOROI_MEMORY')
+    if value is None:
+        return DEFAULT_LIMIT
+    return int(float(value) * 2**20)
+
+
+# The budget shared by all videos, buffers, etc.
+budget = MemoryBudget(_default_limit())
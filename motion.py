@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Rigid motion correction.
+
+The displacement of each frame relative to a reference image is
+estimated by phase correlation (cv2.phaseCorrelate, which uses the
+FFT). Frames are not warped: instead, the ROIs are moved by the
+displacement of each frame when it is measured (see the `shifts`
+argument of `measure.measure`), so correcting for motion costs about
+the same as not doing so. Shifts are saved next to the video in a
+`_shifts.tsv` file so that they are only estimated once (see
+`shifts_filename`).
+'''
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import cv2
+
+from video import VideoBinned
+
+SHIFTS_COLUMNS = ("frame", "x_shift", "y_shift")
+
+
+def _prepare(frame):
+    '''
+    Returns a frame as a single channel float32 array, as needed by
+    cv2.phaseCorrelate.
+    '''
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame.astype(np.float32)
+
+
+def reference_image(video, frame_count=20):
+    '''
+    Returns the mean of the first `frame_count` frames of `video`, to
+    be used as reference to estimate motion.
+    '''
+    reference = None
+    for (frame_index, (frame_number, frame)) in enumerate(
+            video.iter_frames(0, frame_count)):
+        if reference is None:
+            reference = _prepare(frame)
+        else:
+            reference += _prepare(frame)
+    return reference / (frame_index + 1)
+
+
+def estimate_shifts(video, reference=None, binning=1, progress=None):
+    '''
+    Estimates the displacement of each frame of `video` relative to
+    `reference` (by default, see `reference_image`).
+
+    With `binning` greater than 1 the frames are binned before the
+    shifts are estimated (see video.VideoBinned), which is faster and
+    usually precise enough. `reference`, if given, must be binned too.
+
+    `progress` is as in `measure.measure`.
+
+    Returns an array with one row per frame and two columns: the
+    displacement along x and along y, relative to the first frame, in
+    pixels of the video file (i.e. without any binning). A positive
+    shift means that the image moved right or down.
+    '''
+    scale = video.binning * binning
+    if binning > 1:
+        video = VideoBinned(video, binning)
+    if reference is None:
+        reference = reference_image(video)
+    reference = _prepare(reference)
+    window = cv2.createHanningWindow(
+            (reference.shape[1], reference.shape[0]), cv2.CV_32F)
+
+    shifts = np.zeros((video.frame_count, 2))
+    for (frame_number, frame) in video.iter_frames():
+        (shift, response) = cv2.phaseCorrelate(
+                reference, _prepare(frame), window)
+        shifts[frame_number] = shift
+        if progress is not None:
+            if progress(frame_number + 1, video.frame_count):
+                return None
+    # Shifts are relative to the first frame rather than to the
+    # reference, because the first frame is where ROIs are usually
+    # drawn.
+    return (shifts - shifts[0]) * scale
+
+
+def shifts_filename(video_filename, binning=1, reference=None):
+    '''
+    Returns the name of the file where the shifts of a video are
+    saved, which depends on how they were estimated: the binning of
+    the frames (that of the video times that of `estimate_shifts`) and
+    the reference image, if one was given.
+    '''
+    filename = os.path.splitext(video_filename)[0] + '_shifts'
+    if binning > 1:
+        filename += '_bin{}'.format(binning)
+    if reference is not None:
+        digest = hashlib.sha1(np.ascontiguousarray(reference)).hexdigest()
+        filename += '_ref' + digest[:8]
+    return filename + '.tsv'
+
+
+def load_shifts(filename):
+    '''
+    Loads shifts from a tab separated file with a header and three
+    columns: frame, x_shift, y_shift.
+    '''
+    table = pd.read_csv(filename, sep='\t', index_col='frame')
+    return table[list(SHIFTS_COLUMNS[1:])].values
+
+
+def save_shifts(filename, shifts):
+    '''
+    Saves shifts as a tab separated file that can be loaded with
+    `load_shifts`.
+    '''
+    table = pd.DataFrame(shifts, columns=SHIFTS_COLUMNS[1:])
+    table.index.name = SHIFTS_COLUMNS[0]
+    table.to_csv(filename, sep='\t', float_format='%.3f')
+
+
+def get_shifts(video, binning=1, reference=None, progress=None):
+    '''
+    Returns the shifts of `video`, loading them from its `_shifts.tsv`
+    file if that exists and is newer than the video, or estimating and
+    saving them otherwise (see `estimate_shifts`). Shifts estimated
+    with a different binning or reference are saved in a file of their
+    own (see `shifts_filename`).
+    '''
+    filename = shifts_filename(video.filename, video.binning * binning,
+                               reference)
+    if (os.path.exists(filename) and
+            os.path.getmtime(filename) >= os.path.getmtime(video.filename)):
+        shifts = load_shifts(filename)
+        if len(shifts) == video.frame_count:
+            return shifts
+
+    shifts = estimate_shifts(video, reference, binning, progress)
+    if shifts is not None:
+        save_shifts(filename, shifts)
+    return shifts
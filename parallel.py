@@ -0,0 +1,272 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Measure ROIs in several processes.
+
+Frames are read (decoded) in a single process, as usual, but measured
+in worker processes, each of which measures part of the ROIs. Sending
+whole frames to other processes through a queue would mean pickling
+and copying each of them once per worker, which for large frames costs
+more than measuring them. Instead frames are passed through a ring of
+slots in shared memory (see FrameRing): each frame is copied once, into
+a free slot, and all the workers read it from there without copying
+it. Only the measures, a few numbers per ROI, are sent back. A slot is
+reused as soon as all the workers are done with its frame, so at most
+as many frames as slots are held in memory.
+
+This pays off when measuring a frame takes longer than reading it,
+e.g. with many ROIs, statistics or neuropil; otherwise reading is the
+bottleneck and more workers do not make it any faster. Use it through
+the `workers` argument of `measure.measure`, or directly:
+
+    from parallel import ParallelMeasurement
+
+    measurement = ParallelMeasurement(video, rois, workers=4)
+    measurement.update()
+    intensity = measurement.result()
+'''
+
+import collections
+import multiprocessing
+import os
+import queue
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from measure import Measurement
+from memory import budget
+
+
+class FrameRing:
+    '''
+    `slot_count` frames of the given shape and dtype in shared memory,
+    available as the array `frames` (one frame per slot).
+
+    Without `name` the shared memory is created, taken from the memory
+    budget (see memory.py), and it is freed on `close`; if the budget
+    has no room for `slot_count` frames, the ring has fewer slots, at
+    least one. With `name`, an existing ring is attached to, e.g. from
+    another process.
+    '''
+    def __init__(self, slot_count, shape, dtype, name=None):
+        self.dtype = np.dtype(dtype)
+        self._owner = name is None
+        self._allocation = None
+        if self._owner:
+            frame_bytes = int(np.prod(shape)) * self.dtype.itemsize
+            self._allocation = budget.allocate(
+                    'Frames being measured', slot_count * frame_bytes,
+                    owner=self, minimum=frame_bytes)
+            if self._allocation is not None:
+                slot_count = max(self._allocation.size //
+                                 max(frame_bytes, 1), 1)
+            else:
+                slot_count = 1
+        self.shape = (slot_count,) + tuple(shape)
+        if self._owner:
+            size = int(np.prod(self.shape)) * self.dtype.itemsize
+            self._memory = shared_memory.SharedMemory(
+                    create=True, size=max(size, 1))
+        else:
+            self._memory = shared_memory.SharedMemory(name)
+        self.frames = np.ndarray(self.shape, self.dtype,
+                                 buffer=self._memory.buf)
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    def close(self):
+        # Shared memory cannot be closed while arrays use it.
+        self.frames = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+        if self._allocation is not None:
+            self._allocation.free()
+
+
+def partition(rois, count):
+    '''
+    Splits `rois` (a RoiSet, LabelImage or MaskSet) into at most `count`
+    groups with about the same number of ROIs, taking them from the top
+    of the frame to the bottom so that each group covers a band of the
+    frame and its crop is small.
+
+    Returns the indices of the ROIs of each group, in increasing order.
+    '''
+    centres = [(y0 + y1) / 2 for ((x0, y0, x1, y1), mask)
+               in rois.roi_masks()]
+    order = np.argsort(centres, kind='stable')
+    count = max(1, min(count, len(rois)))
+    return [np.sort(group) for group in np.array_split(order, count)]
+
+
+def _reduce_frames(reducer, worker, ring_args, tasks, results):
+    '''
+    Worker process: reduces the frames in the slots of the FrameRing
+    given by `ring_args` (slot count, shape, dtype, name) with
+    `reducer` (a measure.FrameReducer). Takes tasks (slot, offset) from
+    the `tasks` queue until it gets None, and puts tuples (slot,
+    worker, results) in the `results` queue; if reducing fails,
+    results is the traceback.
+    '''
+    ring = FrameRing(*ring_args)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            (slot, offset) = task
+            try:
+                measures = reducer.reduce(ring.frames[slot], offset)
+            except Exception:
+                measures = traceback.format_exc()
+            results.put((slot, worker, measures))
+    finally:
+        ring.close()
+
+
+class ParallelMeasurement(Measurement):
+    '''
+    A Measurement in which frames are measured in `workers` processes
+    (by default, one per core), each of which measures part of the
+    ROIs (see `partition`). Frames are passed to them through a
+    FrameRing of `slot_count` slots (by default, two per worker).
+
+    Other arguments, and the data, are as in measure.Measurement.
+    Processes are started by each `update` and stopped when it is done.
+    '''
+    def __init__(self, video, rois, workers=None, slot_count=None,
+                 **options):
+        super().__init__(video, rois, **options)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.groups = partition(self.reducer.rois, workers)
+        self.slot_count = slot_count or 2 * len(self.groups)
+
+    def reduce_frames(self, start, stop):
+        '''
+        As Measurement.reduce_frames, with frames measured in the
+        worker processes.
+        '''
+        frames = self.video.iter_frames(start, stop, self.step)
+        # The ring is made for the first frame; all the frames of a
+        # video have the same shape.
+        (frame_number, frame) = next(frames, (None, None))
+        if frame is None:
+            return
+        ring = FrameRing(self.slot_count, frame.shape, frame.dtype)
+        # There may not have been room for all the slots.
+        slot_count = ring.shape[0]
+        ring_args = (slot_count, frame.shape, frame.dtype, ring.name)
+        context = multiprocessing.get_context()
+        results = context.Queue()
+        tasks = []
+        processes = []
+        for (worker, group) in enumerate(self.groups):
+            tasks.append(context.Queue())
+            processes.append(context.Process(
+                target=_reduce_frames, daemon=True,
+                args=(self.reducer.subset(group), worker, ring_args,
+                      tasks[-1], results)))
+        for process in processes:
+            process.start()
+
+        free = list(range(slot_count))
+        # Frames being measured, in order, as (frame_number, slot), and
+        # the results of each slot received so far, by worker.
+        pending = collections.deque()
+        received = {}
+
+        def receive(block=True):
+            # Waits for results from a worker. Returns False if there
+            # were none and `block` is False.
+            while True:
+                try:
+                    (slot, worker, measures) = results.get(block, 1)
+                    break
+                except queue.Empty:
+                    if not block:
+                        return False
+                    if not all(process.is_alive()
+                               for process in processes):
+                        raise RuntimeError(
+                                "A measuring process stopped unexpectedly")
+            if isinstance(measures, str):
+                raise RuntimeError("Measuring failed in a worker "
+                                   "process:\n" + measures)
+            received.setdefault(slot, {})[worker] = measures
+            return True
+
+        def done():
+            # The frames that all the workers are done with, in order.
+            while (pending and len(received.get(pending[0][1], ())) ==
+                   len(self.groups)):
+                (frame_number, slot) = pending.popleft()
+                free.append(slot)
+                yield (frame_number, self._combine(received.pop(slot)))
+
+        try:
+            while frame is not None:
+                while not free:
+                    receive()
+                    yield from done()
+                slot = free.pop()
+                ring.frames[slot] = frame
+                offset = self.offset(frame_number)
+                for worker_tasks in tasks:
+                    worker_tasks.put((slot, offset))
+                pending.append((frame_number, slot))
+                while receive(block=False):
+                    pass
+                yield from done()
+                (frame_number, frame) = next(frames, (None, None))
+            while pending:
+                receive()
+                yield from done()
+        finally:
+            for worker_tasks in tasks:
+                worker_tasks.put(None)
+            # Results still queued (e.g. if cancelled) must be taken
+            # for the workers to be able to exit.
+            while any(process.is_alive() for process in processes):
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for process in processes:
+                process.join()
+            ring.close()
+
+    def _combine(self, measures):
+        '''
+        Returns the results of all the workers for a frame, `measures`
+        (by worker), as those of a single FrameReducer.
+        '''
+        combined = {}
+        for (name, values) in measures[0].items():
+            combined[name] = np.empty((len(self.reducer),) +
+                                      values.shape[1:])
+            for (worker, group) in enumerate(self.groups):
+                combined[name][group] = measures[worker][name]
+        return combined
@@ -0,0 +1,391 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Mean, maximum and standard deviation projections of a video.
+
+All three are calculated in a single pass over the video, one frame at
+a time, so memory use does not depend on the length of the video. The
+mean and standard deviation are updated with Welford's algorithm,
+which is numerically stable. Projections are saved next to the video
+in a `_projections.npz` file so that they are only calculated once.
+Their memory is taken from the memory budget (see memory.py).
+
+An Overview of the video, the mean intensity of every frame and small
+thumbnails of frames at regular intervals, is calculated in the same
+pass (see `get_summaries`) and saved as `_overview.npz`. It gives a
+view of the whole video without reading any more frames.
+
+`sample_levels` gives a display range for the whole video from a
+sample of its frames, which is quick enough to do when it is opened.
+'''
+
+import math
+import os
+
+import cv2
+import numpy as np
+
+from measure import gray
+from memory import budget
+
+
+class Projections:
+    '''
+    Running mean, maximum and standard deviation of frames.
+
+    Add frames with `update`; the projections are available at any
+    time as the `mean`, `max` and `std` attributes.
+
+    Raises MemoryError if the memory budget has no room for them.
+    '''
+    def __init__(self):
+        self.source = ''
+        self.frame_count = 0
+        self.mean = None
+        self.max = None
+        self._m2 = None
+        self._allocation = None
+
+    def _allocate(self, frame):
+        # The mean and m2 (float) and the maximum (as the frames).
+        size = frame.size * (2 * 8 + frame.itemsize)
+        self._allocation = budget.allocate('Projections', size,
+                                           owner=self)
+        if self._allocation is None:
+            raise MemoryError("Not enough memory for the projections")
+
+    def update(self, frame):
+        '''
+        Adds a frame to the projections.
+        '''
+        frame = gray(frame)
+        self.frame_count += 1
+        if self.mean is None:
+            self._allocate(frame)
+            self.mean = frame.astype(float)
+            self.max = frame.copy()
+            self._m2 = np.zeros(frame.shape)
+            return
+        delta = frame - self.mean
+        self.mean += delta / self.frame_count
+        self._m2 += delta * (frame - self.mean)
+        np.maximum(self.max, frame, out=self.max)
+
+    @property
+    def std(self):
+        '''
+        Standard deviation projection.
+        '''
+        if self._m2 is None:
+            return None
+        return np.sqrt(self._m2 / self.frame_count)
+
+    def save(self, filename, source=''):
+        '''
+        Saves the projections in a .npz file. `source` is the name of
+        the video they come from.
+        '''
+        np.savez(filename, source=source, frame_count=self.frame_count,
+                 mean=self.mean, max=self.max, m2=self._m2)
+
+    @classmethod
+    def load(cls, filename):
+        projections = cls()
+        with np.load(filename) as data:
+            projections.source = str(data['source'])
+            projections.frame_count = int(data['frame_count'])
+            projections._allocate(data['max'])
+            projections.mean = data['mean']
+            projections.max = data['max']
+            projections._m2 = data['m2']
+        return projections
+
+
+class Overview:
+    '''
+    Mean intensity of each of `frame_count` frames, in `means` (NaN for
+    frames not added yet), and thumbnails of frames at regular
+    intervals, in `thumbnails`: at most `thumbnail_count` of them, one
+    every `thumbnail_step` frames, `thumbnail_width` pixels wide.
+
+    Add frames with `update`. There are no thumbnails if the memory
+    budget has no room for them.
+    '''
+    def __init__(self, frame_count=0, thumbnail_count=500,
+                 thumbnail_width=64):
+        self.source = ''
+        self.means = np.full(frame_count, np.nan)
+        self.thumbnail_step = max(1, math.ceil(frame_count /
+                                               max(thumbnail_count, 1)))
+        self.thumbnail_count = math.ceil(frame_count / self.thumbnail_step)
+        self.thumbnail_width = thumbnail_width
+        self.thumbnails = None
+        self._allocation = None
+
+    def _allocate(self, thumbnail):
+        size = self.thumbnail_count * thumbnail.nbytes
+        self._allocation = budget.allocate('Overview', size, owner=self)
+        if self._allocation is None:
+            self.thumbnail_count = 0
+        return self._allocation is not None
+
+    def update(self, frame_number, frame):
+        '''
+        Adds frame `frame_number` to the overview.
+        '''
+        if frame_number >= len(self.means):
+            return
+        frame = gray(frame)
+        self.means[frame_number] = frame.mean()
+        if (frame_number % self.thumbnail_step or
+                not self.thumbnail_count):
+            return
+        thumbnail = self.make_thumbnail(frame)
+        if self.thumbnails is None:
+            if not self._allocate(thumbnail):
+                return
+            self.thumbnails = np.zeros(
+                    (self.thumbnail_count,) + thumbnail.shape,
+                    thumbnail.dtype)
+        self.thumbnails[frame_number // self.thumbnail_step] = thumbnail
+
+    def make_thumbnail(self, frame):
+        '''
+        Returns `frame` (gray) reduced to the width of the thumbnails.
+        '''
+        (height, width) = frame.shape
+        size = (min(self.thumbnail_width, width),
+                max(1, round(height * self.thumbnail_width / width)))
+        if size[0] == width:
+            return frame.copy()
+        # OpenCV does not resize all types (e.g. bool, int64).
+        if frame.dtype not in (np.uint8, np.uint16, np.float32,
+                               np.float64):
+            frame = frame.astype(np.float32)
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def thumbnail(self, frame_number):
+        '''
+        Returns the thumbnail nearest to frame `frame_number`, or None
+        if there are no thumbnails.
+        '''
+        if self.thumbnails is None:
+            return None
+        index = int(round(frame_number / self.thumbnail_step))
+        return self.thumbnails[min(max(index, 0), self.thumbnail_count - 1)]
+
+    def save(self, filename, source=''):
+        '''
+        Saves the overview in a .npz file. `source` is the name of the
+        video it comes from.
+        '''
+        thumbnails = self.thumbnails
+        if thumbnails is None:
+            thumbnails = np.zeros((0, 0, 0))
+        np.savez(filename, source=source, means=self.means,
+                 thumbnail_step=self.thumbnail_step,
+                 thumbnail_width=self.thumbnail_width,
+                 thumbnails=thumbnails)
+
+    @classmethod
+    def load(cls, filename):
+        overview = cls()
+        with np.load(filename) as data:
+            overview.source = str(data['source'])
+            overview.means = data['means']
+            overview.thumbnail_step = int(data['thumbnail_step'])
+            overview.thumbnail_width = int(data['thumbnail_width'])
+            thumbnails = data['thumbnails']
+            overview.thumbnail_count = len(thumbnails)
+            if len(thumbnails) and overview._allocate(thumbnails[0]):
+                overview.thumbnails = thumbnails
+        return overview
+
+
+def _summary_filename(video, suffix):
+    filename = os.path.splitext(video.filename)[0]
+    if video.binning > 1:
+        filename += '_bin{}'.format(video.binning)
+    return filename + suffix
+
+
+def projections_filename(video):
+    '''
+    Returns the name of the file where the projections of `video` are
+    saved, which depends on the binning of the video.
+    '''
+    return _summary_filename(video, '_projections.npz')
+
+
+def overview_filename(video):
+    '''
+    Returns the name of the file where the overview of `video` is
+    saved, which depends on the binning of the video.
+    '''
+    return _summary_filename(video, '_overview.npz')
+
+
+def _load_saved(cls, filename, video):
+    '''
+    Returns the object of class `cls` (Projections or Overview) saved
+    in `filename`, or None if there is no such file or it is older than
+    `video`.
+    '''
+    if (os.path.exists(filename) and
+            os.path.getmtime(filename) >= os.path.getmtime(video.filename)):
+        saved = cls.load(filename)
+        # Videos with the same name but different extension share the
+        # file name.
+        if saved.source == os.path.basename(video.filename):
+            return saved
+    return None
+
+
+def summarise(video, projections=None, overview=None, progress=None):
+    '''
+    Adds all the frames of `video` to `projections` and `overview`
+    (either of them may be None) in a single pass over the video.
+    Returns False if cancelled.
+
+    If the memory budget has no room for the projections, the
+    MemoryError is raised, unless there is an overview; then the
+    projections are left empty and the overview is still made.
+
+    `progress` is as in `measure.measure`.
+    '''
+    for (frame_number, frame) in video.iter_frames():
+        frame = gray(frame)
+        if projections is not None:
+            try:
+                projections.update(frame)
+            except MemoryError:
+                if overview is None:
+                    raise
+                projections = None
+        if overview is not None:
+            overview.update(frame_number, frame)
+        if progress is not None:
+            if progress(frame_number + 1, video.frame_count):
+                return False
+    return True
+
+
+def project(video, progress=None):
+    '''
+    Returns the Projections of all the frames of `video`.
+
+    `progress` is as in `measure.measure`.
+    '''
+    projections = Projections()
+    if not summarise(video, projections, progress=progress):
+        return None
+    return projections
+
+
+def get_projections(video, progress=None):
+    '''
+    Returns the Projections of `video`, loading them from file if they
+    were saved before and the file is newer than the video, or
+    calculating and saving them otherwise.
+    '''
+    filename = projections_filename(video)
+    projections = _load_saved(Projections, filename, video)
+    if projections is not None:
+        return projections
+
+    projections = project(video, progress)
+    if projections is not None and projections.frame_count > 0:
+        projections.save(filename, os.path.basename(video.filename))
+    return projections
+
+
+def get_summaries(video, progress=None, thumbnail_count=500,
+                  thumbnail_width=64):
+    '''
+    Returns the Projections and the Overview of `video` (with the given
+    number and width of thumbnails), or None if cancelled. As in
+    `get_projections`, each is loaded from file if it was saved before,
+    and whatever is missing is calculated in a single pass over the
+    video and saved. The projections are None if the memory budget has
+    no room for them; the overview is made all the same.
+    '''
+    source = os.path.basename(video.filename)
+    projections = _load_saved(Projections, projections_filename(video),
+                              video)
+    overview = _load_saved(Overview, overview_filename(video), video)
+    if projections is not None and overview is not None:
+        return (projections, overview)
+
+    new_projections = Projections() if projections is None else None
+    new_overview = None
+    if overview is None:
+        new_overview = Overview(video.frame_count, thumbnail_count,
+                                thumbnail_width)
+    try:
+        if not summarise(video, new_projections, new_overview, progress):
+            return None
+    except MemoryError:
+        # Only the projections were missing; the overview was loaded.
+        return (None, overview)
+    if new_projections is not None and new_projections.mean is not None:
+        projections = new_projections
+        projections.save(projections_filename(video), source)
+    if new_overview is not None:
+        overview = new_overview
+        overview.save(overview_filename(video), source)
+    return (projections, overview)
+
+
+def sample_levels(video, sample_count=20, percentile=99.9):
+    '''
+    Returns a display range (0, high) for `video`, where high is the
+    `percentile` of the values of `sample_count` frames taken at regular
+    intervals across the video. Unlike the maximum, this is not set by
+    a few saturated or hot pixels.
+
+    For 8 and 16-bit frames the values are accumulated as a histogram
+    with one bin per value, so the sample can be large at little cost.
+    '''
+    frame_numbers = np.unique(np.linspace(
+            0, video.frame_count - 1, sample_count).astype(int))
+    histogram = None
+    samples = []
+    for frame_number in frame_numbers:
+        frame = video.read(frame_number)
+        if frame is None:
+            continue
+        frame = gray(frame)
+        if frame.dtype.kind == 'u' and frame.itemsize <= 2:
+            counts = np.bincount(frame.ravel(),
+                                 minlength=2**(frame.itemsize * 8))
+            histogram = counts if histogram is None else histogram + counts
+        else:
+            samples.append(frame.ravel())
+
+    if histogram is not None:
+        cumulative = np.cumsum(histogram)
+        high = np.searchsorted(cumulative,
+                               cumulative[-1] * percentile / 100)
+    elif samples:
+        high = np.nanpercentile(np.concatenate(samples), percentile)
+    else:
+        high = 2**video.bits_per_sample - 1
+    # A blank video would otherwise have no range at all.
+    return (0.0, max(float(high), 1.0))
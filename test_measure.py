@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests of measuring videos. Run with
+
+    python3 -m unittest test_measure
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+import cv2
+
+from measure import EllipseRoi, follow, measure
+from video import Video
+
+
+class TestFollow(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.rois = [EllipseRoi('a', (20, 20), (40, 30)),
+                     EllipseRoi('b', (90, 50), (50, 40))]
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_avi(self):
+        # Frames appended to an AVI file while it is followed are all
+        # measured, although its header has no frame count until it is
+        # closed.
+        filename = os.path.join(self.dirname, 'live.avi')
+        rng = np.random.RandomState(0)
+        frames = rng.randint(0, 256, (200, 120, 160)).astype(np.uint8)
+        writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'FFV1'),
+                                 20, (160, 120), False)
+        for frame in frames[:40]:
+            writer.write(frame)
+        self.assertGreater(os.path.getsize(filename), 0)
+
+        def record():
+            for frame in frames[40:]:
+                writer.write(frame)
+                time.sleep(0.01)
+            writer.release()
+
+        video = Video(filename)
+        frame_count = video.frame_count
+        self.assertLess(frame_count, 40)
+        thread = threading.Thread(target=record)
+        thread.start()
+        results = list(follow(video, self.rois, interval=0.05, timeout=2))
+        thread.join()
+        video.close()
+
+        self.assertGreater(len(results), 1)
+        self.assertEqual(len(results[-1]), len(frames))
+        video = Video(filename)
+        expected = measure(video, self.rois)
+        video.close()
+        np.testing.assert_allclose(results[-1][['a', 'b']].values,
+                                   expected[['a', 'b']].values)
+
+
+if __name__ == "__main__":
+    unittest.main()
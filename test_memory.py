@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests of the memory budget. Run with
+
+    python3 -m unittest test_memory
+'''
+
+import unittest
+
+import numpy as np
+
+from memory import MemoryBudget, budget
+from parallel import FrameRing
+
+
+class Buffer:
+    def __init__(self):
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class TestBudget(unittest.TestCase):
+    def test_lower_limit(self):
+        # Lowering the limit releases allocations, oldest first, until
+        # the memory used fits.
+        memory = MemoryBudget(100)
+        buffers = [Buffer() for _ in range(4)]
+        allocations = [memory.allocate('buffer', 20, buffer.release)
+                       for buffer in buffers]
+        memory.allocate('fixed', 15)
+        memory.limit = 50
+        self.assertEqual(memory.used, 35)
+        self.assertEqual([buffer.released for buffer in buffers],
+                         [True, True, True, False])
+        # What cannot be released is kept.
+        memory.limit = 10
+        self.assertEqual(memory.used, 15)
+        self.assertIsNone(memory.allocate('more', 1))
+        for allocation in allocations:
+            allocation.free()
+
+    def test_release_function(self):
+        # Functions are called as well as methods.
+        memory = MemoryBudget(100)
+        released = []
+        memory.allocate('buffer', 60, lambda: released.append(True))
+        memory.allocate('other', 60)
+        self.assertEqual(released, [True])
+
+
+class TestFrameRing(unittest.TestCase):
+    def setUp(self):
+        self.limit = budget.limit
+
+    def tearDown(self):
+        budget.limit = self.limit
+
+    def test_allocation(self):
+        used = budget.used
+        ring = FrameRing(8, (10, 10), np.uint16)
+        self.assertEqual(budget.used, used + ring.frames.nbytes)
+        ring.close()
+        self.assertEqual(budget.used, used)
+
+    def test_fewer_slots(self):
+        budget.limit = budget.used + 3 * 100
+        ring = FrameRing(8, (10, 10), np.uint8)
+        self.assertEqual(ring.shape[0], 3)
+        ring.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
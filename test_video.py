@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2016-2018 Antonio González
+#
+# This file is part of videoroi.
+#
+# Videoroi is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Videoroi is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with videoroi. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests of opening and reading videos. Run with
+
+    python3 -m unittest test_video
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import cv2
+
+from video import Video, VideoSequence, VideoTiff
+
+
+def make_frames(count=5, height=24, width=32):
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 2**16, (count, height, width)).astype(np.uint16)
+
+
+class TestOpen(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_brackets_in_filename(self):
+        # A file whose name looks like a pattern is opened as a file.
+        import tifffile
+        frames = make_frames()
+        filename = os.path.join(self.dirname, 'trial[1].tif')
+        tifffile.imwrite(filename, frames)
+        video = Video(filename)
+        self.assertIsInstance(video, VideoTiff)
+        self.assertEqual(video.frame_count, len(frames))
+        np.testing.assert_array_equal(video.read(2), frames[2])
+        video.close()
+
+    def test_pattern(self):
+        frames = make_frames()
+        for (number, frame) in enumerate(frames):
+            cv2.imwrite(os.path.join(self.dirname,
+                                     'frame{}.png'.format(number)), frame)
+        video = Video(os.path.join(self.dirname, 'frame*.png'))
+        self.assertIsInstance(video, VideoSequence)
+        self.assertEqual(video.frame_count, len(frames))
+        video.close()
+
+    def test_pattern_without_images(self):
+        with self.assertRaises(FileNotFoundError):
+            Video(os.path.join(self.dirname, 'trial[1].tif'))
+
+
+if __name__ == "__main__":
+    unittest.main()
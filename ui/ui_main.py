@@ -23,6 +23,11 @@ class Ui_MainWindow(object):
         self.graphicsView = GraphicsLayoutWidget(self.centralwidget)
         self.graphicsView.setObjectName("graphicsView")
         self.verticalLayout_3.addWidget(self.graphicsView)
+        self.overview_view = GraphicsLayoutWidget(self.centralwidget)
+        self.overview_view.setMinimumSize(QtCore.QSize(0, 60))
+        self.overview_view.setMaximumSize(QtCore.QSize(16777215, 60))
+        self.overview_view.setObjectName("overview_view")
+        self.verticalLayout_3.addWidget(self.overview_view)
         self.scrollbar = QtWidgets.QScrollBar(self.centralwidget)
         self.scrollbar.setOrientation(QtCore.Qt.Horizontal)
         self.scrollbar.setObjectName("scrollbar")
@@ -60,6 +65,14 @@ class Ui_MainWindow(object):
         self.autoLevel_button.setChecked(True)
         self.autoLevel_button.setObjectName("autoLevel_button")
         self.verticalLayout_5.addWidget(self.autoLevel_button)
+        self.display_combo = QtWidgets.QComboBox(self.display_box)
+        self.display_combo.setObjectName("display_combo")
+        self.display_combo.addItem("")
+        self.verticalLayout_5.addWidget(self.display_combo)
+        self.play_button = QtWidgets.QPushButton(self.display_box)
+        self.play_button.setCheckable(True)
+        self.play_button.setObjectName("play_button")
+        self.verticalLayout_5.addWidget(self.play_button)
         self.reset_view_button = QtWidgets.QPushButton(self.display_box)
         self.reset_view_button.setObjectName("reset_view_button")
         self.verticalLayout_5.addWidget(self.reset_view_button)
@@ -92,6 +105,14 @@ class Ui_MainWindow(object):
         self.measure_button = QtWidgets.QPushButton(self.fluorescence_box)
         self.measure_button.setObjectName("measure_button")
         self.verticalLayout.addWidget(self.measure_button)
+        self.follow_button = QtWidgets.QPushButton(self.fluorescence_box)
+        self.follow_button.setCheckable(True)
+        self.follow_button.setObjectName("follow_button")
+        self.verticalLayout.addWidget(self.follow_button)
+        self.measure_combo = QtWidgets.QComboBox(self.fluorescence_box)
+        self.measure_combo.setObjectName("measure_combo")
+        self.measure_combo.addItem("")
+        self.verticalLayout.addWidget(self.measure_combo)
         self.plot_button = QtWidgets.QPushButton(self.fluorescence_box)
         self.plot_button.setObjectName("plot_button")
         self.verticalLayout.addWidget(self.plot_button)
@@ -117,10 +138,15 @@ class Ui_MainWindow(object):
     def retranslateUi(self, MainWindow):
         _translate = QtCore.QCoreApplication.translate
         MainWindow.setWindowTitle(_translate("MainWindow", "Video ROI"))
+        self.overview_view.setToolTip(_translate("MainWindow", "Mean intensity of each frame; click to go to a frame"))
         self.open_video_button.setText(_translate("MainWindow", "&Open"))
         self.open_video_button.setShortcut(_translate("MainWindow", "Ctrl+O"))
         self.display_box.setTitle(_translate("MainWindow", "Display"))
         self.autoLevel_button.setText(_translate("MainWindow", "Auto level"))
+        self.display_combo.setToolTip(_translate("MainWindow", "Image to display"))
+        self.display_combo.setItemText(0, _translate("MainWindow", "Frame"))
+        self.play_button.setText(_translate("MainWindow", "Play"))
+        self.play_button.setShortcut(_translate("MainWindow", "Space"))
         self.reset_view_button.setText(_translate("MainWindow", "Reset view"))
         self.roi_box.setTitle(_translate("MainWindow", "ROIs"))
         self.clear_roi_button.setText(_translate("MainWindow", "Clear"))
@@ -129,6 +155,10 @@ class Ui_MainWindow(object):
         self.save_rois_button.setText(_translate("MainWindow", "Save"))
         self.fluorescence_box.setTitle(_translate("MainWindow", "Fluorescence"))
         self.measure_button.setText(_translate("MainWindow", "Measure"))
+        self.follow_button.setToolTip(_translate("MainWindow", "Keep measuring new frames while the video is recorded"))
+        self.follow_button.setText(_translate("MainWindow", "Follow"))
+        self.measure_combo.setToolTip(_translate("MainWindow", "Data to plot"))
+        self.measure_combo.setItemText(0, _translate("MainWindow", "Intensity"))
         self.plot_button.setText(_translate("MainWindow", "Plot"))
         self.save_button.setText(_translate("MainWindow", "Save"))
         self.quit_button.setText(_translate("MainWindow", "&Quit"))
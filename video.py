@@ -19,7 +19,17 @@
 
 import sys
 import os
+import copy
+import fnmatch
+import json
+import re
+import struct
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from memory import budget
 
 # Requires OpenCV 3
 import cv2
@@ -29,6 +39,12 @@ if int(cv2_ver[0]) < 3:
 
 
 class VideoBase:
+    # Size of the blocks of pixels averaged into one; see VideoBinned.
+    binning = 1
+    # Order of the channels of colour frames: blue, green, red as in
+    # OpenCV, or red, green, blue as in most other libraries.
+    channel_order = 'rgb'
+
     def __init__(self, filename):
         self.filename = filename
         # Placeholders: all these properties must be defined by any
@@ -95,6 +111,41 @@ class VideoBase:
         '''
         return self.frame_count / self.fps
 
+    def iter_frames(self, start=0, stop=None, step=1):
+        '''
+        Iterates over frames `start` to `stop` (excluded; by default
+        the end of the video) taking one every `step` frames. Yields
+        tuples (frame_number, frame).
+        '''
+        if stop is None or stop > self.frame_count:
+            stop = self.frame_count
+        for frame_number in range(start, stop, step):
+            yield frame_number, self.read(frame_number)
+
+    def grab(self):
+        '''
+        Moves to the next frame without reading the current one.
+        Returns False if the end of the video was reached.
+        '''
+        if self.pos_frames + 1 >= self.frame_count:
+            return False
+        self.seek_frame(self.pos_frames + 1)
+        return True
+
+    def refresh(self):
+        '''
+        Updates the number of frames of a video that is still being
+        recorded. Returns True if there are new frames.
+        '''
+        return False
+
+    def clone(self):
+        '''
+        Returns an independent object to read the same video, e.g. to
+        read it from another thread.
+        '''
+        return copy.copy(self)
+
     def close(self):
         # Does nothing by default, but needed for compatibility with
         # videoroi
@@ -103,48 +154,236 @@ class VideoBase:
 
 class VideoTiff(VideoBase):
     '''
-    A class for reading a multi-frame tiff. Requires skimage
-    (scikit-image, https://scikit-image.org/) or tifffile 
-    (https://www.lfd.uci.edu/~gohlke/code/tifffile.py.html)
-    modules. Both are availble from pip.
+    A class for reading a multi-frame tiff. Requires tifffile
+    (https://www.lfd.uci.edu/~gohlke/code/tifffile.py.html) or skimage
+    (scikit-image, https://scikit-image.org/) modules. Both are
+    availble from pip.
+
+    With tifffile, compressed pages are decoded on `threads` threads at
+    the same time (by default, half the number of CPUs; compression
+    codecs do not hold Python's global lock, so this scales with the
+    number of cores). The whole video is loaded in memory if the memory
+    budget (see memory.py) has room for it, and, if given, it takes
+    less than `memory` bytes. Otherwise, or if that memory is needed
+    elsewhere later on, the video is read a few pages at a time, as
+    frames are requested, and only those pages are kept.
     '''
-    def __init__(self, filename, fps=None):
+    def __init__(self, filename, fps=None, memory=None, threads=None):
 
-        # Requires skimage or tiffffile to handle multi-image tiff
+        # Requires tifffile or skimage to handle multi-image tiff
         # files.
 
-        # N.B. I have some 16-bit tiff files that cannot be opened with
-        # the latest (2019.2.22) tifffile module ("NotImplementedError:
-        # unpacking 12-bit integers to uint16 not supported") but they
-        # can be opened if I use skimage, albeit with a warning ("tags
-        # are not ordered by code"). It turns out that skimage uses
-        # tifffile too to open tiff files, but an older version
-        # (2017.01.12). For this reason I am setting skimage as the
-        # first option. This may change in the future.
+        # N.B. tifffile is preferred because it can decode pages in
+        # parallel and read only some pages of a file. skimage uses
+        # tifffile too, but only to read whole files. Old tifffile
+        # versions (2019.2.22) could not unpack some 12-bit files that
+        # the (older) version included in skimage could read; current
+        # versions can, with the imagecodecs module.
 
         # Also PIL and Matplotlib cannot deal with mutliframe tiffs:
         # they only load the first frame.
 
+        super().__init__(filename)
+        self.memory = memory
+        self.threads = threads
+        self._tif = None
+        # The frames, if loaded in memory.
+        self._frames = None
+        # Pages read last, when the video is not loaded in memory, and
+        # the memory allocated for them.
+        self._block_range = range(0)
+        self._block = None
+        self._block_allocation = None
+        # Where to look for pages added to the file, and the file
+        # opened to read them; see `refresh`.
+        self._next_ifd = None
+        self._tail = None
+        # The file opened with Pillow to read pages without tifffile.
+        self._image = None
+        name = os.path.basename(filename)
+
         try:
-            from skimage.io import imread
+            import tifffile
         except ModuleNotFoundError:
+            tifffile = None
+        if tifffile is None:
             try:
-                from tifffile import imread
+                from skimage.io import imread
             except ModuleNotFoundError as error:
-                msg = ("Requires `scikit-image` or `tifffile` module" +
+                msg = ("Requires `tifffile` or `scikit-image` module" +
                         ", available from pip.")
                 raise ModuleNotFoundError(msg) from error
+            # skimage reads whole files only. Files that do not fit in
+            # memory are read one page at a time with Pillow, which
+            # skimage requires, on one thread.
+            from PIL import Image
+            with Image.open(self.filename) as image:
+                self._frame_count = getattr(image, 'n_frames', 1)
+                first = np.asarray(image)
+            frame_shape = first.shape
+            dtype = first.dtype
+            self._frame_shape = frame_shape
+            self._frame_bytes = first.nbytes
+            self.block_frames = 4
+            size = self._frame_bytes * self._frame_count
+            if memory is None or size <= memory:
+                frames = _Frames(name, size)
+                if frames.allocation is not None:
+                    frames.array = imread(self.filename).reshape(
+                            (self._frame_count,) + frame_shape)
+                    self._frames = frames
+        else:
+            self._tif = tifffile.TiffFile(self.filename)
+            series = self._tif.series[0]
+            frame_shape = series.keyframe.shape
+            dtype = series.dtype
+            self._frame_count = int(np.prod(series.shape) //
+                                    np.prod(frame_shape))
+            self._frame_bytes = int(np.prod(frame_shape)) * dtype.itemsize
+            # Pages added later are found from the last one in the
+            # file, and read from their offsets; see `refresh`.
+            self._tiff_format = self._tif.tiff
+            self._frame_shape = frame_shape
+            self._next_ifd = self._tif.pages.next_page_offset
+            self._series_frames = self._frame_count
+            self._appended = []
+            # Enough pages to keep all threads busy, if there is room
+            # for them.
+            self.block_frames = 4 * (os.cpu_count() or 1)
+            size = self._frame_bytes * self._frame_count
+            if memory is None or size <= memory:
+                frames = _Frames(name, size)
+                if frames.allocation is not None:
+                    frames.array = self._read_pages(
+                            range(self._frame_count))
+                    self._frames = frames
+                    self._tif.close()
+                    self._tif = None
+        # To tell whether the file is still being written; see
+        # `refresh`.
+        self._file_size = os.path.getsize(self.filename)
+        self._pages_found = self._frame_count
 
-        super().__init__(filename)
-        self._frames = imread(self.filename)
-        self._width = self._frames.shape[-1]
-        self._height = self._frames.shape[-2]
-        self._frame_count = self._frames.shape[-3]
+        self._height, self._width = frame_shape[:2]
         if fps is None:
             warnings.warn("FPS is not defined, defaulting to 1.")
             fps = 1
         self._fps = fps
-        self.bits_per_sample = self._frames.dtype.itemsize * 8
+        self.bits_per_sample = dtype.itemsize * 8
+
+    @property
+    def paged(self):
+        '''
+        True if frames are read from file as needed instead of being
+        loaded in memory.
+        '''
+        return self._frames is None or self._frames.array is None
+
+    def _open(self):
+        '''
+        Opens the file with tifffile, if it is not open, to read pages
+        from it.
+        '''
+        if self._tif is None:
+            import tifffile
+            self._tif = tifffile.TiffFile(self.filename)
+        return self._tif
+
+    def _read_pages(self, frame_numbers):
+        if self._next_ifd is None:
+            # Without tifffile.
+            return self._read_images(frame_numbers)
+        frame_numbers = list(frame_numbers)
+        # Pages added since the file was opened are not in the series.
+        appended = [frame_number for frame_number in frame_numbers
+                    if frame_number >= self._series_frames]
+        frame_numbers = frame_numbers[:len(frame_numbers) - len(appended)]
+        blocks = []
+        if frame_numbers:
+            frames = self._open().asarray(key=frame_numbers, series=0,
+                                          maxworkers=self.threads)
+            blocks.append(frames.reshape((len(frame_numbers),) +
+                                         self._frame_shape))
+        if appended:
+            blocks.append(self._read_appended(appended))
+        return blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+
+    def _read_appended(self, frame_numbers):
+        '''
+        Reads pages added to the file since it was opened from their
+        offsets, taking the rest from the first page.
+        '''
+        import tifffile
+        tif = self._open_tail(self._file_size)
+        keyframe = tif.pages.first
+        pages = [tifffile.TiffFrame(
+                        tif, frame_number, keyframe=keyframe,
+                        offset=self._appended[frame_number -
+                                              self._series_frames])
+                 for frame_number in frame_numbers]
+        series = tifffile.TiffPageSeries(
+                pages, (len(pages),) + keyframe.shape, keyframe.dtype,
+                'I' + keyframe.axes, parent=tif)
+        frames = tif.asarray(series=series, maxworkers=self.threads)
+        return frames.reshape((len(pages),) + self._frame_shape)
+
+    def _read_images(self, frame_numbers):
+        '''
+        Reads pages with Pillow, one at a time. The file is kept open,
+        as Pillow finds each page from the ones before it.
+        '''
+        if self._image is None:
+            from PIL import Image
+            self._image = Image.open(self.filename)
+        frames = []
+        for frame_number in frame_numbers:
+            self._image.seek(frame_number)
+            frames.append(np.asarray(self._image))
+        return np.stack(frames)
+
+    def _open_tail(self, size):
+        '''
+        Returns the file opened with tifffile to read pages added to
+        it. tifffile does not read beyond the size the file had when it
+        was opened, so it is opened again once the file is larger than
+        `size`; only the first page is read then.
+        '''
+        if self._tail is not None and self._tail.filehandle.size < size:
+            self._tail.close()
+            self._tail = None
+        if self._tail is None:
+            import tifffile
+            self._tail = tifffile.TiffFile(self.filename)
+        return self._tail
+
+    def _get_frame(self, frame_number, step=1):
+        '''
+        Returns frame `frame_number`. If the video is not in memory,
+        the next `block_frames` frames taking one every `step` are read
+        with it.
+        '''
+        # The frames may be released from memory at any time.
+        frames = None if self._frames is None else self._frames.array
+        if frames is not None:
+            return frames[frame_number]
+        if self._block_allocation is None:
+            self._block_allocation = budget.allocate(
+                    os.path.basename(self.filename) + ' (pages)',
+                    self.block_frames * self._frame_bytes,
+                    owner=self, minimum=self._frame_bytes)
+            if self._block_allocation is not None:
+                self.block_frames = (self._block_allocation.size //
+                                     self._frame_bytes)
+            else:
+                self.block_frames = 1
+        if frame_number not in self._block_range:
+            self._block_range = range(
+                    frame_number,
+                    min(frame_number + self.block_frames * step,
+                        self.frame_count),
+                    step)
+            self._block = self._read_pages(self._block_range)
+        return self._block[self._block_range.index(frame_number)]
 
     def seek_frame(self, frame_number=0):
         '''
@@ -176,7 +415,7 @@ class VideoTiff(VideoBase):
             # to that frame before reading data.
             self.seek_frame(frame_number)
         # Read the video frame.
-        img = self._frames[self.pos_frames, :, :]
+        img = self._get_frame(self.pos_frames)
         # After reading the frame shift the pointer one place forward
         # so that the next read will return the next frame in the
         # video.
@@ -194,6 +433,122 @@ class VideoTiff(VideoBase):
         '''
         return self._current_frame / self.fps * 1000
 
+    def iter_frames(self, start=0, stop=None, step=1):
+        if stop is None or stop > self.frame_count:
+            stop = self.frame_count
+        for frame_number in range(start, stop, step):
+            yield frame_number, self._get_frame(frame_number, step)
+
+    def _find_pages(self, size):
+        '''
+        Returns the offsets of the pages added to the file since the
+        last one found, of a file of `size` bytes. Only their image
+        file directories (IFD) are read, not those of the pages found
+        before.
+        '''
+        import tifffile
+        tif = self._open_tail(size)
+        tiff = self._tiff_format
+        offsets = []
+        with open(self.filename, 'rb') as file:
+            while True:
+                file.seek(self._next_ifd)
+                data = file.read(tiff.offsetsize)
+                if len(data) < tiff.offsetsize:
+                    break
+                (offset,) = struct.unpack(tiff.offsetformat, data)
+                if offset == 0 or offset + tiff.tagnosize > size:
+                    break
+                file.seek(offset)
+                (tag_count,) = struct.unpack(tiff.tagnoformat,
+                                             file.read(tiff.tagnosize))
+                next_ifd = offset + tiff.tagnosize + tag_count * tiff.tagsize
+                if (tag_count == 0 or tag_count > 4096 or
+                        next_ifd + tiff.offsetsize > size):
+                    # The IFD is being written; it is read again on the
+                    # next refresh.
+                    break
+                # So is the page if any of its tags or data are not
+                # there yet.
+                try:
+                    page = tifffile.TiffFrame(
+                            tif, self._series_frames + len(offsets),
+                            offset=offset, keyframe=tif.pages.first)
+                except Exception:
+                    break
+                ends = np.add(page.dataoffsets, page.databytecounts)
+                if not all(page.databytecounts) or max(ends) > size:
+                    break
+                offsets.append(offset)
+                self._next_ifd = next_ifd
+        return offsets
+
+    def refresh(self):
+        # Requires tifffile to read the new pages.
+        if self._next_ifd is None:
+            return False
+        size = os.path.getsize(self.filename)
+        growing = size != self._file_size
+        if not growing and self._pages_found == self._frame_count:
+            return False
+        self._file_size = size
+        # N.B. a new list, as clones share this one.
+        self._appended = self._appended + self._find_pages(size)
+        frame_count = self._series_frames + len(self._appended)
+        self._pages_found = frame_count
+        if growing:
+            # The last page may not have been written completely. It
+            # will be read once the file stops growing.
+            frame_count -= 1
+        if frame_count <= self._frame_count:
+            return False
+        # From now on frames are read from file.
+        self._frames = None
+        self._block_range = range(0)
+        self._block = None
+        self._frame_count = frame_count
+        return True
+
+    def clone(self):
+        # Frames in memory are shared, but pages are read from file
+        # with a file handle of its own.
+        video = copy.copy(self)
+        video._tif = None
+        video._tail = None
+        video._image = None
+        video._block_range = range(0)
+        video._block = None
+        video._block_allocation = None
+        return video
+
+    def close(self):
+        for tif in (self._tif, self._tail, self._image):
+            if tif is not None:
+                tif.close()
+        self._tif = None
+        self._tail = None
+        self._image = None
+        if self._block_allocation is not None:
+            self._block_allocation.free()
+        self._frames = None
+        self._block = None
+
+
+class _Frames:
+    '''
+    Frames of a video loaded in memory, as `array`, with an allocation
+    of `size` bytes from the memory budget. The frames are dropped when
+    the memory is needed elsewhere; clones of the video share the
+    frames, so all of them read from file from then on.
+    '''
+    def __init__(self, name, size):
+        self.array = None
+        self.allocation = budget.allocate(name, size, release=self.drop,
+                                          owner=self)
+
+    def drop(self):
+        self.array = None
+
 
 class VideoCv(VideoBase):
     '''
@@ -203,6 +558,7 @@ class VideoCv(VideoBase):
     of that class to provide useful functions to facilitate reading
     frames from videos.
     '''
+    channel_order = 'bgr'
     def __init__(self, filename):
         self.filename = filename
         self.capture = cv2.VideoCapture(filename)
@@ -216,14 +572,38 @@ class VideoCv(VideoBase):
             self._fps = self.capture.get(cv2.CAP_PROP_FPS)
             fourcc = int(self.capture.get(cv2.CAP_PROP_FOURCC))
             self.fourcc = fourcc.to_bytes(4, sys.byteorder).decode()
+            # To tell whether the file has changed; see `refresh`.
+            self._file_size = os.path.getsize(filename)
+            self._opened_size = self._file_size
+            # Where to look for frames added to an AVI file, and the
+            # frames found; None for other formats.
+            self._avi_offset = None
+            self._avi_frames = 0
+            with open(filename, 'rb') as file:
+                header = file.read(12)
+            writing = False
+            if header[:4] == b'RIFF' and header[8:] == b'AVI ':
+                self._avi_offset = len(header)
+                writing = self._frame_count <= 0
+                if writing:
+                    self._frame_count = self._count_avi_frames(
+                            self._file_size)
 
             # Read the first frame to get bit depth information
             frame = self.read()
             self.bits_per_sample = frame.dtype.itemsize * 8
-            self.seek_frame(0)
+            if writing:
+                # Without an index, seeking skips frames.
+                self.capture.release()
+                self.capture = cv2.VideoCapture(filename)
+            else:
+                self.seek_frame(0)
 
     def seek_frame(self, frame_number=0):
-        self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+        # Files being written cannot always be seeked, so reading on
+        # from where the last read ended must not seek.
+        if frame_number != self.pos_frames:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
 
     def seek_time(self, milliseconds=0):
         self.capture.set(cv2.CAP_PROP_POS_MSEC, milliseconds)
@@ -234,6 +614,30 @@ class VideoCv(VideoBase):
         ret_val, img = self.capture.read()
         return img
 
+    def iter_frames(self, start=0, stop=None, step=1):
+        '''
+        Iterates over frames `start` to `stop` (excluded; by default
+        the end of the video) taking one every `step` frames. Yields
+        tuples (frame_number, frame).
+
+        Frames in between those returned are skipped with `grab`, which
+        avoids retrieving and converting them and is more reliable
+        than seeking in compressed videos.
+        '''
+        if stop is None or stop > self.frame_count:
+            stop = self.frame_count
+        self.seek_frame(start)
+        for frame_number in range(start, stop, step):
+            ret_val, img = self.capture.read()
+            if ret_val is False:
+                # The frame count reported by some containers is only
+                # an estimate.
+                break
+            yield frame_number, img
+            for _ in range(step - 1):
+                if not self.grab():
+                    return
+
     # def _on_trackbar(self, frame_number):
     #     self.seek_frame(frame_number)
     #     ret_val, frame = self.read()
@@ -260,12 +664,575 @@ class VideoCv(VideoBase):
     def pos_ms(self):
         return self.capture.get(cv2.CAP_PROP_POS_MSEC)
 
+    def grab(self):
+        return self.capture.grab()
+
+    def _count_avi_frames(self, size):
+        '''
+        Returns the number of frames written completely to an AVI file
+        of `size` bytes. The AVI header only has the number of frames
+        once the file is closed, so the chunks of the frames are
+        counted instead, from the last one found. A frame being written
+        is not counted: it cannot be decoded yet, and reading it would
+        also spoil the frames after it.
+        '''
+        with open(self.filename, 'rb') as file:
+            while True:
+                file.seek(self._avi_offset)
+                header = file.read(12)
+                if len(header) < 8:
+                    break
+                (chunk_id, chunk_size) = struct.unpack('<4sI', header[:8])
+                if chunk_id in (b'RIFF', b'LIST') and len(header) < 12:
+                    break
+                if (chunk_id == b'RIFF' or
+                        chunk_id == b'LIST' and header[8:] == b'movi'):
+                    # The list of frames (or, in files larger than
+                    # 1 GB, a new part of the file); its size is only
+                    # saved once it is complete.
+                    self._avi_offset += 12
+                    continue
+                end = self._avi_offset + 8 + chunk_size
+                if end > size:
+                    break
+                # Video frames ('00dc', or '00db' if not compressed);
+                # other chunks are headers, indices, audio...
+                if chunk_id != b'LIST' and chunk_id[2:] in (b'dc', b'db'):
+                    self._avi_frames += 1
+                # Chunks are aligned to 2 bytes.
+                self._avi_offset = end + chunk_size % 2
+        return self._avi_frames
+
+    def refresh(self):
+        '''
+        Updates the number of frames. That of AVI files is that of the
+        frames written completely, which are read with the capture in
+        use. Other containers have it in their header, which some of
+        them only save when the file is closed.
+
+        A capture does not see frames added to those files after it
+        was opened, so the file is opened again, but only once it has
+        changed and stopped growing; until then the capture in use is
+        kept.
+        '''
+        size = os.path.getsize(self.filename)
+        growing = size != self._file_size
+        self._file_size = size
+        if self._avi_offset is not None:
+            frame_count = self._count_avi_frames(size)
+            if frame_count <= self._frame_count:
+                return False
+            self._frame_count = frame_count
+            return True
+        if growing or size == self._opened_size:
+            return False
+        self._opened_size = size
+        capture = cv2.VideoCapture(self.filename)
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_count <= self.frame_count:
+            capture.release()
+            return False
+        self.capture.release()
+        self.capture = capture
+        self._frame_count = frame_count
+        return True
+
+    def clone(self):
+        video = VideoCv(self.filename)
+        video.fps = self.fps
+        return video
+
     def close(self):
         self.capture.release()
 
 
-def Video(filename):
-    if os.path.splitext(filename)[-1] in (".tif", ".tiff"):
-        return VideoTiff(filename)
+class VideoBinned(VideoBase):
+    '''
+    A video with frames reduced in size by averaging blocks of
+    `binning` x `binning` pixels.
+
+    This class wraps any of the other video classes. Binning is done
+    once per frame with cv2.resize (INTER_AREA), which keeps the data
+    type of the frames. Width and height are those of the binned
+    frames; pixels left over at the right and bottom edges when the
+    size of the video is not a multiple of `binning` are dropped.
+    '''
+    def __init__(self, video, binning):
+        if binning < 1:
+            raise ValueError("binning must be 1 or greater")
+        super().__init__(video.filename)
+        self.video = video
+        # The size of the blocks binned by this class and, since the
+        # video wrapped could be binned already, the total binning
+        # relative to the video file.
+        self.factor = binning
+        self.binning = video.binning * binning
+        self._width = video.width // binning
+        self._height = video.height // binning
+        self._frame_count = video.frame_count
+        self.bits_per_sample = video.bits_per_sample
+        self.fourcc = video.fourcc
+        self.channel_order = video.channel_order
+
+    @property
+    def fps(self):
+        return self.video.fps
+
+    @fps.setter
+    def fps(self, value):
+        self.video.fps = value
+
+    def bin_frame(self, frame):
+        '''
+        Returns `frame`, as read from the wrapped video, binned.
+        '''
+        if frame is None or self.factor == 1:
+            return frame
+        frame = frame[:self.height * self.factor,
+                      :self.width * self.factor]
+        return cv2.resize(frame, (self.width, self.height),
+                          interpolation=cv2.INTER_AREA)
+
+    def seek_frame(self, frame_number=0):
+        self.video.seek_frame(frame_number)
+
+    def seek_time(self, milliseconds=0):
+        self.video.seek_time(milliseconds)
+
+    def read(self, frame_number=None):
+        return self.bin_frame(self.video.read(frame_number))
+
+    def iter_frames(self, start=0, stop=None, step=1):
+        for (frame_number, frame) in self.video.iter_frames(
+                start, stop, step):
+            yield frame_number, self.bin_frame(frame)
+
+    @property
+    def pos_frames(self):
+        return self.video.pos_frames
+
+    @property
+    def pos_ms(self):
+        return self.video.pos_ms
+
+    def grab(self):
+        return self.video.grab()
+
+    def refresh(self):
+        if not self.video.refresh():
+            return False
+        self._frame_count = self.video.frame_count
+        return True
+
+    def clone(self):
+        return VideoBinned(self.video.clone(), self.factor)
+
+    def close(self):
+        self.video.close()
+
+
+class VideoStore(VideoBase):
+    '''
+    A class for reading videos saved with `transcode`.
+
+    The video is a directory with a `header.json` file (frame size,
+    data type, frame rate, etc.), a `timestamps.npy` file and the
+    frames, uncompressed, in .npy files of `chunk_frames` frames each.
+    The chunks are memory-mapped, so reading a frame is just a matter
+    of reading it from disk (or from memory, if it was read recently)
+    and any number of processes reading the same video share the same
+    pages.
+    '''
+    HEADER = 'header.json'
+    TIMESTAMPS = 'timestamps.npy'
+    CHUNK = 'chunk_{:05d}.npy'
+
+    def __init__(self, filename):
+        # The header can be given instead of the directory, e.g. from a
+        # file dialog.
+        if os.path.basename(filename) == self.HEADER:
+            filename = os.path.dirname(filename)
+        super().__init__(filename)
+        with open(os.path.join(filename, self.HEADER)) as file:
+            self.header = json.load(file)
+        self._frame_count = self.header['frame_count']
+        self._height = self.header['height']
+        self._width = self.header['width']
+        self._fps = self.header['fps']
+        self.dtype = np.dtype(self.header['dtype'])
+        self.bits_per_sample = self.dtype.itemsize * 8
+        self.binning = self.header.get('binning', 1)
+        self.fourcc = self.header.get('fourcc')
+        self.channel_order = self.header.get('channel_order', 'rgb')
+        self.chunk_frames = self.header['chunk_frames']
+        self.timestamps = np.load(os.path.join(filename, self.TIMESTAMPS))
+        # Chunks are mapped when first needed.
+        self._chunks = {}
+
+    def _chunk(self, chunk_number):
+        if chunk_number not in self._chunks:
+            self._chunks[chunk_number] = np.load(
+                    os.path.join(self.filename,
+                                 self.CHUNK.format(chunk_number)),
+                    mmap_mode='r')
+        return self._chunks[chunk_number]
+
+    def seek_frame(self, frame_number=0):
+        if frame_number >= self.frame_count:
+            frame_number = self.frame_count - 1
+        self._current_frame = frame_number
+
+    def seek_time(self, milliseconds=0):
+        '''
+        Moves the pointer to the last frame at or before
+        `milliseconds`.
+        '''
+        frame = np.searchsorted(self.timestamps, milliseconds / 1000,
+                                side='right') - 1
+        self.seek_frame(max(int(frame), 0))
+
+    def read(self, frame_number=None):
+        if frame_number is not None:
+            self.seek_frame(frame_number)
+        (chunk_number, index) = divmod(self.pos_frames, self.chunk_frames)
+        img = np.asarray(self._chunk(chunk_number)[index])
+        self.seek_frame(self.pos_frames + 1)
+        return img
+
+    @property
+    def pos_frames(self):
+        return self._current_frame
+
+    @property
+    def pos_ms(self):
+        return self.timestamps[self._current_frame] * 1000
+
+
+class VideoSequence(VideoBase):
+    '''
+    A class for reading a sequence of images, one per frame, as saved
+    by some cameras into a directory.
+
+    All the images in directory `filename` are used, or only those that
+    match `pattern` (e.g. 'frame_*.png'). They are sorted by name, with
+    numbers compared by value (i.e. 'frame_2' goes before 'frame_10').
+
+    Images are read with cv2.imread on a pool of `threads` threads. When
+    a frame is read, the next `prefetch` ones are read in the
+    background, so that going through the video is about as fast as all
+    the threads together. Only those frames are kept in memory, and
+    fewer are read ahead if the memory budget (see memory.py) does not
+    have room for them.
+    '''
+    EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp')
+    channel_order = 'bgr'
+
+    def __init__(self, filename, pattern=None, fps=None, prefetch=16,
+                 threads=None):
+        super().__init__(os.path.normpath(filename))
+        self.pattern = pattern
+        self.prefetch = prefetch
+        self.threads = threads
+        self.files = self._list_files()
+        # The images found last time; see `refresh`.
+        self._listed = self.files
+        if not self.files:
+            raise FileNotFoundError(
+                    "No images found in {}".format(self.filename))
+        self._pool = ThreadPoolExecutor(threads)
+        # Frames being read, or read already, by frame number.
+        self._pending = {}
+
+        frame = self._load(self.files[0])
+        self._height, self._width = frame.shape[:2]
+        self._frame_count = len(self.files)
+        # Frames read ahead, within the memory budget.
+        self._allocation = budget.allocate(
+                os.path.basename(self.filename) + ' (read ahead)',
+                prefetch * frame.nbytes, owner=self,
+                minimum=frame.nbytes)
+        if self._allocation is not None:
+            self._ahead = max(1, self._allocation.size // frame.nbytes)
+        else:
+            self._ahead = 1
+        if fps is None:
+            warnings.warn("FPS is not defined, defaulting to 1.")
+            fps = 1
+        self._fps = fps
+        self.bits_per_sample = frame.dtype.itemsize * 8
+
+    def _list_files(self):
+        if self.pattern is None:
+            names = [name for name in os.listdir(self.filename)
+                     if os.path.splitext(name)[-1].lower() in
+                     self.EXTENSIONS]
+        else:
+            names = fnmatch.filter(os.listdir(self.filename),
+                                   self.pattern)
+        names.sort(key=natural_key)
+        return [os.path.join(self.filename, name) for name in names]
+
+    @staticmethod
+    def _load(filename):
+        return cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+
+    def _fetch(self, frame_number, step=1):
+        '''
+        Returns frame `frame_number`, and starts reading the next
+        `prefetch` frames (or as many as there is memory for) taking one
+        every `step`.
+        '''
+        ahead = range(frame_number,
+                      min(frame_number + self._ahead * step,
+                          self.frame_count),
+                      step)
+        # Frames that are not ahead anymore (e.g. after seeking) are
+        # dropped.
+        for number in list(self._pending):
+            if number not in ahead:
+                self._pending.pop(number).cancel()
+        for number in ahead:
+            if number not in self._pending:
+                self._pending[number] = self._pool.submit(
+                        self._load, self.files[number])
+        return self._pending.pop(frame_number).result()
+
+    def seek_frame(self, frame_number=0):
+        if frame_number >= self.frame_count:
+            frame_number = self.frame_count - 1
+        self._current_frame = frame_number
+
+    def seek_time(self, milliseconds=0):
+        seconds = milliseconds/1000
+        frame = round(seconds * self.fps)
+        self.seek_frame(frame)
+
+    def read(self, frame_number=None):
+        if frame_number is not None:
+            self.seek_frame(frame_number)
+        img = self._fetch(self.pos_frames)
+        self.seek_frame(self.pos_frames + 1)
+        return img
+
+    def iter_frames(self, start=0, stop=None, step=1):
+        if stop is None or stop > self.frame_count:
+            stop = self.frame_count
+        for frame_number in range(start, stop, step):
+            yield frame_number, self._fetch(frame_number, step)
+
+    @property
+    def pos_frames(self):
+        return self._current_frame
+
+    @property
+    def pos_ms(self):
+        return self._current_frame / self.fps * 1000
+
+    def refresh(self):
+        files = self._list_files()
+        if files != self._listed:
+            # The last image may not have been written completely. It
+            # will be read once no more images are added.
+            self._listed = files
+            files = files[:-1]
+        if len(files) <= self.frame_count:
+            return False
+        self.files = files
+        self._frame_count = len(files)
+        return True
+
+    def clone(self):
+        # Each object has its own threads and frames.
+        return VideoSequence(self.filename, self.pattern, self.fps,
+                             self.prefetch, self.threads)
+
+    def close(self):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self._pool.shutdown(wait=False)
+        if self._allocation is not None:
+            self._allocation.free()
+
+
+def natural_key(name):
+    '''
+    Key to sort strings with the numbers in them compared by value.
+    '''
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', name)]
+
+
+def transcode(video, dirname, chunk_size=2**28, progress=None):
+    '''
+    Saves all the frames of `video` as a VideoStore in directory
+    `dirname`, which is created if needed. Frames are saved as they are
+    read, e.g. binned if `video` is a VideoBinned.
+
+    Frames are grouped in chunks of about `chunk_size` bytes, or
+    smaller if the memory budget (see memory.py) has no room for them.
+    `progress` is as in `measure.measure`; if the transcoding is
+    cancelled the video is not usable.
+
+    Returns the VideoStore.
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    # A directory without header is not a valid video, which is what
+    # is left if transcoding is interrupted.
+    header_filename = os.path.join(dirname, VideoStore.HEADER)
+    if os.path.exists(header_filename):
+        os.remove(header_filename)
+
+    chunk = None
+    chunk_number = 0
+    timestamps = []
+    allocation = None
+    try:
+        for (frame_number, frame) in video.iter_frames():
+            if chunk is None:
+                allocation = budget.allocate(
+                        'Transcoding ' + os.path.basename(video.filename),
+                        max(chunk_size, frame.nbytes),
+                        minimum=frame.nbytes)
+                if allocation is None:
+                    raise MemoryError("Not enough memory to transcode")
+                chunk_frames = allocation.size // frame.nbytes
+                chunk = np.empty((chunk_frames,) + frame.shape,
+                                 frame.dtype)
+            index = frame_number % chunk_frames
+            chunk[index] = frame
+            timestamps.append(frame_number / video.fps)
+            if index == chunk_frames - 1:
+                np.save(os.path.join(
+                            dirname, VideoStore.CHUNK.format(chunk_number)),
+                        chunk)
+                chunk_number += 1
+            if progress is not None:
+                if progress(frame_number + 1, video.frame_count):
+                    return None
+        if chunk is None:
+            raise ValueError("No frames could be read from the video")
+        # The last chunk may not be full. Also, the frame count
+        # reported by some containers is only an estimate, so it is
+        # taken from the frames actually read.
+        frame_count = len(timestamps)
+        if frame_count % chunk_frames:
+            np.save(os.path.join(dirname,
+                                 VideoStore.CHUNK.format(chunk_number)),
+                    chunk[:frame_count % chunk_frames])
+    finally:
+        if allocation is not None:
+            allocation.free()
+    np.save(os.path.join(dirname, VideoStore.TIMESTAMPS),
+            np.array(timestamps))
+
+    # A store made from another one keeps the name of the original
+    # video; see `companion_name`.
+    source = os.path.basename(video.filename)
+    if is_store(video.filename):
+        source = _store_source(video.filename) or source
+    header = dict(source=source,
+                  frame_count=frame_count, height=chunk.shape[1],
+                  width=chunk.shape[2], shape=chunk.shape[1:],
+                  dtype=chunk.dtype.str, fps=video.fps,
+                  binning=video.binning, fourcc=video.fourcc,
+                  channel_order=video.channel_order,
+                  chunk_frames=chunk_frames)
+    with open(header_filename, 'w') as file:
+        json.dump(header, file, indent=2)
+    return VideoStore(dirname)
+
+
+def store_dirname(filename):
+    '''
+    Returns the default name of the VideoStore of video `filename`.
+    '''
+    return os.path.splitext(filename)[0] + '_frames'
+
+
+def is_store(filename):
+    return (os.path.basename(filename) == VideoStore.HEADER or
+            os.path.exists(os.path.join(filename, VideoStore.HEADER)))
+
+
+def _store_dirname(filename):
+    # The header can be given instead of the directory.
+    if os.path.basename(filename) == VideoStore.HEADER:
+        filename = os.path.dirname(filename)
+    return os.path.normpath(filename)
+
+
+def _store_source(filename):
+    '''
+    Returns the name of the video that the VideoStore `filename` was
+    made from, as saved in its header, or None if not known.
+    '''
+    header_filename = os.path.join(_store_dirname(filename),
+                                   VideoStore.HEADER)
+    with open(header_filename) as file:
+        return json.load(file).get('source')
+
+
+def companion_name(filename):
+    '''
+    Returns the name, without suffix or extension, of the files that go
+    with video `filename`: its ROIs ([name]_ROIs.tsv), the intensity
+    measured ([name].tsv), etc. That is the name of the video without
+    extension; for a VideoStore, that of the video it was made from,
+    in the directory where the store is, so that both share the same
+    files.
+    '''
+    if is_store(filename):
+        source = _store_source(filename)
+        if source:
+            return os.path.join(
+                    os.path.dirname(_store_dirname(filename)),
+                    os.path.splitext(source)[0])
+    return os.path.splitext(filename)[0]
+
+
+def Video(filename, binning=1):
+    if is_store(filename):
+        video = VideoStore(filename)
+    elif os.path.isdir(filename):
+        video = VideoSequence(filename)
+    elif (not os.path.isfile(filename) and
+            any(char in os.path.basename(filename) for char in '*?[')):
+        # A pattern matching the images of a sequence (files can also
+        # have these characters in their names, e.g. 'trial[1].tif').
+        video = VideoSequence(*os.path.split(filename))
+    elif os.path.splitext(filename)[-1] in (".tif", ".tiff"):
+        video = VideoTiff(filename)
     else:
-        return VideoCv(filename)
+        video = VideoCv(filename)
+    if binning > 1:
+        video = VideoBinned(video, binning)
+    return video
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description=('Convert a video into a directory of ' +
+                         'uncompressed, memory-mapped frames, which ' +
+                         'is much faster to read and seek'))
+    parser.add_argument(
+            'filename', type=str, help='Video file')
+    parser.add_argument(
+            'output', nargs='?', type=str, default=None,
+            help='Output directory (default: [filename]_frames)')
+    parser.add_argument(
+            '--binning', type=int, default=1,
+            help='Bin frames BINNING x BINNING pixels')
+    parser.add_argument(
+            '--chunk-size', type=int, default=256,
+            help='Size of the files the frames are saved in (MB)')
+    args = parser.parse_args()
+
+    if args.output is None:
+        args.output = store_dirname(args.filename)
+    video = Video(args.filename, binning=args.binning)
+    store = transcode(video, args.output, args.chunk_size * 2**20)
+    print('{}: {} frames, {} x {}'.format(
+        args.output, store.frame_count, store.width, store.height))
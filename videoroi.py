@@ -19,21 +19,91 @@
 # along with videoroi. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import queue
+import time
 
+import cv2
 from PyQt5.QtWidgets import (QMainWindow, QWidget, QApplication,
                              QFileDialog, QLabel)
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import (Qt, QRectF, QThread, QTimer, pyqtSignal,
+                          pyqtSlot)
 from PyQt5 import QtGui
 import pyqtgraph as pg
 import numpy as np
-import pandas as pd
-import cv2
 
 from ui.ui_main import Ui_MainWindow
-from video import Video
+from video import Video, VideoBinned, companion_name
+from measure import (CHANNELS, EllipseRoi, LabelImage, Measurement,
+                     load_rois, save_rois, gray, measure, select_measure,
+                     save_intensity)
+from motion import get_shifts
+from projection import get_summaries, sample_levels
+import memory
+import daemon
 
 ROI_PEN = (3, 9)
 OUT_TABLE_FMT = 'long' # long | wide
+# With 'labels' the ROIs are rasterised into a label image before they
+# are measured, which is much faster when there are many ROIs, but
+# where ROIs overlap the shared pixels are counted only once.
+MEASURE_METHOD = 'mask' # mask | labels
+# Passed on to `measure.measure`: measure one every `step` frames,
+# average every `bin_size` measurements, if `dff_window` (s) is not
+# None calculate also ΔF/F, measure also `statistics` of the pixels of
+# each ROI (see measure.STATISTICS) and, if `neuropil_factor` is not
+# None, the neuropil around each ROI, and subtract that fraction of it
+# from the intensity. With `channels`, e.g. ('red', 'green'), those
+# channels of colour videos are measured separately instead of gray.
+# With `workers` greater than 1 (or None, one per core), frames are
+# measured in that many processes; not used by Follow.
+MEASURE_OPTIONS = dict(step=1, bin_size=1, dff_window=None,
+                       dff_percentile=8, statistics=(),
+                       neuropil_factor=None, channels=None, workers=1)
+# Address of a running measurement daemon (see daemon.py; '' for the
+# default address) to measure there instead of in this window, or None.
+MEASURE_DAEMON = None
+# Names displayed for each measure.
+MEASURE_LABELS = {'intensity': 'Intensity', 'dff': 'ΔF/F',
+                  'neuropil': 'Neuropil', 'corrected': 'Corrected intensity',
+                  'std': 'Standard deviation', 'median': 'Median',
+                  'min': 'Minimum', 'max': 'Maximum',
+                  'saturated': 'Saturated pixels', 'area': 'Area'}
+# With Follow, the video is checked for new frames every FOLLOW_INTERVAL
+# ms, and at most FOLLOW_CHUNK frames are measured each time so that
+# the window stays responsive.
+FOLLOW_INTERVAL = 200
+FOLLOW_CHUNK = 50
+# Playback speed relative to the video's frame rate, and number of
+# frames read ahead of the one displayed during playback.
+PLAYBACK_SPEED = 1.0
+PLAYBACK_BUFFER = 8
+# Names displayed for each projection.
+PROJECTION_LABELS = {'mean': 'Mean', 'max': 'Maximum',
+                     'std': 'Standard deviation'}
+# Number of frames, taken at regular intervals across the video, from
+# which the Auto level display range is calculated, and percentile of
+# their pixel values used as the top of that range.
+AUTO_LEVEL_SAMPLES = 20
+AUTO_LEVEL_PERCENTILE = 99.9
+# The overview above the scrollbar shows the mean intensity of every
+# frame over a strip of thumbnails. Up to OVERVIEW_THUMBNAILS thumbnails,
+# OVERVIEW_THUMBNAIL_WIDTH pixels wide, are taken at regular intervals
+# in the same pass as the projections; while the scrollbar is dragged
+# the nearest one is displayed instead of reading frames.
+OVERVIEW_THUMBNAILS = 500
+OVERVIEW_THUMBNAIL_WIDTH = 64
+# Bin frames SPATIAL_BINNING x SPATIAL_BINNING pixels for display and
+# measurement; much faster for large videos but less precise. ROI files
+# are always saved and loaded in full size coordinates.
+SPATIAL_BINNING = 1
+# Correct for (rigid) motion before measuring. Shifts are estimated once
+# and saved as [filename]_shifts.tsv; frames are binned MOTION_BINNING x
+# MOTION_BINNING pixels to estimate them.
+MOTION_CORRECTION = False
+MOTION_BINNING = 1
+# Memory (bytes) that videos loaded in memory, frames read ahead and
+# projections may take altogether; None for the default of memory.py.
+MEMORY_BUDGET = None
 
 
 def fmt_frame_to_time(frame, fps):
@@ -43,6 +113,53 @@ def fmt_frame_to_time(frame, fps):
     return '{:02}:{:05.2f}'.format(int(minutes), seconds)
 
 
+def measure_label(name):
+    '''
+    Returns the name displayed for a measure, including those split by
+    channel (e.g. 'red' or 'dff_red').
+    '''
+    if name in MEASURE_LABELS:
+        return MEASURE_LABELS[name]
+    (measure, _, channel) = name.rpartition('_')
+    if channel in CHANNELS.values():
+        if not measure:
+            return 'Intensity ({})'.format(channel)
+        return '{} ({})'.format(MEASURE_LABELS.get(measure, measure),
+                                channel)
+    return name
+
+
+class DisplayLut:
+    '''
+    Lookup table that maps the values of 8 and 16 bit images to 8 bit
+    display values, with `levels` (low, high) mapped to black and
+    white.
+
+    Applying a table is much faster than having pyqtgraph scale every
+    frame as floats, and the table is only rebuilt when the levels or
+    the data type change.
+    '''
+    def __init__(self):
+        self._key = None
+        self._table = None
+
+    @staticmethod
+    def supports(image):
+        return image.dtype.kind == 'u' and image.itemsize <= 2
+
+    def apply(self, image, levels):
+        key = (image.dtype, tuple(levels))
+        if key != self._key:
+            (low, high) = levels
+            values = np.arange(np.iinfo(image.dtype).max + 1,
+                               dtype=np.float32)
+            scale = 255 / max(high - low, 1)
+            self._table = np.clip((values - low) * scale, 0, 255
+                                  ).astype(np.uint8)
+            self._key = key
+        return np.take(self._table, image)
+
+
 class Roi(pg.EllipseROI):
     '''
     A labelled ROI.
@@ -106,20 +223,155 @@ class Roi(pg.EllipseROI):
         else:
             super().mouseClickEvent(event)
 
+    def geometry(self):
+        '''
+        Returns the ROI as an EllipseRoi, i.e. its name and shape
+        without any of the graphics.
+        '''
+        return EllipseRoi(self.objectName(),
+                          (self.pos().x(), self.pos().y()),
+                          (self.size().x(), self.size().y()),
+                          self.angle())
+
+
+class ProjectionThread(QThread):
+    '''
+    Samples the display range for Auto level, and then calculates (or
+    loads) the projections and the overview of a video in the
+    background, in a single pass over the video.
+
+    The thread reads the video through an object of its own, so that
+    it does not interfere with the frames displayed by the main
+    window.
+    '''
+    levels = pyqtSignal(object)
+    progress = pyqtSignal(int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, video, parent=None):
+        super().__init__(parent)
+        self.video = video.clone()
+        self._percent = -1
+
+    def run(self):
+        try:
+            # Sampling reads frames from across the video, which is
+            # slow for compressed videos; here opening it does not
+            # wait for that.
+            self.levels.emit(sample_levels(
+                    self.video, AUTO_LEVEL_SAMPLES, AUTO_LEVEL_PERCENTILE))
+            if self.isInterruptionRequested():
+                return
+            summaries = get_summaries(
+                    self.video, progress=self.update_progress,
+                    thumbnail_count=OVERVIEW_THUMBNAILS,
+                    thumbnail_width=OVERVIEW_THUMBNAIL_WIDTH)
+        except MemoryError as error:
+            self.failed.emit(str(error))
+            return
+        finally:
+            self.video.close()
+        if summaries is not None:
+            self.done.emit(summaries)
+
+    def update_progress(self, frames_done, frame_count):
+        # Only emit a signal when the percentage changes, not for every
+        # frame.
+        percent = 100 * frames_done // frame_count
+        if percent != self._percent:
+            self._percent = percent
+            self.progress.emit(percent)
+        return self.isInterruptionRequested()
+
+
+class PlaybackThread(QThread):
+    '''
+    Reads frames ahead of the one displayed during playback.
+
+    Frames are put in `frames`, a queue of at most PLAYBACK_BUFFER
+    (frame_number, frame) items, or fewer if the memory budget has no
+    room for them. The main window sets `target` to the
+    frame that should be displayed at each moment; if reading falls
+    behind it, the frames in between are skipped without decoding
+    them (or with a seek if the gap is large), so that playback stays
+    in time.
+    '''
+    def __init__(self, video, start, parent=None):
+        super().__init__(parent)
+        self.video = video.clone()
+        self.start_frame = start
+        self.target = start
+        # Frames are converted to gray before they are queued.
+        frame_bytes = (video.width * video.height *
+                       -(-video.bits_per_sample // 8))
+        self.allocation = memory.budget.allocate(
+                'Playback', PLAYBACK_BUFFER * frame_bytes, owner=self,
+                minimum=frame_bytes)
+        size = 1
+        if self.allocation is not None:
+            size = max(1, self.allocation.size // frame_bytes)
+        self.frames = queue.Queue(maxsize=size)
+
+    def run(self):
+        frame_number = self.start_frame
+        self.video.seek_frame(frame_number)
+        while not self.isInterruptionRequested():
+            if frame_number >= self.video.frame_count:
+                break
+            target = self.target
+            if target - frame_number > self.video.fps:
+                self.video.seek_frame(target)
+                frame_number = target
+            while frame_number < target:
+                if not self.video.grab():
+                    break
+                frame_number += 1
+            frame = self.video.read()
+            if frame is None:
+                break
+            frame = gray(frame)
+            # Wait for space in the queue, but keep checking whether
+            # playback has been stopped.
+            while not self.isInterruptionRequested():
+                try:
+                    self.frames.put((frame_number, frame), timeout=0.05)
+                    break
+                except queue.Full:
+                    pass
+            frame_number += 1
+        self.video.close()
+        if self.allocation is not None:
+            self.allocation.free()
+
 
 class MainWindow(QMainWindow, Ui_MainWindow):
 
     def __init__(self, parent=None):
         QWidget.__init__(self, parent)
         self.setupUi(self)
+        if MEMORY_BUDGET is not None:
+            memory.budget.limit = MEMORY_BUDGET
 
         self.video = None
         self.intensity = None
+        self.projections = None
+        self.overview = None
+        self.projection_thread = None
+        self.playback_thread = None
+        self.playback_timer = QTimer(self)
+        self.playback_timer.timeout.connect(self.on_playback_timeout)
+        self.measurement = None
+        self.follow_timer = QTimer(self)
+        self.follow_timer.timeout.connect(self.on_follow_timeout)
+        self.plot_window = None
+        self.plot_curves = {}
         self.working_dir = os.path.expanduser('~')
 
         self.fluorescence_box.setDisabled(True)
         self.roi_box.setDisabled(True)
         self._init_image_item()
+        self._init_overview()
         self._init_statusbar()
         self._roi_counter = 0
 
@@ -131,8 +383,32 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.view_box.invertY(True)
         self.view_box.setAspectLocked(True)
 
-        self.img_item = pg.ImageItem()
+        # Frames are passed in their own (row-major) order rather
+        # than transposed.
+        self.img_item = pg.ImageItem(axisOrder='row-major')
         self.view_box.addItem(self.img_item)
+        self.display_lut = DisplayLut()
+
+    def _init_overview(self):
+        self.overview_plot = self.overview_view.addPlot()
+        self.overview_plot.hideAxis('left')
+        self.overview_plot.hideAxis('bottom')
+        self.overview_plot.hideButtons()
+        self.overview_plot.setMenuEnabled(False)
+        self.overview_plot.setMouseEnabled(x=False, y=False)
+        self.overview_view.ci.layout.setContentsMargins(0, 0, 0, 0)
+        # Thumbnails behind the mean intensity curve, and a line at the
+        # frame displayed.
+        self.overview_strip = pg.ImageItem(axisOrder='row-major')
+        self.overview_strip.setOpacity(0.5)
+        self.overview_plot.addItem(self.overview_strip)
+        self.overview_curve = self.overview_plot.plot(pen='y')
+        self.overview_line = pg.InfiniteLine(angle=90,
+                                            pen=pg.mkPen('r', width=2))
+        self.overview_line.hide()
+        self.overview_plot.addItem(self.overview_line)
+        self.overview_view.scene().sigMouseClicked.connect(
+            self.on_overview_clicked)
 
     def _init_statusbar(self):
         self.statusbar_left = QLabel()
@@ -152,17 +428,28 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         info_text = ('Framerate: {} fps | ' +
                      'Codec: {} | ' +
                      'Dimensions: {} x {}')
-        self.statusbar_left.setText(info_text.format(
+        info_text = info_text.format(
             self.video.fps,
             self.video.fourcc,
             self.video.width,
-            self.video.height))
+            self.video.height)
+        if self.video.binning > 1:
+            info_text += ' (binned {0} x {0})'.format(self.video.binning)
+        self.statusbar_left.setText(info_text)
+        self.show_memory()
         self.left_label.setText('00:00.00')
         self.centre_label.setText('Frame 0/{}'.format(
             self.max_frame))
         self.right_label.setText('-' + fmt_frame_to_time(
             self.max_frame, self.video.fps))
 
+    def show_memory(self):
+        '''
+        Shows the memory taken from the memory budget, and by what, as
+        the tooltip of the status bar.
+        '''
+        self.statusbar_left.setToolTip(memory.budget.report())
+
     def reset(self):
         self.statusbar_left.setText("")
         self.left_label.setText('00:00.00')
@@ -173,6 +460,13 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.roi_box.setDisabled(True)
         self.display_box.setDisabled(True)
 
+        self.stop_playback()
+        self.stop_follow()
+        self.stop_projections()
+        self.display_combo.setCurrentIndex(0)
+        while self.display_combo.count() > 1:
+            self.display_combo.removeItem(1)
+
         if self.video is not None:
             self.video.close()
             self.clear_rois()
@@ -184,39 +478,99 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def on_scrollbar_valueChanged(self):
         if self.video is None:
             return
+        # During playback the scrollbar is updated with its signals
+        # blocked, so this is the user moving it.
+        self.stop_playback()
+        # Moving the scrollbar goes back to displaying video frames.
+        if self.display_combo.currentIndex() != 0:
+            self.display_combo.blockSignals(True)
+            self.display_combo.setCurrentIndex(0)
+            self.display_combo.blockSignals(False)
         frame_number = self.scrollbar.value()
+        # While the scrollbar is dragged, show thumbnails rather than
+        # reading frames from anywhere in the video.
+        if self.scrollbar.isSliderDown() and self.display_thumbnail(
+                frame_number):
+            return
         self.display_video_frame(frame_number)
 
+    def on_scrollbar_sliderReleased(self):
+        if self.video is None:
+            return
+        if self.display_combo.currentIndex() == 0:
+            self.display_video_frame(self.scrollbar.value())
+
     # Display video ---------------------------------------------------
 
     def get_video_frame(self, frame_number):
-        frame = self.video.read(frame_number)
+        return self.prepare_frame(self.video.read(frame_number))
+
+    def prepare_frame(self, frame):
         # If the video has 3 dimensions it is assumed to be RGB;
         # convert to gray.
-        if frame.ndim == 3:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame = frame.astype('float')  # pg crashes if a uint is passed
-        frame = frame.T  # because pg rotates images by 90 deg.
+        frame = gray(frame)
+        return frame, self.get_levels()
+
+    def get_levels(self):
         if self.autoLevel_button.isChecked():
-            # If Auto level is selected, set the image display range to
-            # the maximum value in that frame.
-            levels = (0.0, frame.max())
+            # If Auto level is selected, the image display range is
+            # that of the whole video, sampled when it was opened.
+            return self.auto_levels
         else:
             # If no Auto level, then the image is displayed in its full
             # bit-depth range
-            levels = (0.0, float(2**self.video.bits_per_sample) - 1)
-        return frame, levels
+            return (0.0, float(2**self.video.bits_per_sample) - 1)
 
-    def display_video_frame(self, frame_number):
+    def set_image(self, image, levels):
+        '''
+        Displays `image` in the range given by `levels`. 8 and 16 bit
+        images are scaled with a lookup table; other types (e.g.
+        floats) are left to pyqtgraph.
+        '''
+        if DisplayLut.supports(image):
+            image = self.display_lut.apply(image, levels)
+            levels = (0, 255)
+        self.img_item.setImage(image, levels=levels)
+
+    def display_video_frame(self, frame_number, frame=None):
+        '''
+        Displays frame `frame_number`. The frame is read from the video
+        unless it is given (e.g. read already by the playback thread).
+        '''
         if frame_number < self.video.frame_count:
-            self.frame, self.levels = self.get_video_frame(frame_number)
-            self.img_item.setImage(self.frame, levels=self.levels)
-            self.centre_label.setText("{}/{}".format(frame_number,
-                                                     self.max_frame))
-            self.left_label.setText(fmt_frame_to_time(
-                frame_number, self.video.fps))
-            self.right_label.setText('-' + fmt_frame_to_time(
-                self.max_frame - frame_number, self.video.fps))
+            if frame is None:
+                self.frame, self.levels = self.get_video_frame(
+                    frame_number)
+            else:
+                self.frame, self.levels = self.prepare_frame(frame)
+            self.set_image(self.frame, self.levels)
+            self.show_frame_number(frame_number)
+
+    def display_thumbnail(self, frame_number):
+        '''
+        Displays the thumbnail of the overview nearest to frame
+        `frame_number`, scaled to the size of the frames. Returns False
+        if there are no thumbnails.
+        '''
+        if self.overview is None:
+            return False
+        thumbnail = self.overview.thumbnail(frame_number)
+        if thumbnail is None or frame_number >= self.video.frame_count:
+            return False
+        image = cv2.resize(thumbnail, (self.video.width, self.video.height),
+                           interpolation=cv2.INTER_LINEAR)
+        self.set_image(image, self.get_levels())
+        self.show_frame_number(frame_number)
+        return True
+
+    def show_frame_number(self, frame_number):
+        self.centre_label.setText("{}/{}".format(frame_number,
+                                                 self.max_frame))
+        self.left_label.setText(fmt_frame_to_time(
+            frame_number, self.video.fps))
+        self.right_label.setText('-' + fmt_frame_to_time(
+            self.max_frame - frame_number, self.video.fps))
+        self.overview_line.setValue(frame_number)
 
     def on_open_video_button_clicked(self, checked=None):
         if checked is None:
@@ -224,7 +578,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         filename = QFileDialog.getOpenFileName(
                 self, caption='Open file...',
                 directory=self.working_dir,
-                filter='Video files (*.avi *.mp4 *.mov *.tif *.tiff)')
+                filter=('Video files (*.avi *.mp4 *.mov *.tif *.tiff '
+                        'header.json)'))
         filename = filename[0]
         if not filename:
             return
@@ -238,15 +593,25 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         # Open video.
         try:
-            self.video = Video(filename)
+            self.video = Video(filename, binning=SPATIAL_BINNING)
         except ModuleNotFoundError as error:
             msg = "Unable to open file: missing module.\n" + error.msg
             QtGui.QMessageBox.critical(self.parent(), "Warning", msg)
             return
+        except (OSError, ValueError) as error:
+            # E.g. a pattern that matches no images, or a file that is
+            # not a video.
+            msg = "Unable to open file.\n" + str(error)
+            QtGui.QMessageBox.critical(self.parent(), "Warning", msg)
+            return
+
+        # Display range for Auto level: the full bit-depth range until
+        # it is sampled in the background (see ProjectionThread).
+        self.auto_levels = (0.0, float(2**self.video.bits_per_sample) - 1)
 
         # Read and display first frame.
         self.frame, levels = self.get_video_frame(frame_number=0)
-        self.img_item.setImage(self.frame, levels)
+        self.set_image(self.frame, levels)
         self.view_box.setRange(xRange=(0, self.video.width),
                                yRange=(0, self.video.height))
 
@@ -259,6 +624,212 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.roi_box.setEnabled(True)
         self.display_box.setEnabled(True)
 
+        self.start_projections()
+
+    # Playback --------------------------------------------------------
+
+    def on_play_button_clicked(self, checked=None):
+        if checked is None:
+            return
+        if checked:
+            self.start_playback()
+        else:
+            self.stop_playback()
+
+    def start_playback(self):
+        '''
+        Plays the video from the current frame at PLAYBACK_SPEED times
+        its frame rate. Frames are read by a PlaybackThread and
+        displayed by a timer, which drops frames if they are not read
+        or displayed fast enough to keep in time.
+        '''
+        start = self.scrollbar.value()
+        if start >= self.max_frame:
+            start = 0
+        if self.display_combo.currentIndex() != 0:
+            self.display_combo.blockSignals(True)
+            self.display_combo.setCurrentIndex(0)
+            self.display_combo.blockSignals(False)
+
+        self.playback_thread = PlaybackThread(self.video, start, parent=self)
+        self.playback_thread.start()
+        self.show_memory()
+        self._playback_start = (start, time.perf_counter())
+        self._playback_pending = None
+        self._dropped_frames = 0
+        fps = self.video.fps * PLAYBACK_SPEED
+        self.playback_timer.start(max(1, int(1000 / fps)))
+        self.play_button.setChecked(True)
+        self.play_button.setText('Stop')
+
+    def stop_playback(self):
+        if self.playback_thread is None:
+            return
+        self.playback_timer.stop()
+        self.playback_thread.requestInterruption()
+        self.playback_thread.wait()
+        self.playback_thread = None
+        self.show_memory()
+        self.play_button.setChecked(False)
+        self.play_button.setText('Play')
+
+    def on_playback_timeout(self):
+        # Frame that should be displayed now.
+        (start, start_time) = self._playback_start
+        elapsed = time.perf_counter() - start_time
+        target = start + int(elapsed * self.video.fps * PLAYBACK_SPEED)
+        target = min(target, self.max_frame)
+        self.playback_thread.target = target
+
+        # Take the latest frame read that is not ahead of the target;
+        # any earlier ones are dropped. Frames ahead of the target are
+        # kept for later.
+        latest = None
+        frames = self.playback_thread.frames
+        while True:
+            if self._playback_pending is None:
+                try:
+                    self._playback_pending = frames.get_nowait()
+                except queue.Empty:
+                    break
+            if self._playback_pending[0] > target:
+                break
+            if latest is not None:
+                self._dropped_frames += 1
+            latest = self._playback_pending
+            self._playback_pending = None
+        if latest is None:
+            # Stop if there is nothing else to read.
+            if (self._playback_pending is None and frames.empty() and
+                    self.playback_thread.isFinished()):
+                self.stop_playback()
+            return
+
+        (frame_number, frame) = latest
+        self.display_video_frame(frame_number, frame)
+        self.scrollbar.blockSignals(True)
+        self.scrollbar.setValue(frame_number)
+        self.scrollbar.blockSignals(False)
+        self.statusbar_right.setText('Playing ({} dropped)'.format(
+            self._dropped_frames))
+        if frame_number >= self.max_frame:
+            self.stop_playback()
+
+    # Projections -----------------------------------------------------
+
+    def start_projections(self):
+        '''
+        Starts calculating the projections of the video in the
+        background. They are offered in the display box when ready.
+        '''
+        self.projection_thread = ProjectionThread(self.video, parent=self)
+        self.projection_thread.levels.connect(self.on_levels_sampled)
+        self.projection_thread.progress.connect(
+            self.on_projection_progress)
+        self.projection_thread.done.connect(self.on_projections_done)
+        self.projection_thread.failed.connect(self.on_projections_failed)
+        self.projection_thread.start()
+
+    def stop_projections(self):
+        if self.projection_thread is not None:
+            self.projection_thread.requestInterruption()
+            self.projection_thread.wait()
+            self.projection_thread = None
+        self.projections = None
+        self.clear_overview()
+
+    def on_levels_sampled(self, levels):
+        self.auto_levels = levels
+        if (self.autoLevel_button.isChecked() and
+                self.display_combo.currentIndex() == 0):
+            self.set_image(self.frame, levels)
+
+    def on_projection_progress(self, percent):
+        self.statusbar_right.setText('Projections {}%'.format(percent))
+
+    def on_projections_done(self, summaries):
+        (self.projections, self.overview) = summaries
+        self.show_overview()
+        if self.projections is None:
+            self.statusbar_right.setText(
+                    'Not enough memory for the projections')
+        else:
+            for (name, label) in PROJECTION_LABELS.items():
+                self.display_combo.addItem(label, name)
+            self.statusbar_right.setText('Projections ready')
+        self.show_memory()
+
+    def on_projections_failed(self, message):
+        self.statusbar_right.setText(message)
+        self.show_memory()
+
+    # Overview --------------------------------------------------------
+
+    def show_overview(self):
+        '''
+        Shows the mean intensity of every frame, over as many
+        thumbnails, side by side, as fit in the overview.
+        '''
+        means = self.overview.means
+        if not len(means):
+            return
+        self.overview_curve.setData(np.arange(len(means)), means)
+        (low, high) = (np.nanmin(means), np.nanmax(means))
+        if not high > low:
+            (low, high) = (low - 0.5, low + 0.5)
+        self.overview_plot.setRange(xRange=(0, len(means)),
+                                    yRange=(low, high), padding=0)
+        self.overview_line.show()
+
+        thumbnails = self.overview.thumbnails
+        if thumbnails is None:
+            return
+        (height, width) = thumbnails.shape[1:]
+        # Thumbnails keep their aspect ratio at the height of the view.
+        count = self.overview_view.width() * height // (
+            self.overview_view.height() * width)
+        count = min(max(count, 1), len(thumbnails))
+        indices = np.linspace(0, len(thumbnails) - 1, count).astype(int)
+        strip = np.hstack(thumbnails[indices])
+        levels = self.get_levels()
+        if DisplayLut.supports(strip):
+            strip = self.display_lut.apply(strip, levels)
+            levels = (0, 255)
+        self.overview_strip.setImage(strip, levels=levels)
+        self.overview_strip.setRect(QRectF(0, high, len(means), low - high))
+
+    def clear_overview(self):
+        self.overview = None
+        self.overview_curve.setData([], [])
+        self.overview_strip.clear()
+        self.overview_line.hide()
+
+    def on_overview_clicked(self, event):
+        if self.video is None or self.overview is None:
+            return
+        position = self.overview_plot.vb.mapSceneToView(event.scenePos())
+        frame_number = int(min(max(position.x(), 0), self.max_frame))
+        self.scrollbar.setValue(frame_number)
+
+    def display_projection(self, name):
+        image = getattr(self.projections, name)
+        if name == 'std':
+            # Not in the same units as the frames.
+            levels = (0.0, image.max())
+        else:
+            levels = self.get_levels()
+        self.set_image(image, levels)
+
+    @pyqtSlot(int)
+    def on_display_combo_currentIndexChanged(self, index):
+        if self.video is None:
+            return
+        name = self.display_combo.itemData(index)
+        if name is None:
+            self.display_video_frame(self.scrollbar.value())
+        else:
+            self.display_projection(name)
+
     def on_reset_view_button_clicked(self, checked=None):
         if checked is None:
             return
@@ -312,11 +883,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         if checked is None:
             return
-        filename = os.path.splitext(self.video.filename)
-        filename = filename[0] + '_ROIs.tsv'
+        filename = companion_name(self.video.filename) + '_ROIs.tsv'
 
         try:
-            rois = pd.read_csv(filename, sep='\t')
+            rois = load_rois(filename)
         except FileNotFoundError as error:
             msg = ("\n\nN.B. A ROI file is only loaded if it is " +
                    "named after the main file and saved in the same" +
@@ -326,13 +896,13 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                     "ROIs file not found", error.args[0] + msg)
             return
 
-        for (index, roi) in rois.iterrows():
-            pos = (roi.x_pos, roi.y_pos)
-            size = (roi.x_size, roi.y_size)
-            new_roi = Roi(parent=self, pos=pos, size=size,
+        for roi in rois:
+            roi = roi.scaled(1 / self.video.binning)
+            new_roi = Roi(parent=self, pos=(roi.x_pos, roi.y_pos),
+                          size=(roi.x_size, roi.y_size),
                           angle=roi.angle)
-            new_roi.setObjectName(roi['name'])
-        self._roi_counter = index + 1
+            new_roi.setObjectName(roi.name)
+        self._roi_counter = len(rois)
 
         if not self.fluorescence_box.isEnabled():
             self.fluorescence_box.setEnabled(True)
@@ -351,34 +921,24 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if len(self.rois) == 0:
             self.statusbar_right.setText("Nothing to save")
             return
-        filename = os.path.splitext(self.video.filename)
-        filename = filename[0] + '_ROIs.tsv'
+        filename = companion_name(self.video.filename) + '_ROIs.tsv'
 
-        headerfmt = '{}\t{}\t{}\t{}\t{}\t{}\n'
-        datafmt = '{}\t{:.6f}\t{:.6f}\t{:.6f}\t{:.6f}\t{:.6f}\n'
-        header = ("name", "x_pos", "y_pos", "x_size", "y_size", "angle")
-        header = headerfmt.format(*header)
-
-        f = open(filename, 'w')
-        f.write(header)
-        for roi in self.rois:
-            data = datafmt.format(roi.objectName(),
-                                  roi.pos().x(), roi.pos().y(),
-                                  roi.size().x(), roi.size().y(),
-                                  roi.angle())
-            f.write(data)
-        f.close()
+        save_rois(filename, [roi.geometry().scaled(self.video.binning)
+                             for roi in self.rois])
 
     # Fluorescence buttons --------------------------------------------
 
-    def on_measure_button_clicked(self, checked=None):
-        if checked is None:
-            return
-
+    def get_rois_to_measure(self, rasterise=True):
+        '''
+        Returns the ROIs, ready to be measured, or None if there are
+        none or their names are not unique. With MEASURE_METHOD
+        'labels' they are rasterised into a LabelImage, unless
+        `rasterise` is False.
+        '''
         # Get the ROIs from the list of added items to the view box and
         # sort them by object name.
         if len(self.rois) == 0:
-            return
+            return None
         rois = sorted(self.rois, key=lambda x: x.objectName())
 
         # Check if any names are duplicated. If so, stop and ask the
@@ -388,70 +948,157 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             msg = ('Some ROI names are duplicated.\n' +
                    'Fix this before continuing.')
             QtGui.QMessageBox.warning(self.parent(), "Warning", msg)
+            return None
+
+        rois = [roi.geometry() for roi in rois]
+        if MEASURE_METHOD == 'labels' and rasterise:
+            rois = LabelImage.from_rois(rois, self.video.width,
+                                        self.video.height)
+        return rois
+
+    def set_measures(self):
+        '''
+        Offers all the measures available in the data for plotting.
+        '''
+        measures = self.intensity.attrs['measures']
+        if [self.measure_combo.itemData(index) for index in
+                range(self.measure_combo.count())] == measures:
+            return
+        self.measure_combo.clear()
+        for name in measures:
+            self.measure_combo.addItem(measure_label(name), name)
+
+    def on_measure_button_clicked(self, checked=None):
+        if checked is None:
+            return
+        self.stop_playback()
+        self.stop_follow()
+
+        rois = self.get_rois_to_measure(rasterise=MEASURE_DAEMON is None)
+        if rois is None:
             return
 
         # Set-up progress dialog.
         self.statusbar_right.setText("Measure")
-        total_frame_count = self.video.frame_count * len(rois)
-        total_frame_count -= 1
         progress = QtGui.QProgressDialog(
-            'Processing...', 'Cancel', 0, total_frame_count,
-            parent=self)
+            'Processing...', 'Cancel', 0, 1, parent=self)
         progress.setWindowModality(Qt.WindowModal)
 
-        # Create a data frame to hold mean intensity values. Each row
-        # is a frame and each column is a ROI. Add also a 'time'
-        # column.
-        frames = np.arange(self.video.frame_count)
-        self.intensity = pd.DataFrame(index=frames,
-                                      columns=['time'] + names)
-        self.intensity.index.name = 'frame'
-        self.intensity.time = frames / self.video.fps
-
-        # Loop over ROIs and frames and calculate mean intensity.
-        for (roi_number, roi) in enumerate(rois):
-            mask = np.ones_like(self.frame)
-            mask = roi.getArrayRegion(mask, self.img_item)
-            mask = mask.astype('bool')
-            roi_name = roi.objectName()
-
-            for frame_number in frames:
-
-                # Update progress dialog.
-                progress_frame = frame_number + (
-                        roi_number * self.video.frame_count)
-                progress.setValue(progress_frame)
-
-                # If the user cancels, clear data.
-                if progress.wasCanceled():
-                    self.intensity = None
-                    return
-
-                # Calculate ROI mean intensity.
-                frame, _ = self.get_video_frame(frame_number)
-                data = roi.getArrayRegion(frame, self.img_item)
-                mean_intensity = data[mask].mean()
-                self.intensity.loc[frame_number, roi_name] = (
-                        mean_intensity)
-
-        # These lines calculate the intensity of the whole video
-        # without looping. They require the video to be fully loaded as
-        # a 3D arrray, which is the case when reading tiff files.
-        # However, with cv2 it is necessary to read one frame at a
-        # time, so not all the frames are loaded at once when the video
-        # is opened. I've compared this 'fast' method to the startdard,
-        # looping one, and the results are identical.
-        # if IS_TIFF:
-        #     roi_region = roi.getArrayRegion(
-        #         self.video.capture, self.img_item, axes=(2, 1))
-        #     mask = roi_region.astype('bool')
-        #     roi_region[~mask] = np.nan
-        #     intensity = np.nanmean(roi_region, axis=(1, 2))
-        # else:
-        #     pass
+        def update_progress(frames_done, frame_count):
+            progress.setMaximum(frame_count)
+            progress.setValue(frames_done)
+            return progress.wasCanceled()
+
+        if MEASURE_DAEMON is not None:
+            self.intensity = self.measure_in_daemon(rois, update_progress)
+            if self.intensity is None:
+                return
+            self.set_measures()
+            self.statusbar_right.setText("Done")
+            return
+
+        # Estimate motion, or load it if estimated before.
+        shifts = None
+        if MOTION_CORRECTION:
+            progress.setLabelText('Estimating motion...')
+            shifts = get_shifts(self.video, binning=MOTION_BINNING,
+                                progress=update_progress)
+            if shifts is None:
+                return
+            progress.setLabelText('Processing...')
+
+        # Calculate mean intensity. Each row in the resulting data
+        # frame is a frame and each column is a ROI, plus a 'time'
+        # column. If the user cancels, data are cleared.
+        self.intensity = measure(self.video, rois, shifts=shifts,
+                                 progress=update_progress,
+                                 **MEASURE_OPTIONS)
+        if self.intensity is None:
+            return
+
+        self.set_measures()
 
         # Print message to statusbar.
-        self.statusbar_right.setText("Done")
+        if self.video.binning > 1:
+            self.statusbar_right.setText("Done (binned {0} x {0})".format(
+                self.video.binning))
+        else:
+            self.statusbar_right.setText("Done")
+
+    def measure_in_daemon(self, rois, progress):
+        '''
+        Measures `rois` (a list of EllipseRoi) in the daemon at
+        MEASURE_DAEMON, which estimates motion too if needed. Returns
+        the data, or None if cancelled or failed.
+        '''
+        # The daemon opens the file as this window does, so only the
+        # binning added here is sent; `binning` also counts that of the
+        # file itself (e.g. a binned frame store).
+        binning = 1
+        if isinstance(self.video, VideoBinned):
+            binning = self.video.factor
+        try:
+            return daemon.submit(
+                    self.video.filename, rois, method=MEASURE_METHOD,
+                    motion=MOTION_CORRECTION, motion_binning=MOTION_BINNING,
+                    video_binning=binning, progress=progress,
+                    address=MEASURE_DAEMON or None, **MEASURE_OPTIONS)
+        except (OSError, RuntimeError) as error:
+            msg = "Unable to measure in the daemon:\n" + str(error)
+            QtGui.QMessageBox.warning(self.parent(), "Warning", msg)
+            return None
+
+    def on_follow_button_clicked(self, checked=None):
+        if checked is None:
+            return
+        if checked:
+            self.start_follow()
+        else:
+            self.stop_follow()
+
+    def start_follow(self):
+        '''
+        Measures the video while it is being recorded: every
+        FOLLOW_INTERVAL ms new frames are measured and the plot, if
+        open, is updated. Motion correction is not available.
+        '''
+        self.follow_button.setChecked(False)
+        rois = self.get_rois_to_measure()
+        if rois is None:
+            return
+        self.stop_playback()
+        options = dict(MEASURE_OPTIONS)
+        self._follow_bin_size = options.pop('bin_size')
+        options.pop('workers')
+        self.measurement = Measurement(self.video, rois, **options)
+        self.follow_timer.start(FOLLOW_INTERVAL)
+        self.follow_button.setChecked(True)
+        self.statusbar_right.setText("Following")
+
+    def stop_follow(self):
+        if self.measurement is None:
+            return
+        self.follow_timer.stop()
+        self.measurement = None
+        self.follow_button.setChecked(False)
+
+    def on_follow_timeout(self):
+        video = self.measurement.video
+        if video.refresh():
+            self.max_frame = self.video.frame_count - 1
+            self.scrollbar.blockSignals(True)
+            self.scrollbar.setMaximum(self.video.frame_count)
+            self.scrollbar.blockSignals(False)
+
+        stop = (self.measurement.next_frame +
+                FOLLOW_CHUNK * self.measurement.step)
+        if not self.measurement.update(stop):
+            return
+        self.intensity = self.measurement.result(self._follow_bin_size)
+        self.set_measures()
+        self.update_plot()
+        self.statusbar_right.setText("Following: frame {}".format(
+            self.measurement.next_frame - 1))
 
     def on_plot_button_clicked(self, checked=None):
         if checked is None:
@@ -474,13 +1121,28 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         yfont.setPointSize(y_tick_fontsize)
         xfont.setPointSize(x_tick_fontsize)
 
-        self.plot_window = pg.GraphicsWindow(title='Mean ROI intensity')
+        measure_name = self.measure_combo.currentData()
+        if measure_name is None:
+            measure_name = 'intensity'
+        intensity = select_measure(self.intensity, measure_name)
+
+        if measure_name == 'intensity':
+            title = 'Mean ROI intensity'
+        else:
+            title = 'ROI ' + measure_label(measure_name)
+        if self.video.binning > 1:
+            title += ' (binned {0} x {0})'.format(self.video.binning)
+        self.plot_window = pg.GraphicsWindow(title=title)
+        # Curves are kept to update them with Follow.
+        self.plot_measure = measure_name
+        self.plot_curves = {}
         plots = []
         # The first column is time so should be ignored.
-        for column in self.intensity.columns[1:]:
+        for column in intensity.columns[1:]:
             plt = self.plot_window.addPlot()
-            y = self.intensity[column]
-            plt.plot(self.intensity.time, y, pen=(3, 9))
+            y = intensity[column]
+            self.plot_curves[column] = plt.plot(intensity.time, y,
+                                                pen=(3, 9))
 
             # Hide x labels.
             plt.getAxis('bottom').setStyle(showValues=False)
@@ -521,6 +1183,16 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.plot_window.resize(*plot_window_size)
         self.plot_window.show()
 
+    def update_plot(self):
+        '''
+        Updates the curves in the plot window with the data measured.
+        '''
+        if self.plot_window is None or not self.plot_window.isVisible():
+            return
+        intensity = select_measure(self.intensity, self.plot_measure)
+        for (column, curve) in self.plot_curves.items():
+            curve.setData(intensity.time.values, intensity[column].values)
+
     def on_save_button_clicked(self, checked=None):
         '''
         Save intensity data from ROIs in a tab-separated file.
@@ -530,23 +1202,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if self.intensity is None:
             return
 
-        filename = os.path.splitext(self.video.filename)
-        filename = filename[0] + '.tsv'
-
-        if OUT_TABLE_FMT == 'long':
-            # Convert table from wide to long format
-            intensity = self.intensity.reset_index()
-            intensity = intensity.melt(
-                    id_vars = ['frame', 'time'],
-                    var_name = 'roi',
-                    value_name = 'intensity')
-            intensity.to_csv(filename, sep='\t', index = False)
-
-        elif OUT_TABLE_FMT == 'wide':
-            self.intensity.to_csv(filename, sep='\t', index = True)
+        filename = companion_name(self.video.filename)
+        if self.video.binning > 1:
+            filename += '_bin{}'.format(self.video.binning)
+        filename += '.tsv'
 
-        else:
-            raise ValueError("OUT_TABLE_FMT must be 'wide' or 'long'")
+        save_intensity(filename, self.intensity, OUT_TABLE_FMT)
 
         self.statusbar_right.setText("Data saved")
 
@@ -559,6 +1220,16 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.video.close()
         self.close()
 
+    def closeEvent(self, event):
+        '''
+        Method from QMainWindow, overridden to stop any background
+        work before the window closes.
+        '''
+        self.stop_playback()
+        self.stop_follow()
+        self.stop_projections()
+        super().closeEvent(event)
+
 
 if __name__ == "__main__":
     import argparse